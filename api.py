@@ -0,0 +1,406 @@
+"""FinanFlow JSON API: the core data layer over HTTP for mobile and automation clients.
+
+    uvicorn api:app --host 0.0.0.0 --port 8000
+
+Settings come from the environment (DATABASE_URL, SESSION_SECRET, ...). Clients log in at
+POST /api/v1/login and send the returned token as "Authorization: Bearer <token>"; a refreshed
+token comes back in the X-Session-Token header. GET responses carry a weak ETag and answer
+If-None-Match with 304; bodies are gzipped when the client accepts it.
+
+In-process client for local tests (needs httpx):
+
+    from starlette.testclient import TestClient
+    client = TestClient(api.app)
+"""
+import contextlib
+import contextvars
+import datetime
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+import pandas as pd
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from core import aggregations, auth, config, repository
+from core.errors import DatabaseUnavailable, FinanFlowError
+
+API_PREFIX = "/api/v1"
+API_PAGE_SIZE = 100          # default page of GET /transactions
+API_MAX_PAGE_SIZE = 500
+API_MAX_BATCH = 1000         # transactions per POST/DELETE batch
+API_MAX_ID = 2 ** 31 - 1     # ids are INTEGER columns
+API_MAX_AMOUNT = Decimal("999999999999.99")  # R$ per transaction or goal; far inside the BIGINT cents
+API_SESSION_STATES = 10000   # users whose replica stickiness is remembered
+GZIP_MINIMUM_SIZE = 500      # bytes; smaller bodies are sent as is
+
+logger = logging.getLogger(__name__)
+
+# Replica stickiness is kept per API user (the request's context), not per server thread
+_api_user = contextvars.ContextVar("api_user", default=None)
+_session_states = OrderedDict()
+_session_states_lock = threading.Lock()
+
+def _session_state():
+    user_id = _api_user.get()
+    if user_id is None:
+        raise RuntimeError("outside an authenticated request")
+    with _session_states_lock:
+        state = _session_states.setdefault(user_id, {})
+        _session_states.move_to_end(user_id)
+        while len(_session_states) > API_SESSION_STATES:
+            _session_states.popitem(last=False)
+        return state
+
+config.configure(session_state=_session_state)
+
+class ApiError(Exception):
+    """Error answered as {"error": message} with the given HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# --- Serialization ---
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime, pd.Timestamp)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _records(df):
+    """DataFrame rows as JSON-ready dicts (NaN/NaT become null)."""
+    if df.empty:
+        return []
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def _dump(data):
+    return json.dumps(data, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _respond(request, data, status=200, headers=None):
+    """JSON response; GETs get a weak ETag and a 304 when the client already has this body."""
+    body = _dump(data)
+    headers = dict(headers or {})
+    if request.method == "GET":
+        etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        headers["ETag"] = etag
+        headers["Cache-Control"] = "private, no-cache"
+        # Weak comparison: the W/ prefix is ignored on both sides
+        candidates = [t.strip()[2:] if t.strip().startswith("W/") else t.strip()
+                      for t in request.headers.get("if-none-match", "").split(",")]
+        if "*" in candidates or etag[2:] in candidates:
+            return Response(status_code=304, headers=headers)
+    return Response(body, status_code=status, headers=headers, media_type="application/json")
+
+# --- Request helpers ---
+
+async def _authenticate(request):
+    """Returns the user of the bearer token and sets the request context; raises ApiError 401."""
+    header = request.headers.get("authorization", "")
+    scheme, _, token = header.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise ApiError(401, "Token ausente. Envie 'Authorization: Bearer <token>'.")
+    user, fresh_token = await run_in_threadpool(auth.validate_session_token, token.strip())
+    if user is None:
+        raise ApiError(401, "Sessão inválida ou expirada.")
+    _api_user.set(user["id"])
+    request.state.fresh_token = fresh_token if fresh_token != token.strip() else None
+    return user
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except Exception:
+        raise ApiError(400, "Corpo JSON inválido.") from None
+
+def _date(value, field):
+    if value in (None, ""):
+        return None
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        raise ApiError(400, f"'{field}' deve ser uma data AAAA-MM-DD.") from None
+
+def _int(value, field, default=None, minimum=None, maximum=None, required=False):
+    if value in (None, ""):
+        if required:
+            raise ApiError(400, f"'{field}' é obrigatório.")
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, f"'{field}' deve ser um número inteiro.") from None
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        raise ApiError(400, f"'{field}' fora do intervalo permitido.")
+    return number
+
+def _path_id(request, name):
+    """Integer path parameter; ids no row can have answer 404 instead of a database error."""
+    value = request.path_params[name]
+    if not 1 <= value <= API_MAX_ID:
+        raise ApiError(404, "Registro não encontrado.")
+    return value
+
+def _amount(value, field="amount", allow_negative=False):
+    """Positive amount of at least one cent and at most API_MAX_AMOUNT (negative too when allowed)."""
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        raise ApiError(400, f"'{field}' deve ser um número.") from None
+    if not amount.is_finite():
+        raise ApiError(400, f"'{field}' deve ser um número.")
+    if amount < 0 and not allow_negative:
+        raise ApiError(400, f"'{field}' deve ser positivo.")
+    if not Decimal("0.01") <= abs(amount) <= API_MAX_AMOUNT:
+        raise ApiError(400, f"'{field}' deve estar entre 0,01 e {API_MAX_AMOUNT:,}.")
+    return amount
+
+def _transaction_fields(data):
+    """Validates a transaction object; returns (date, type, category, amount, description)."""
+    if not isinstance(data, dict):
+        raise ApiError(400, "Cada transação deve ser um objeto JSON.")
+    date = _date(data.get("date"), "date")
+    if date is None:
+        raise ApiError(400, "'date' é obrigatório.")
+    type_ = data.get("type")
+    if type_ not in aggregations.TRANSACTION_TYPES:
+        raise ApiError(400, f"'type' deve ser um de: {', '.join(aggregations.TRANSACTION_TYPES)}.")
+    category = str(data.get("category") or "").strip()
+    if not category:
+        raise ApiError(400, "'category' é obrigatório.")
+    description = data.get("description")
+    # Redemptions are negative investments
+    amount = _amount(data.get("amount"), allow_negative=type_ == "Investimento")
+    return date, type_, category, amount, None if description is None else str(description)
+
+def endpoint(fn):
+    """Wraps a handler(request, user): authentication, error mapping and the refreshed-token header."""
+    async def wrapper(request):
+        try:
+            user = await _authenticate(request)
+            response = await fn(request, user)
+        except ApiError as e:
+            return JSONResponse({"error": str(e)}, status_code=e.status)
+        except DatabaseUnavailable:
+            return JSONResponse({"error": "Banco de dados indisponível."}, status_code=503)
+        except FinanFlowError:
+            logger.exception("API call %s %s failed", request.method, request.url.path)
+            return JSONResponse({"error": "Erro ao acessar o banco de dados."}, status_code=500)
+        fresh_token = getattr(request.state, "fresh_token", None)
+        if fresh_token:
+            response.headers["X-Session-Token"] = fresh_token
+        return response
+    return wrapper
+
+# --- Session ---
+
+async def login(request):
+    try:
+        data = await _json_body(request)
+    except ApiError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status)
+    if not isinstance(data, dict):
+        return JSONResponse({"error": "Envie um objeto com 'email' e 'password'."}, status_code=400)
+    email, password = str(data.get("email") or ""), str(data.get("password") or "")
+    client_id = auth.client_address(
+        request.headers.get("x-forwarded-for"), request.client.host if request.client else None
+    ) or "unknown"
+    user = await run_in_threadpool(auth.check_login, email, password, client_id)
+    if user is None:
+        return JSONResponse({"error": "E-mail ou senha incorretos."}, status_code=401)
+    status = user.get("status")
+    if status == "throttled":
+        return JSONResponse({"error": "Muitas tentativas. Tente novamente em instantes."}, status_code=429,
+                            headers={"Retry-After": str(auth.LOGIN_EMAIL_REFILL_SECONDS)})
+    if status == "busy":
+        return JSONResponse({"error": "Servidor ocupado. Tente novamente."}, status_code=503, headers={"Retry-After": "1"})
+    if status == "expired":
+        return JSONResponse({"error": "Seu acesso expirou."}, status_code=403)
+    if status != "active":
+        return JSONResponse({"error": "Conta aguardando aprovação ou bloqueada."}, status_code=403)
+    return JSONResponse({"token": auth.issue_session_token(user), "user": user})
+
+@endpoint
+async def logout(request, user):
+    token = request.headers["authorization"].partition(" ")[2].strip()
+    payload = auth.verify_session_token(token)
+    if payload:
+        await run_in_threadpool(auth.revoke_session_token, payload)
+    request.state.fresh_token = None
+    return Response(status_code=204)
+
+# --- Transactions ---
+
+@endpoint
+async def list_transactions(request, user):
+    query = request.query_params
+    start, end = _date(query.get("start"), "start"), _date(query.get("end"), "end")
+    type_filter = query.get("type") or None
+    if type_filter and type_filter not in aggregations.TRANSACTION_TYPES:
+        raise ApiError(400, f"'type' deve ser um de: {', '.join(aggregations.TRANSACTION_TYPES)}.")
+    limit = _int(query.get("limit"), "limit", API_PAGE_SIZE, 1, API_MAX_PAGE_SIZE)
+    offset = _int(query.get("offset"), "offset", 0, 0)
+
+    df, total = await run_in_threadpool(
+        repository.get_transactions_page, user["id"], start, end, type_filter, limit, offset
+    )
+    next_offset = offset + limit if offset + limit < total else None
+    return _respond(request, {
+        "items": _records(df), "total": int(total), "limit": limit, "offset": offset, "next_offset": next_offset,
+    })
+
+@endpoint
+async def create_transactions(request, user):
+    """One transaction object, or a list of them added in a single statement."""
+    data = await _json_body(request)
+    items = data if isinstance(data, list) else [data]
+    if not items or len(items) > API_MAX_BATCH:
+        raise ApiError(400, f"Envie entre 1 e {API_MAX_BATCH} transações.")
+    rows = [_transaction_fields(item) for item in items]
+    await run_in_threadpool(repository.add_transactions, user["id"], rows)
+    return _respond(request, {"created": len(rows)}, status=201)
+
+@endpoint
+async def update_transaction(request, user):
+    transaction_id = _path_id(request, "transaction_id")
+    date, type_, category, amount, description = _transaction_fields(await _json_body(request))
+    updated = await run_in_threadpool(
+        repository.update_transaction, transaction_id, date, type_, category, amount, description, user["id"]
+    )
+    if not updated:
+        raise ApiError(404, "Transação não encontrada.")
+    return _respond(request, {"updated": transaction_id})
+
+@endpoint
+async def delete_transaction(request, user):
+    transaction_id = _path_id(request, "transaction_id")
+    if not await run_in_threadpool(repository.delete_transaction, transaction_id, user["id"]):
+        raise ApiError(404, "Transação não encontrada.")
+    return Response(status_code=204)
+
+@endpoint
+async def delete_transactions(request, user):
+    """Batch delete: {"ids": [...]}."""
+    data = await _json_body(request)
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids or len(ids) > API_MAX_BATCH:
+        raise ApiError(400, f"Envie 'ids' com entre 1 e {API_MAX_BATCH} ids.")
+    ids = [_int(i, "ids", minimum=1, maximum=API_MAX_ID, required=True) for i in ids]
+    deleted = await run_in_threadpool(repository.delete_transactions, ids, user["id"])
+    return _respond(request, {"deleted": deleted})
+
+# --- Aggregates ---
+
+@endpoint
+async def monthly_summary(request, user):
+    today = datetime.date.today()
+    month = _int(request.query_params.get("month"), "month", today.month, 1, 12)
+    year = _int(request.query_params.get("year"), "year", today.year, 1900, 9999)
+    income, expense, investment = await run_in_threadpool(repository.get_monthly_summary, user["id"], month, year)
+    return _respond(request, {
+        "month": month, "year": year, "income": income, "expense": expense, "investment": investment,
+        "balance": income - expense - investment,
+    })
+
+@endpoint
+async def monthly_series(request, user):
+    today = datetime.date.today()
+    month = _int(request.query_params.get("month"), "month", today.month, 1, 12)
+    year = _int(request.query_params.get("year"), "year", today.year, 1900, 9999)
+    months = _int(request.query_params.get("months"), "months", 12, 1, 120)
+    series = await run_in_threadpool(repository.get_monthly_series, user["id"], month, year, months)
+    series = series.rename_axis("month").reset_index()
+    return _respond(request, {"items": _records(series)})
+
+@endpoint
+async def portfolio(request, user):
+    as_of = _date(request.query_params.get("as_of"), "as_of")
+    as_of = as_of.isoformat() if as_of else None
+    summary, total, evolution = await run_in_threadpool(lambda: (
+        repository.get_portfolio_summary(user["id"], as_of),
+        repository.get_total_portfolio_value(user["id"], as_of),
+        repository.get_portfolio_evolution(user["id"]),
+    ))
+    return _respond(request, {
+        "as_of": as_of, "total": total, "categories": _records(summary), "evolution": _records(evolution),
+    })
+
+@endpoint
+async def categories(request, user):
+    type_filter = request.query_params.get("type")
+    if type_filter not in aggregations.TRANSACTION_TYPES:
+        raise ApiError(400, f"'type' deve ser um de: {', '.join(aggregations.TRANSACTION_TYPES)}.")
+    names = await run_in_threadpool(repository.get_all_categories, user["id"], type_filter)
+    return _respond(request, {"items": list(names)})
+
+@endpoint
+async def ai_context(request, user):
+    context = await run_in_threadpool(repository.get_ai_financial_context, user["id"])
+    return _respond(request, context)
+
+# --- Goals ---
+
+@endpoint
+async def list_goals(request, user):
+    goals = await run_in_threadpool(repository.get_goals, user["id"])
+    return _respond(request, {"items": _records(goals)})
+
+@endpoint
+async def save_goal(request, user):
+    """Creates or updates the goal of a category: {"category": ..., "target": ...}."""
+    data = await _json_body(request)
+    category = str(data.get("category") or "").strip() if isinstance(data, dict) else ""
+    if not category:
+        raise ApiError(400, "'category' é obrigatório.")
+    target = _amount(data.get("target"), "target")
+    await run_in_threadpool(repository.update_goal_target, user["id"], category, target)
+    return _respond(request, {"category": category, "target": target})
+
+@endpoint
+async def delete_goal(request, user):
+    goal_id = _path_id(request, "goal_id")
+    if not await run_in_threadpool(repository.delete_goal, goal_id, user["id"]):
+        raise ApiError(404, "Meta não encontrada.")
+    return Response(status_code=204)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(repository.ensure_schema)
+    yield
+
+routes = [
+    Route(f"{API_PREFIX}/login", login, methods=["POST"]),
+    Route(f"{API_PREFIX}/logout", logout, methods=["POST"]),
+    Route(f"{API_PREFIX}/transactions", list_transactions, methods=["GET"]),
+    Route(f"{API_PREFIX}/transactions", create_transactions, methods=["POST"]),
+    Route(f"{API_PREFIX}/transactions", delete_transactions, methods=["DELETE"]),
+    Route(f"{API_PREFIX}/transactions/{{transaction_id:int}}", update_transaction, methods=["PUT"]),
+    Route(f"{API_PREFIX}/transactions/{{transaction_id:int}}", delete_transaction, methods=["DELETE"]),
+    Route(f"{API_PREFIX}/summary", monthly_summary, methods=["GET"]),
+    Route(f"{API_PREFIX}/series", monthly_series, methods=["GET"]),
+    Route(f"{API_PREFIX}/portfolio", portfolio, methods=["GET"]),
+    Route(f"{API_PREFIX}/categories", categories, methods=["GET"]),
+    Route(f"{API_PREFIX}/ai-context", ai_context, methods=["GET"]),
+    Route(f"{API_PREFIX}/goals", list_goals, methods=["GET"]),
+    Route(f"{API_PREFIX}/goals", save_goal, methods=["PUT"]),
+    Route(f"{API_PREFIX}/goals/{{goal_id:int}}", delete_goal, methods=["DELETE"]),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)],
+    lifespan=lifespan,
+)
@@ -1,91 +1,69 @@
+import secrets
 import streamlit as st
-import database as db
-import bcrypt
+import database  # wires the core library to st.secrets, st.session_state and st.error
+import styles
+from core import auth as core_auth
+from core.auth import issue_session_token, verify_session_token, revoke_session_token, validate_session_token, register_user
 
-def hash_password(password):
-    """Hashes a password using bcrypt."""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# Signed session tokens are kept in the URL so reloads and new tabs skip the login
+SESSION_QUERY_PARAM = "session"
 
-def verify_password(password, hashed):
-    """Verifies a password against a hash."""
-    try:
-        # Ensure hashed is bytes
-        if isinstance(hashed, str):
-            hashed = hashed.encode('utf-8')
-        return bcrypt.checkpw(password.encode('utf-8'), hashed)
-    except Exception:
-        return False
+def _client_id():
+    """Client address of the current Streamlit request (see core.auth.client_address).
 
-def check_login(email, password):
-    """Verifies email and password. Returns user dict if successful, None otherwise."""
-    # First check for regular user in DB
-    try:
-        result = db.run_query("SELECT id, email, password_hash, role, status, expiry_date FROM users WHERE email = %s", (email,), return_data=True)
-        
-        if isinstance(result, list) and len(result) > 0:
-            user = result[0]
-            # Check if we have password_hash (index 2)
-            if len(user) >= 3:
-                stored_hash = user[2]
-                if verify_password(password, stored_hash):
-                    # Check Expiration (index 5)
-                    expiry = user[5]
-                    from datetime import datetime
-                    if expiry and datetime.now() > expiry:
-                        # Auto-block if expired
-                        db.run_query("UPDATE users SET status = 'blocked' WHERE id = %s", (user[0],))
-                        return {"status": "expired"}
-                    
-                    return {
-                        "id": user[0],
-                        "email": user[1],
-                        "role": user[3] if len(user) > 3 else 'user',
-                        "status": user[4] if len(user) > 4 else 'active'
-                    }
-        elif isinstance(result, str):
-            st.sidebar.error(f"Erro no Banco: {result}")
-    except Exception as e:
-        st.sidebar.error(f"Erro de processamento: {e}")
-    
-    # Check for admin (Credentials from secrets)
+    When none can be told, the browser session is its own client rather than sharing one
+    throttle bucket with every other unresolved client.
+    """
     try:
-        admin_email = st.secrets["general"]["admin_email"]
-        admin_pass = st.secrets["general"]["admin_password"]
+        address = core_auth.client_address(
+            st.context.headers.get("X-Forwarded-For"), getattr(st.context, "ip_address", None)
+        )
     except Exception:
-        # Fallback for local dev without secrets.toml
-        admin_email = "admin@finanflow.com" 
-        admin_pass = "admin@123"
+        address = None
+    if address:
+        return address
+    if "client_id" not in st.session_state:
+        st.session_state.client_id = f"session:{secrets.token_hex(8)}"
+    return st.session_state.client_id
 
-    if email == admin_email and password == admin_pass:
-        # Ensure admin exists in DB
-        existing = db.run_query("SELECT * FROM users WHERE email = %s", (email,), return_data=True)
-        if not existing or isinstance(existing, str):
-             db.run_query("INSERT INTO users (email, password_hash, role, status) VALUES (%s, %s, %s, %s)", 
-                          (email, hash_password(password), 'admin', 'active'))
-        return {"id": 0, "email": email, "role": "admin", "status": "active"}
-        
-    return None
+def start_session(user):
+    """Logs the user into this browser session and stores the signed token in the URL."""
+    token = issue_session_token(user)
+    st.session_state.user = user
+    st.session_state.session_token = token
+    st.query_params[SESSION_QUERY_PARAM] = token
 
-def register_user(email, password):
-    """Registers a new user with 'pending' status."""
-    existing = db.run_query("SELECT * FROM users WHERE email = %s", (email,), return_data=True)
-    if existing and not isinstance(existing, str):
-        return False, "E-mail já cadastrado."
-    
-    hashed = hash_password(password)
-    result = db.run_query("INSERT INTO users (email, password_hash, role, status) VALUES (%s, %s, %s, %s)", 
-                          (email, hashed, 'user', 'pending'))
-    
-    if result is True:
-        return True, "Cadastro realizado! Aguarde aprovação do administrador."
-    else:
-        return False, f"Erro ao cadastrar: {result}"
+def end_session():
+    """Revokes the current token and clears the browser session."""
+    token = st.session_state.get("session_token") or st.query_params.get(SESSION_QUERY_PARAM)
+    payload = verify_session_token(token) if token else None
+    if payload:
+        revoke_session_token(payload)
+    st.query_params.clear()
+    st.session_state.clear()
+
+def check_login(email, password):
+    """Verifies email and password for the current request's client (see core.auth.check_login)."""
+    return core_auth.check_login(email, password, _client_id())
 
 def require_auth():
-    """Checks if user is logged in, else shows login screen."""
+    """Checks if user is logged in (session state or signed token), else shows login screen."""
     if "user" not in st.session_state:
         st.session_state.user = None
 
+    token = st.session_state.get("session_token") or st.query_params.get(SESSION_QUERY_PARAM)
+    if token:
+        user, fresh_token = validate_session_token(token)
+        if user is None:
+            st.session_state.user = None
+            st.session_state.pop("session_token", None)
+            st.query_params.pop(SESSION_QUERY_PARAM, None)
+        else:
+            st.session_state.user = user
+            if fresh_token != token or st.query_params.get(SESSION_QUERY_PARAM) != fresh_token:
+                st.session_state.session_token = fresh_token
+                st.query_params[SESSION_QUERY_PARAM] = fresh_token
+
     if st.session_state.user is None:
         login_page()
         return False
@@ -93,65 +71,7 @@ def require_auth():
 
 def login_page():
     # Inject Custom CSS for Premium Login
-    st.markdown("""
-        <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&family=Outfit:wght@600;700&display=swap');
-        
-        /* Gradient Background */
-        .stApp {
-            background: linear-gradient(135deg, #f8f9fa 0%, #ffffff 100%) !important;
-        }
-
-        /* Center Card Container */
-        .login-card {
-            background: white;
-            padding: 2.5rem;
-            border-radius: 20px;
-            box-shadow: 0 10px 25px rgba(0,0,0,0.05);
-            max-width: 450px;
-            margin: 2rem auto;
-            border: 1px solid #e2e8f0;
-        }
-
-        /* Input Styling */
-        .stTextInput > div > div > input {
-            padding: 12px 16px !important;
-            border-radius: 10px !important;
-            border: 1px solid #cbd5e1 !important;
-            background-color: #f8fafc !important;
-        }
-
-        /* Full Width Buttons */
-        .stButton > button {
-            width: 100% !important;
-            padding: 12px !important;
-            border-radius: 10px !important;
-            background: linear-gradient(135deg, #10b981 0%, #059669 100%) !important;
-            color: white !important;
-            font-weight: 600 !important;
-            border: none !important;
-        }
-
-        /* Branding Text */
-        .brand-title {
-            font-family: 'Outfit', sans-serif;
-            font-size: 1.8rem;
-            font-weight: 700;
-            color: #0f172a;
-            margin-top: 15px;
-            letter-spacing: -1px;
-        }
-        
-        .brand-subtitle {
-            font-size: 0.9rem;
-            color: #10b981;
-            text-transform: uppercase;
-            letter-spacing: 2px;
-            font-weight: 700;
-            margin-bottom: 25px;
-        }
-        </style>
-    """, unsafe_allow_html=True)
+    st.markdown(styles.style_block("login.css"), unsafe_allow_html=True)
 
     # Centering via columns
     empty_col_l, main_col, empty_col_r = st.columns([1, 2, 1])
@@ -183,10 +103,14 @@ def login_page():
                 if user:
                     if isinstance(user, dict) and user.get("status") == "expired":
                         st.error("🚫 Seu acesso expirou. Entre em contato com o administrador.")
+                    elif user.get("status") == "throttled":
+                        st.error("⏳ Muitas tentativas de login. Aguarde alguns instantes e tente novamente.")
+                    elif user.get("status") == "busy":
+                        st.warning("⚠️ Servidor ocupado no momento. Tente novamente em alguns segundos.")
                     elif user['status'] != 'active':
                         st.error("Sua conta ainda não foi aprovada pelo administrador ou está bloqueada.")
                     else:
-                        st.session_state.user = user
+                        start_session(user)
                         st.rerun()
                 else:
                     st.error("E-mail ou senha incorretos.")
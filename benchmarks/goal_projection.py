@@ -0,0 +1,77 @@
+"""Timing of the goal projections (core.projections) on synthetic users.
+
+Each user gets a year and a half of weekly contributions spread over their goal categories and
+one goal per category at a multiple of its current balance. Reports the time of
+monthly_contributions() plus project_goals() per user, as the investments tab runs them.
+
+    python benchmarks/goal_projection.py --users 50 --goals 3
+    python benchmarks/goal_projection.py --goals 7 --paths 2000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+from core import projections
+
+# (category, expected annual yield %, annual volatility %) as in the investments tab
+CATEGORIES = [
+    ("Reserva de Emergência", 10.5, 0.5),
+    ("CDB", 11.2, 0.8),
+    ("Tesouro Direto", 10.8, 1.5),
+    ("Ações", 14.2, 25.0),
+    ("Fundos Imobiliários", 9.5, 15.0),
+    ("Crypto", 45.0, 70.0),
+    ("Outros", 8.0, 5.0),
+]
+
+def synthetic_user(rng, goals, today):
+    """Transactions frame and goals frame of one user."""
+    chosen = CATEGORIES[:goals]
+    dates = pd.date_range(end=today, periods=78, freq='7D')
+    df = pd.DataFrame({
+        'date': dates,
+        'type': 'Investimento',
+        'category': [chosen[i][0] for i in rng.integers(len(chosen), size=len(dates))],
+        'amount': rng.integers(-300, 1500, size=len(dates)).astype(float),
+    })
+    current = rng.uniform(1_000, 20_000, size=len(chosen))
+    goal_frame = pd.DataFrame({
+        'category': [c[0] for c in chosen],
+        'current': current,
+        'target': current * rng.uniform(2, 10, size=len(chosen)),
+    })
+    return df, goal_frame
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--goals", type=int, default=3, choices=range(1, len(CATEGORIES) + 1))
+    parser.add_argument("--paths", type=int, default=projections.PROJECTION_PATHS)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    today = pd.Timestamp.today().normalize()
+    assumptions = {name: (perf, vol) for name, perf, vol in CATEGORIES}
+
+    timings = []
+    for user_id in range(args.users):
+        df, goals = synthetic_user(rng, args.goals, today)
+        start = time.perf_counter()
+        history = projections.monthly_contributions(df, today)
+        projections.project_goals(goals, history, assumptions, today, paths=args.paths, seed=user_id)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(f"{args.users} users, {args.goals} goals, {args.paths} paths per goal")
+    print(f"  median  {statistics.median(timings):7.1f} ms")
+    print(f"  p95     {timings[int(0.95 * (len(timings) - 1))]:7.1f} ms")
+    print(f"  max     {timings[-1]:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Credential-stuffing simulation for the login path.
+
+Compares the CPU burned by bcrypt when every attempt is verified inline on the
+request thread (previous behaviour) with the throttled, pool-bounded
+verification in auth. The attack is spread over many e-mails and client
+addresses, the worst case for the rate limiter, so the bound comes from the
+bcrypt pool.
+
+    python benchmarks/login_attack.py --attackers 32 --seconds 10
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt
+from core import auth
+
+PASSWORD = "correct horse battery staple"
+
+
+def run_attack(attempt, attackers, seconds):
+    """Runs `attackers` threads calling attempt() until time runs out; returns (outcomes, cores used)."""
+    outcomes = {}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def attacker(n):
+        i = 0
+        while time.monotonic() < deadline:
+            outcome = attempt(n, i)
+            i += 1
+            with lock:
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=attacker, args=(n,)) for n in range(attackers)]
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cores = (time.process_time() - cpu_start) / (time.perf_counter() - wall_start)
+    return outcomes, cores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--attackers", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    hashed = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+
+    def inline(n, i):
+        auth.verify_password("wrong-password", hashed)
+        return "verified"
+
+    def bounded(n, i):
+        if not auth.login_allowed(f"victim{i}@example.com", f"10.{n}.{i // 250 % 250}.{i % 250}"):
+            return "throttled"
+        result = auth.verify_password_bounded("wrong-password", hashed)
+        return "busy" if result is None else "verified"
+
+    print(f"{args.attackers} attackers, {args.seconds:.0f}s each, {os.cpu_count()} CPUs, "
+          f"bcrypt pool of {auth.BCRYPT_WORKERS} (+{auth.BCRYPT_QUEUE_LIMIT} queued)\n")
+    for name, attempt in (("inline", inline), ("bounded", bounded)):
+        outcomes, cores = run_attack(attempt, args.attackers, args.seconds)
+        summary = ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items()))
+        print(f"{name:8s} cores busy: {cores:5.2f}   {summary}")
+
+    print(f"\nExpected: 'bounded' stays near {auth.BCRYPT_WORKERS} cores, the rest are fast rejections.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Import-time breakdown of FinanFlow's cold start.
+
+Reads the module-level imports of main.py (what every cold start and the
+login page pay for) and the imports done lazily inside functions (paid by the
+first render of the tab that needs them), then measures each group in a fresh
+interpreter with `python -X importtime`. `from core import a, b` is reported per
+submodule (core.a, core.b). A module that fails to import is listed and the
+report exits 1, since a failed import would otherwise look cheap.
+
+    python benchmarks/startup_report.py                # report
+    python benchmarks/startup_report.py --budget-ms 900 # exit 1 when eager imports exceed the budget
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def is_local_module(name):
+    """True when a dotted name is a module or package of this repository."""
+    path = os.path.join(ROOT, *name.split("."))
+    return os.path.isfile(path + ".py") or os.path.isdir(path)
+
+
+def collect_imports(path):
+    """Returns (eager, lazy) module names imported by a file at module level and inside functions."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    def names(node):
+        if isinstance(node, ast.Import):
+            return [alias.name for alias in node.names]
+        if isinstance(node, ast.ImportFrom) and node.level == 0:
+            # Our own submodules are charged separately; names from third-party packages to the package
+            return list(dict.fromkeys(f"{node.module}.{alias.name}" if is_local_module(f"{node.module}.{alias.name}")
+                                      else node.module for alias in node.names))
+        return []
+
+    eager = [name for node in tree.body for name in names(node)]
+    lazy = [name for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+            for child in ast.walk(node) for name in names(child)]
+    return list(dict.fromkeys(eager)), [m for m in dict.fromkeys(lazy) if m not in eager]
+
+
+def measure(modules):
+    """Imports modules in a fresh interpreter; returns ({top-level module: cumulative ms}, {module: error})."""
+    # __import__ rather than importlib.import_module: only the former is timed as a top-level import
+    code = (
+        f"for name in {modules!r}:\n"
+        "    try:\n"
+        "        __import__(name)\n"
+        "    except BaseException as e:\n"
+        "        print(f'{name}\\t{type(e).__name__}: {e}'.replace('\\n', ' '))\n"
+    )
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(f"Import timing run failed:\n{proc.stderr[-2000:]}")
+    failures = dict(line.split("\t", 1) for line in proc.stdout.splitlines() if "\t" in line)
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented; only the outermost ones add up to the total
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        timings[name.strip()] = timings.get(name.strip(), 0) + int(cumulative) / 1000
+    # A failed import stops early and would look cheap; it is reported instead of timed
+    return {k: v for k, v in timings.items() if k not in failures}, failures
+
+
+def print_table(title, timings, limit):
+    total = sum(timings.values())
+    print(f"{title}: {total:8.1f} ms")
+    for name, ms in sorted(timings.items(), key=lambda kv: kv[1], reverse=True)[:limit]:
+        print(f"    {ms:8.1f} ms  {name}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, help="fail when the eager imports take longer than this")
+    parser.add_argument("--top", type=int, default=15, help="modules listed per group")
+    args = parser.parse_args()
+
+    eager, lazy = collect_imports(os.path.join(ROOT, "main.py"))
+    # Chart builders (charts.py) import plotly on first build, the FinanBot client (core/chat.py) the Gemini SDK
+    for helper in ("charts.py", os.path.join("core", "chat.py")):
+        lazy += [m for m in collect_imports(os.path.join(ROOT, helper))[1] if m not in lazy and m not in eager]
+    # Modules the bare interpreter loads anyway (site, encodings, ...) are not ours
+    baseline, _ = measure([])
+    eager_timings, failures = measure(eager)
+    eager_timings = {k: v for k, v in eager_timings.items() if k not in baseline}
+    eager_total = print_table("Cold start (module-level imports of main.py)", eager_timings, args.top)
+    print()
+    # Measured after the eager set so shared dependencies are not counted twice
+    lazy_timings, lazy_failures = measure(eager + lazy)
+    lazy_timings = {k: v for k, v in lazy_timings.items() if k not in eager_timings and k not in baseline}
+    print_table("Deferred to first use (function-level imports)", lazy_timings, args.top)
+
+    failed = False
+    if failures or lazy_failures:
+        print("\nFAIL: these imports raised and are missing from the timings above:")
+        for name, error in {**lazy_failures, **failures}.items():
+            print(f"    {name}: {error}")
+        failed = True
+    if args.budget_ms is not None and eager_total > args.budget_ms:
+        print(f"\nFAIL: cold-start imports took {eager_total:.1f} ms (budget {args.budget_ms:.1f} ms)")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
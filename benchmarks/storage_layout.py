@@ -0,0 +1,179 @@
+"""Storage benchmark: text layout vs compact layout of the transactions table.
+
+Builds both layouts side by side in a scratch schema with the same synthetic
+rows: the previous one (type and category as TEXT, amount as DECIMAL(15,2))
+and the current one (transaction_type enum, per-user smallint category id,
+BIGINT cents). Reports table and index sizes and the timing of the aggregates
+the app runs most. The scratch schema is dropped at the end.
+
+    python benchmarks/storage_layout.py --rows 1000000 --users 2000
+    python benchmarks/storage_layout.py --dsn postgresql://localhost/finanflow_bench
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import database as db
+
+SCHEMA = "bench_storage_layout"
+CATEGORIES = {
+    "Entrada": ["Salário", "Freelance", "Reembolso", "Presente"],
+    "Saída": ["Alimentação", "Transporte", "Moradia", "Lazer", "Saúde", "Educação", "Assinaturas", "Mercado"],
+    "Investimento": ["Reserva de Emergência", "Ações", "Fundos Imobiliários", "CDB", "Tesouro Direto", "Crypto"],
+}
+
+# (label, text-layout query, compact-layout query); %(user_ids)s is a sample of users, %(start)s/%(end)s one month
+QUERIES = [
+    ("resumo mensal (1 usuário)",
+     "SELECT type, SUM(amount) FROM text_rows WHERE user_id = ANY(%(user_ids)s) AND date >= %(start)s AND date < %(end)s GROUP BY type",
+     "SELECT type, SUM(amount_cents) FROM compact_rows WHERE user_id = ANY(%(user_ids)s) AND date >= %(start)s AND date < %(end)s GROUP BY type"),
+    ("carteira por categoria",
+     "SELECT category, SUM(amount) FROM text_rows WHERE user_id = ANY(%(user_ids)s) AND type = 'Investimento' GROUP BY category",
+     "SELECT k.name, s.total FROM (SELECT user_id, category_id, SUM(amount_cents) AS total FROM compact_rows "
+     "WHERE user_id = ANY(%(user_ids)s) AND type = 'Investimento' GROUP BY 1, 2) s "
+     "JOIN categories k ON k.user_id = s.user_id AND k.id = s.category_id"),
+    ("totais por tipo (tabela inteira)",
+     "SELECT type, SUM(amount) FROM text_rows WHERE type <> 'Entrada' GROUP BY type",
+     "SELECT type, SUM(amount_cents) FROM compact_rows WHERE type <> 'Entrada' GROUP BY type"),
+    ("gastos por categoria (tabela inteira)",
+     "SELECT category, SUM(amount) FROM text_rows WHERE type = 'Saída' GROUP BY category",
+     "SELECT category_id, SUM(amount_cents) FROM compact_rows WHERE type = 'Saída' GROUP BY category_id"),
+]
+
+
+def build(c, rows, users):
+    """Creates both layouts with identical synthetic rows."""
+    c.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    c.execute(f"CREATE SCHEMA {SCHEMA}")
+    c.execute(f"SET search_path TO {SCHEMA}")
+    c.execute("CREATE TYPE transaction_type AS ENUM ('Entrada', 'Saída', 'Investimento')")
+
+    names = [(t, n) for t, ns in CATEGORIES.items() for n in ns]
+    c.execute("CREATE TABLE names (n SMALLINT PRIMARY KEY, type TEXT NOT NULL, name TEXT NOT NULL)")
+    c.executemany("INSERT INTO names VALUES (%s, %s, %s)", [(i + 1, t, n) for i, (t, n) in enumerate(names)])
+
+    c.execute('''
+        CREATE TABLE text_rows (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            amount DECIMAL(15,2) NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        INSERT INTO text_rows (user_id, date, type, category, amount, description)
+        SELECT 1 + (g %% %(users)s), DATE '2022-01-01' + (g %% 1096), n.type, n.name,
+               round((random() * 2000)::numeric, 2), NULL
+        FROM generate_series(1, %(rows)s) g
+        JOIN names n ON n.n = 1 + (g / 7) %% %(names)s
+    ''', {"users": users, "rows": rows, "names": len(names)})
+    c.execute("CREATE INDEX ON text_rows (user_id, date)")
+
+    c.execute('''
+        CREATE TABLE categories (
+            user_id INTEGER NOT NULL,
+            id SMALLINT NOT NULL,
+            type transaction_type NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (user_id, id)
+        )
+    ''')
+    c.execute('''
+        INSERT INTO categories (user_id, id, type, name)
+        SELECT DISTINCT t.user_id, n.n, t.type::transaction_type, t.category
+        FROM text_rows t JOIN names n ON n.type = t.type AND n.name = t.category
+    ''')
+    c.execute('''
+        CREATE TABLE compact_rows (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            type transaction_type NOT NULL,
+            category_id SMALLINT NOT NULL,
+            amount_cents BIGINT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        INSERT INTO compact_rows (id, user_id, date, type, category_id, amount_cents, description, created_at)
+        SELECT t.id, t.user_id, t.date, t.type::transaction_type, n.n, ROUND(t.amount * 100), t.description, t.created_at
+        FROM text_rows t JOIN names n ON n.type = t.type AND n.name = t.category
+    ''')
+    c.execute("CREATE INDEX ON compact_rows (user_id, date)")
+    c.execute("VACUUM ANALYZE text_rows")
+    c.execute("VACUUM ANALYZE compact_rows")
+    c.execute("VACUUM ANALYZE categories")
+
+
+def sizes(c, table):
+    """Returns (table MB, index MB, average row bytes)."""
+    c.execute(
+        "SELECT pg_table_size(%s), pg_indexes_size(%s), (SELECT AVG(pg_column_size(r.*)) FROM " + table + " r)",
+        (table, table)
+    )
+    table_bytes, index_bytes, row_bytes = c.fetchone()
+    return table_bytes / 2 ** 20, index_bytes / 2 ** 20, float(row_bytes)
+
+
+def timed(c, query, params, repeat):
+    """Median wall time of a query in milliseconds (one untimed warm-up run)."""
+    c.execute(query, params)
+    c.fetchall()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        c.execute(query, params)
+        c.fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", help="database to use (default: DATABASE_URL from the app secrets or the environment)")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=7, help="timed runs per query (median reported)")
+    parser.add_argument("--keep", action="store_true", help=f"keep the {SCHEMA} schema for inspection")
+    args = parser.parse_args()
+
+    dsn = args.dsn or db.get_secret("DATABASE_URL") or os.environ.get("DATABASE_URL")
+    if not dsn:
+        parser.error("no database: pass --dsn or set DATABASE_URL")
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True  # VACUUM cannot run inside a transaction
+    c = conn.cursor()
+    try:
+        print(f"Building {args.rows:,} rows for {args.users:,} users in both layouts...")
+        build(c, args.rows, args.users)
+
+        print(f"\n{'':34s}{'tabela MB':>12s}{'índices MB':>12s}{'bytes/linha':>13s}")
+        for label, table in (("texto + DECIMAL", "text_rows"), ("enum + id + centavos", "compact_rows")):
+            table_mb, index_mb, row_bytes = sizes(c, table)
+            print(f"{label:34s}{table_mb:12.1f}{index_mb:12.1f}{row_bytes:13.1f}")
+
+        params = {"user_ids": [1], "start": "2023-06-01", "end": "2023-07-01"}
+        print(f"\n{'consulta (mediana de ' + str(args.repeat) + ')':40s}{'texto ms':>10s}{'compacto ms':>13s}{'ganho':>8s}")
+        for label, text_query, compact_query in QUERIES:
+            before = timed(c, text_query, params, args.repeat)
+            after = timed(c, compact_query, params, args.repeat)
+            print(f"{label:40s}{before:10.2f}{after:13.2f}{before / after:7.1f}x")
+    finally:
+        if not args.keep:
+            c.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
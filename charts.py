@@ -0,0 +1,158 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# Serialized figures kept per process; the inputs are small aggregates, so a few dozen specs are cheap to hold
+FIGURE_CACHE_SIZE = 64
+
+_specs = OrderedDict()
+_specs_lock = threading.Lock()
+
+def fingerprint(df, **options):
+    """Content hash of an aggregated frame plus the chart options."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((list(df.columns), sorted(options.items()))).encode())
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+def cached_figure(kind, df, build, **options):
+    """Returns build(df, **options), reusing the spec serialized for the same data and options (LRU).
+
+    The cache holds the figure's JSON, shared by every session of the process. Each call gets
+    its own figure loaded from it without plotly's validation (the spec came out of a validated
+    figure), so a caller changing its figure does not change anyone else's. st.plotly_chart
+    still serializes the figure it is given: Streamlit cannot be handed the cached JSON.
+    """
+    import plotly.graph_objects as go
+    import plotly.io as pio
+
+    key = (kind, fingerprint(df, **options))
+    with _specs_lock:
+        spec = _specs.get(key)
+        if spec is not None:
+            _specs.move_to_end(key)
+
+    if spec is None:
+        spec = pio.to_json(build(df, **options), validate=False)
+        with _specs_lock:
+            _specs[key] = spec
+            _specs.move_to_end(key)
+            while len(_specs) > FIGURE_CACHE_SIZE:
+                _specs.popitem(last=False)
+    return go.Figure(json.loads(spec), _validate=False)
+
+def figure_cache_info():
+    """Number of figures currently cached and the cache bound."""
+    with _specs_lock:
+        return len(_specs), FIGURE_CACHE_SIZE
+
+def clear_figure_cache():
+    """Drops every cached figure."""
+    with _specs_lock:
+        _specs.clear()
+
+# --- Builders (plotly is imported on first build, not at app start) ---
+
+def _build_cashflow(table):
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=table.index, y=table['Entrada'], name='Receita', marker_color='#10b981'))
+    fig.add_trace(go.Bar(x=table.index, y=table['Saída'], name='Despesa', marker_color='#ef4444'))
+    fig.add_trace(go.Scatter(x=table.index, y=table['Saldo Acumulado'], name='Saldo Acum.',
+                             line=dict(color='#3b82f6', width=3), yaxis='y2'))
+    fig.update_layout(
+        yaxis=dict(title="Valores (R$)"),
+        yaxis2=dict(title="Acumulado (R$)", overlaying='y', side='right'),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        margin=dict(l=0, r=0, t=30, b=0),
+        hovermode="x unified",
+        height=400,
+        template="plotly_white"
+    )
+    return fig
+
+def _build_expense_donut(expenses, total):
+    import plotly.express as px
+
+    fig = px.pie(expenses, values='amount', names='category', hole=0.6,
+                 color_discrete_sequence=px.colors.sequential.RdBu)
+    fig.update_layout(
+        showlegend=True,
+        margin=dict(l=0, r=0, t=0, b=0),
+        height=350,
+        annotations=[dict(text=f'Total Gastos<br>R$ {total:,.2f}', x=0.5, y=0.5, font_size=12, showarrow=False)]
+    )
+    return fig
+
+def _build_composition_pie(portfolio):
+    import plotly.express as px
+
+    return px.pie(portfolio, values='total', names='category', hole=0.4)
+
+def _build_evolution_line(evolution):
+    import plotly.express as px
+
+    return px.line(evolution, x='month', y='cumulative_total', markers=True)
+
+def _build_sparkline(series, color):
+    import plotly.express as px
+
+    fig = px.line(series, x=series.index, y=series.columns[0], color_discrete_sequence=[color])
+    fig.update_layout(
+        margin=dict(l=0, r=0, t=0, b=0),
+        height=40,
+        xaxis_visible=False,
+        yaxis_visible=False,
+        showlegend=False,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
+        hovermode=False
+    )
+    return fig
+
+def _build_goal_projection(bands, target):
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=bands.index, y=bands['p90'], line=dict(width=0), showlegend=False, hoverinfo='skip'))
+    fig.add_trace(go.Scatter(x=bands.index, y=bands['p10'], fill='tonexty', fillcolor='rgba(59, 130, 246, 0.2)',
+                             line=dict(width=0), name='10%–90% dos cenários'))
+    fig.add_trace(go.Scatter(x=bands.index, y=bands['p50'], name='Cenário mediano', line=dict(color='#3b82f6', width=3)))
+    fig.add_hline(y=target, line_dash='dash', line_color='#10b981', annotation_text=f'Meta R$ {target:,.0f}')
+    fig.update_layout(
+        yaxis=dict(title="Saldo projetado (R$)"),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        margin=dict(l=0, r=0, t=30, b=0),
+        hovermode="x unified",
+        height=350,
+        template="plotly_white"
+    )
+    return fig
+
+def cashflow_chart(table):
+    """Bars of income/expense per bucket plus the running balance line (table from core.aggregations.cashflow_series)."""
+    return cached_figure("cashflow", table[['Entrada', 'Saída', 'Saldo Acumulado']], _build_cashflow)
+
+def expense_donut(expenses, total):
+    """Expenses per category donut with the period total in the hole."""
+    return cached_figure("expense_donut", expenses[['category', 'amount']], _build_expense_donut, total=float(total))
+
+def composition_pie(portfolio):
+    """Portfolio composition by category."""
+    return cached_figure("composition_pie", portfolio[['category', 'total']], _build_composition_pie)
+
+def evolution_line(evolution):
+    """Cumulative invested amount per month."""
+    return cached_figure("evolution_line", evolution[['month', 'cumulative_total']], _build_evolution_line)
+
+def sparkline(series, color):
+    """Axis-less inline line for KPI cards."""
+    return cached_figure("sparkline", series, _build_sparkline, color=color)
+
+def goal_projection(bands, target):
+    """Projected balance of a goal: median path, 10%-90% band and the target line (bands from core.projections)."""
+    return cached_figure("goal_projection", bands[['p10', 'p50', 'p90']], _build_goal_projection, target=float(target))
@@ -0,0 +1,5 @@
+"""FinanFlow core: configuration, data access, aggregations and authentication without any UI dependency.
+
+The Streamlit app (main.py, auth.py, database.py) is a presentation layer over this package; workers,
+batch jobs, benchmarks and other front ends import it directly after calling config.configure().
+"""
@@ -0,0 +1,62 @@
+import pandas as pd
+
+TRANSACTION_TYPES = ["Entrada", "Saída", "Investimento"]
+MAX_CHART_POINTS = 120
+
+# From finest to coarsest: (pandas period frequency, label shown under the chart)
+GRANULARITIES = [("D", "dia"), ("W", "semana"), ("M", "mês"), ("Q", "trimestre"), ("Y", "ano")]
+
+def choose_granularity(start, end, max_points=MAX_CHART_POINTS):
+    """Picks the bucket size for a date range: day up to ~2 months, week up to a year, then month,
+    coarsening further while the range would need more than max_points buckets."""
+    span_days = (end - start).days + 1
+    first = 0 if span_days <= 62 else 1 if span_days <= 366 else 2
+    for freq, label in GRANULARITIES[first:]:
+        if len(pd.period_range(start, end, freq=freq)) <= max_points:
+            return freq, label
+    return GRANULARITIES[-1]
+
+def cashflow_series(df, start=None, end=None, max_points=MAX_CHART_POINTS):
+    """Buckets transactions by real date and computes the running balance in one vectorized pass.
+
+    Gaps are filled with zeros over [start, end] (defaults to the data's own range). Returns
+    (DataFrame indexed by bucket start date with one column per type plus 'Saldo' and
+    'Saldo Acumulado', granularity label).
+    """
+    dates = pd.to_datetime(df['date'])
+    start = pd.Timestamp(start) if start is not None else dates.min()
+    end = pd.Timestamp(end) if end is not None else dates.max()
+    if pd.isna(start) or pd.isna(end):
+        return pd.DataFrame(columns=TRANSACTION_TYPES + ['Saldo', 'Saldo Acumulado']), GRANULARITIES[0][1]
+
+    freq, label = choose_granularity(start, end, max_points)
+    buckets = pd.DataFrame({
+        'period': dates.dt.to_period(freq),
+        'type': df['type'],
+        'amount': df['amount'].astype(float),
+    })
+    table = buckets.pivot_table(index='period', columns='type', values='amount', aggfunc='sum')
+    table = table.reindex(columns=TRANSACTION_TYPES).reindex(pd.period_range(start, end, freq=freq)).fillna(0.0)
+
+    table['Saldo'] = table['Entrada'] - table['Saída'] - table['Investimento']
+    table['Saldo Acumulado'] = table['Saldo'].cumsum()
+    table.index = table.index.to_timestamp()
+    return table, label
+
+def period_totals(df):
+    """Returns (income, expense, investment, balance) of a transactions frame."""
+    if df.empty: return 0.0, 0.0, 0.0, 0.0
+    totals = df.groupby('type')['amount'].sum()
+    income, expense, invest = (float(totals.get(t, 0.0)) for t in TRANSACTION_TYPES)
+    return income, expense, invest, income - expense - invest
+
+def pct_change(cur, pre):
+    """Percentage variation against the previous value (0 when there is nothing to compare to)."""
+    if pre == 0: return 0.0
+    return ((cur - pre) / pre) * 100
+
+def investment_flows(df):
+    """Returns (contributions, redemptions) of a transactions frame; redemptions are negative investments."""
+    if df.empty: return 0.0, 0.0
+    amounts = df.loc[df['type'] == 'Investimento', 'amount'].astype(float)
+    return float(amounts[amounts > 0].sum()), float(abs(amounts[amounts < 0].sum()))
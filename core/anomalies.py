@@ -0,0 +1,168 @@
+"""Spending anomalies over the monthly and daily expense aggregates.
+
+Three kinds, all computed on whole frames (any number of users) without per-row Python:
+
+- 'pico': a category's month far above its own baseline (median and interquartile range of the
+  ANOMALY_BASELINE_MONTHS before it, counting only months since the category first appeared);
+- 'recorrente': a new charge that repeats, i.e. the last RECURRING_MONTHS months of a category all
+  above its usual range by a similar amount (a new category counts from a baseline of zero);
+- 'dia': a day of the month whose total is far above the user's typical spending day over the
+  DAY_BASELINE_DAYS before the month.
+
+Input frames come from repository.get_expense_history(_for_users).
+"""
+import numpy as np
+import pandas as pd
+
+ANOMALY_BASELINE_MONTHS = 12   # months before the evaluated one forming each baseline
+BASELINE_MIN_MONTHS = 3        # a category needs this many baseline months to be judged
+SPIKE_SCORE = 3.0              # distance above the median, in interquartile ranges, to flag a month
+SPIKE_MIN_RATIO = 1.5          # ... and at least this multiple of the median
+MIN_SPREAD_SHARE = 0.1         # the range used is at least this share of the median (steady categories)
+MIN_EXCESS = 50.0              # R$ above the baseline below which no spike or day is flagged
+RECURRING_MONTHS = 2           # consecutive months a new charge must repeat in
+RECURRING_SCORE = 2.0          # each of them above the median by this many interquartile ranges
+RECURRING_MIN_AMOUNT = 20.0    # R$ of the smallest new charge reported (a subscription)
+RECURRING_MAX_GAP = 0.25       # relative difference allowed between those months' excesses
+DAY_BASELINE_DAYS = 90         # days before the month forming the typical spending day
+DAY_MIN_DAYS = 10              # spending days needed in the window before judging a day
+DAY_SCORE = 4.0
+DAY_MIN_RATIO = 3.0
+
+COLUMNS = ['user_id', 'kind', 'category', 'period', 'amount', 'baseline', 'score']
+
+def _quartiles(values):
+    """Row-wise 25th, 50th and 75th percentiles ignoring NaN (rows without data give NaN).
+
+    Same linear interpolation as np.nanpercentile, on one sort of the whole matrix instead of a
+    Python call per row.
+    """
+    ordered = np.sort(values, axis=1)  # NaN last
+    counts = np.sum(~np.isnan(values), axis=1)
+    result = []
+    for q in (0.25, 0.5, 0.75):
+        position = np.maximum(counts - 1, 0) * q
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, np.maximum(counts - 1, 0))
+        a = np.take_along_axis(ordered, low[:, None], axis=1)[:, 0]
+        b = np.take_along_axis(ordered, high[:, None], axis=1)[:, 0]
+        result.append(np.where(counts > 0, a + (b - a) * (position - low), np.nan))
+    return result
+
+def _spread(q25, q50, q75):
+    return np.maximum(q75 - q25, MIN_SPREAD_SHARE * np.abs(q50))
+
+def _monthly_anomalies(monthly, month):
+    """'pico' and 'recorrente' rows for `month` (a Timestamp at the month start)."""
+    months = pd.date_range(end=month, periods=ANOMALY_BASELINE_MONTHS + 1, freq='MS')
+    grid = monthly.pivot_table(index=['user_id', 'category'], columns='month', values='total', aggfunc='sum')
+    grid = grid.reindex(columns=months)
+    if grid.empty:
+        return pd.DataFrame(columns=COLUMNS)
+
+    values = grid.to_numpy(dtype=float)
+    seen = ~np.isnan(values)
+    spent = np.nan_to_num(values)
+
+    # Months since the category's first expense (0 after that), NaN before it
+    appeared = np.maximum.accumulate(seen, axis=1)
+    since_first = np.where(appeared, spent, np.nan)
+
+    # Months since the user's first expense in any category: a new category's baseline is zero there
+    user_codes = grid.index.codes[0]
+    user_started = np.zeros((user_codes.max() + 1, len(months)), dtype=bool)
+    np.logical_or.at(user_started, user_codes, appeared)
+    since_user = np.where(user_started[user_codes], spent, np.nan)
+
+    current = spent[:, -1]
+    users = grid.index.get_level_values('user_id').to_numpy()
+    categories = grid.index.get_level_values('category').to_numpy()
+    found = []
+
+    # Spikes: the month against the category's own history
+    base = since_first[:, :-1]
+    q25, q50, q75 = _quartiles(base)
+    spread = _spread(q25, q50, q75)
+    score = (current - q50) / np.where(spread > 0, spread, np.nan)
+    spike = (
+        (np.sum(~np.isnan(base), axis=1) >= BASELINE_MIN_MONTHS)
+        & (score >= SPIKE_SCORE)
+        & (current >= SPIKE_MIN_RATIO * q50)
+        & (current - q50 >= MIN_EXCESS)
+    )
+
+    # Recurring: the last RECURRING_MONTHS all above the usual range by about the same amount
+    k = RECURRING_MONTHS
+    before = since_user[:, :-k]
+    r25, r50, r75 = _quartiles(before)
+    excess = spent[:, -k:] - r50[:, None]
+    recurring_score = excess.min(axis=1) / np.maximum(_spread(r25, r50, r75), RECURRING_MIN_AMOUNT)
+    recurring = (
+        (np.sum(~np.isnan(before), axis=1) >= BASELINE_MIN_MONTHS)
+        & np.all(spent[:, -k:] > r75[:, None], axis=1)
+        & (excess.min(axis=1) >= np.maximum(RECURRING_SCORE * _spread(r25, r50, r75), RECURRING_MIN_AMOUNT))
+        & (excess.max(axis=1) - excess.min(axis=1) <= RECURRING_MAX_GAP * excess.max(axis=1))
+    )
+    # A repeated rise is reported as recurring, not also as a spike
+    spike &= ~recurring
+
+    for kind, mask, baseline, scores in (
+        ('pico', spike, q50, score),
+        ('recorrente', recurring, r50, recurring_score),
+    ):
+        found.append(pd.DataFrame({
+            'user_id': users[mask],
+            'kind': kind,
+            'category': categories[mask],
+            'period': month,
+            'amount': current[mask],
+            'baseline': np.nan_to_num(baseline[mask]),
+            'score': scores[mask],
+        }))
+    return pd.concat(found, ignore_index=True)
+
+def _daily_anomalies(daily, month):
+    """'dia' rows for the days of `month`, against each user's spending days in the window before it."""
+    in_month = daily['date'] >= month
+    base = daily[~in_month & (daily['date'] >= month - pd.Timedelta(days=DAY_BASELINE_DAYS))]
+    days = daily[in_month]
+    if base.empty or days.empty:
+        return pd.DataFrame(columns=COLUMNS)
+
+    grouped = base.groupby('user_id')['total']
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats = stats[grouped.size() >= DAY_MIN_DAYS].reindex(days['user_id'])
+    q25, q50, q75 = (stats[q].to_numpy() for q in (0.25, 0.5, 0.75))
+    total = days['total'].to_numpy()
+    spread = _spread(q25, q50, q75)
+    score = (total - q50) / np.where(spread > 0, spread, np.nan)
+    flagged = (score >= DAY_SCORE) & (total >= DAY_MIN_RATIO * q50) & (total - q50 >= MIN_EXCESS)
+    return pd.DataFrame({
+        'user_id': days['user_id'].to_numpy()[flagged],
+        'kind': 'dia',
+        'category': '',
+        'period': days['date'].to_numpy()[flagged],
+        'amount': total[flagged],
+        'baseline': q50[flagged],
+        'score': score[flagged],
+    })
+
+def detect(monthly, daily, month):
+    """Anomalies of `month` for every user in the frames, strongest first.
+
+    monthly: user_id, month, category, total; daily: user_id, date, total (month and date as
+    datetimes; totals may be Decimal). Returns a DataFrame with user_id, kind ('pico', 'recorrente' or 'dia'),
+    category ('' for days), period (month start or day), amount, baseline and score (distance
+    from the baseline in interquartile ranges).
+    """
+    month = pd.Timestamp(month).to_period('M').to_timestamp()
+    frames = []
+    if not monthly.empty:
+        frames.append(_monthly_anomalies(monthly.astype({'total': float}), month))
+    if not daily.empty:
+        frames.append(_daily_anomalies(daily.astype({'total': float}), month))
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=COLUMNS)
+    found = pd.concat(frames, ignore_index=True)
+    return found.sort_values(['user_id', 'score'], ascending=[True, False], ignore_index=True)
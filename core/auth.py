@@ -0,0 +1,248 @@
+import bcrypt
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from core import config, repository as repo
+from core.errors import FinanFlowError, report_error
+
+# Signed session tokens
+SESSION_TOKEN_TTL = 7 * 24 * 3600      # seconds a token stays valid (SESSION_TOKEN_TTL setting)
+SESSION_RECHECK_SECONDS = 900          # status/expiry re-checked in the DB at most this often
+SESSION_DENYLIST_TTL = 60              # seconds the revoked-token list is cached
+
+# Login throttling: token buckets checked before any bcrypt work
+LOGIN_EMAIL_BURST = 5                  # attempts per e-mail before throttling
+LOGIN_EMAIL_REFILL_SECONDS = 30        # one attempt regained every N seconds
+LOGIN_CLIENT_BURST = 20                # attempts per client (IP) before throttling
+LOGIN_CLIENT_REFILL_SECONDS = 3
+TRUSTED_PROXY_HOPS = 0                 # reverse proxies in front of the app (TRUSTED_PROXY_HOPS setting)
+
+# bcrypt runs on a small pool; beyond the queue limit logins are rejected immediately
+BCRYPT_WORKERS = 2
+BCRYPT_QUEUE_LIMIT = 8
+BCRYPT_TIMEOUT_SECONDS = 10
+
+# Tokens signed with this fallback only survive until the process restarts
+_fallback_secret = secrets.token_bytes(32)
+_denylist_cache = {"jtis": set(), "fetched_at": 0.0}
+
+def hash_password(password):
+    """Hashes a password using bcrypt."""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def verify_password(password, hashed):
+    """Verifies a password against a hash."""
+    try:
+        # Ensure hashed is bytes
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        return bcrypt.checkpw(password.encode('utf-8'), hashed)
+    except Exception:
+        return False
+
+class TokenBucketLimiter:
+    """In-memory token buckets per key. allow() is O(1) and never touches the database."""
+
+    def __init__(self, burst, refill_seconds, max_keys=50000):
+        self.capacity = float(burst)
+        self.refill_rate = 1.0 / refill_seconds
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.refill_rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            # Least recently used keys are forgotten first, which only ever lets them retry sooner
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+_email_limiter = TokenBucketLimiter(LOGIN_EMAIL_BURST, LOGIN_EMAIL_REFILL_SECONDS)
+_client_limiter = TokenBucketLimiter(LOGIN_CLIENT_BURST, LOGIN_CLIENT_REFILL_SECONDS)
+_bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+_bcrypt_slots = threading.BoundedSemaphore(BCRYPT_WORKERS + BCRYPT_QUEUE_LIMIT)
+
+def client_address(forwarded_for, peer):
+    """Client address for the login throttle, or None when it cannot be told.
+
+    X-Forwarded-For entries are only believed as far as TRUSTED_PROXY_HOPS proxies appended
+    them: the client is the entry that many places from the right. The leftmost entries are
+    whatever the client sent, so without trusted proxies the socket peer is used.
+    """
+    hops = int(config.get_setting("TRUSTED_PROXY_HOPS", TRUSTED_PROXY_HOPS))
+    if hops > 0 and forwarded_for:
+        entries = [e.strip() for e in forwarded_for.split(",") if e.strip()]
+        if len(entries) >= hops:
+            return entries[-hops]
+    return peer or None
+
+def login_allowed(email, client_id):
+    """Consumes one login attempt for the e-mail and the client; False means throttled."""
+    return _email_limiter.allow((email or "").strip().lower()) and _client_limiter.allow(client_id)
+
+def verify_password_bounded(password, hashed):
+    """Verifies a password on the bcrypt pool. Returns None when the pool is saturated."""
+    if not _bcrypt_slots.acquire(blocking=False):
+        return None
+    try:
+        future = _bcrypt_pool.submit(verify_password, password, hashed)
+    except Exception:
+        _bcrypt_slots.release()
+        raise
+    future.add_done_callback(lambda _: _bcrypt_slots.release())
+    try:
+        return future.result(timeout=BCRYPT_TIMEOUT_SECONDS)
+    except FutureTimeout:
+        return None
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(body):
+    secret = config.get_setting("SESSION_SECRET")
+    key = secret.encode('utf-8') if secret else _fallback_secret
+    return _b64encode(hmac.new(key, body.encode('ascii'), hashlib.sha256).digest())
+
+def issue_session_token(user, jti=None, expires_at=None):
+    """Returns a signed token carrying the user, its expiry and the time of the last DB check."""
+    now = int(time.time())
+    payload = {
+        "uid": int(user["id"]),
+        "email": user["email"],
+        "role": user["role"],
+        "status": user["status"],
+        "exp": expires_at or now + int(config.get_setting("SESSION_TOKEN_TTL", SESSION_TOKEN_TTL)),
+        "chk": now,
+        "jti": jti or secrets.token_urlsafe(12),
+    }
+    body = _b64encode(json.dumps(payload, separators=(",", ":")).encode('utf-8'))
+    return f"{body}.{_sign(body)}"
+
+def verify_session_token(token):
+    """Returns the payload of a correctly signed, unexpired token, None otherwise. No DB access."""
+    try:
+        body, signature = token.split(".", 1)
+        if not hmac.compare_digest(signature, _sign(body)):
+            return None
+        payload = json.loads(_b64decode(body))
+    except Exception:
+        return None
+    if payload.get("exp", 0) < time.time():
+        return None
+    return payload
+
+def _revoked_jtis():
+    """Returns the cached denylist, refreshed every SESSION_DENYLIST_TTL seconds."""
+    if time.time() - _denylist_cache["fetched_at"] > SESSION_DENYLIST_TTL:
+        _denylist_cache["jtis"] = repo.get_revoked_sessions()
+        _denylist_cache["fetched_at"] = time.time()
+    return _denylist_cache["jtis"]
+
+def revoke_session_token(payload):
+    """Revokes a token everywhere (denylist) and immediately in this process."""
+    try:
+        repo.revoke_session(payload["jti"], datetime.datetime.fromtimestamp(payload["exp"]))
+    except FinanFlowError as e:
+        report_error(e)
+    _denylist_cache["jtis"].add(payload["jti"])
+
+def validate_session_token(token):
+    """Returns (user, token) for a valid session, or (None, None).
+
+    The DB is only consulted when the last status/expiry check is older than
+    SESSION_RECHECK_SECONDS; the returned token then carries the new check time.
+    """
+    payload = verify_session_token(token)
+    if payload is None or payload["jti"] in _revoked_jtis():
+        return None, None
+
+    recheck = float(config.get_setting("SESSION_RECHECK_SECONDS", SESSION_RECHECK_SECONDS))
+    if time.time() - payload["chk"] >= recheck:
+        try:
+            rows = repo.find_user_by_email(payload["email"])
+        except FinanFlowError as e:
+            report_error(e)
+            return None, None
+        if not rows:
+            return None, None
+        _, _, _, role, status, expiry = rows[0]
+        if status != 'active' or (expiry and datetime.datetime.now() > expiry):
+            return None, None
+        payload.update(role=role, status=status)
+        checked = True
+    else:
+        checked = False
+
+    user = {"id": payload["uid"], "email": payload["email"], "role": payload["role"], "status": payload["status"]}
+    if checked:
+        token = issue_session_token(user, jti=payload["jti"], expires_at=payload["exp"])
+    return user, token
+
+def check_login(email, password, client_id="unknown"):
+    """Verifies email and password.
+
+    Returns the user dict, {"status": "throttled" | "busy" | "expired"} when the attempt was
+    refused, or None for wrong credentials.
+    """
+    if not login_allowed(email, client_id):
+        return {"status": "throttled"}
+
+    # First check for regular user in DB
+    try:
+        rows = repo.find_user_by_email(email)
+    except FinanFlowError as e:
+        report_error(e)
+        rows = []
+
+    if rows:
+        user = rows[0]
+        valid = verify_password_bounded(password, user[2])
+        if valid is None:
+            return {"status": "busy"}
+        if valid:
+            expiry = user[5]
+            if expiry and datetime.datetime.now() > expiry:
+                # Blocking is left to the background expiry sweeper
+                return {"status": "expired"}
+            return {"id": user[0], "email": user[1], "role": user[3], "status": user[4]}
+
+    # Check for admin (credentials from the configuration; fallback for local dev without secrets)
+    admin_email = config.get_setting("admin_email", "admin@finanflow.com")
+    admin_pass = config.get_setting("admin_password", "admin@123")
+
+    if email == admin_email and password == admin_pass:
+        # Ensure admin exists in DB
+        try:
+            if not repo.find_user_by_email(email):
+                repo.create_user(email, hash_password(password), 'admin', 'active')
+        except FinanFlowError as e:
+            report_error(e)
+        return {"id": 0, "email": email, "role": "admin", "status": "active"}
+        
+    return None
+
+def register_user(email, password):
+    """Registers a new user with 'pending' status. Returns (ok, message)."""
+    try:
+        if repo.find_user_by_email(email):
+            return False, "E-mail já cadastrado."
+        repo.create_user(email, hash_password(password), 'user', 'pending')
+    except FinanFlowError as e:
+        return False, f"Erro ao cadastrar: {e}"
+    return True, "Cadastro realizado! Aguarde aprovação do administrador."
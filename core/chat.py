@@ -0,0 +1,209 @@
+"""FinanBot conversation memory: persisted turns, a bounded session window and a fixed-size prompt history.
+
+A session keeps only the last CHAT_WINDOW turns; older ones are read from chat_messages on
+demand. Each question carries at most CHAT_HISTORY_BUDGET characters of history: the rolling
+summary of old turns, the most recent turns and a few older turns matching the question. Once
+more than CHAT_SUMMARIZE_AFTER turns are outside the summary, summarize_old_turns() folds all
+but the last CHAT_WINDOW into it (run as the summarize_chat background job).
+"""
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from core import config, repository
+
+CHAT_WINDOW = 20               # turns kept in the session (and drawn) before older ones are paged in
+CHAT_OLDER_MAX = 200           # older turns a session may page in
+CHAT_HISTORY_BUDGET = 6000     # characters of summary and turns sent with each question
+CHAT_RECENT_SHARE = 0.7        # part of the remaining budget for the latest turns; the rest for relevant older ones
+CHAT_RELEVANT_TURNS = 3        # older turns matched against the question
+CHAT_TURN_MAX_CHARS = 1500     # a single turn is cut to this in prompts
+CHAT_SUMMARIZE_AFTER = 30      # turns outside the summary before it is rolled forward
+CHAT_SUMMARIZE_BATCH = 40      # turns folded per model call
+CHAT_SUMMARY_MAX_CHARS = 2000
+
+# Answers to the quick suggestions, reused while the user's financial context is unchanged
+AI_CACHE_TTL = 6 * 3600        # seconds (AI_CACHE_TTL in secrets)
+AI_CACHE_SIZE = 512            # answers kept per process (least recently used evicted)
+
+# Stable models based on the API model list, tried in order
+AI_MODELS = [
+    'gemini-1.5-flash',
+    'gemini-flash-latest',
+    'gemini-pro-latest',
+    'gemini-2.0-flash'
+]
+
+ROLE_LABELS = {"user": "Usuário", "assistant": "FinanBot"}
+HISTORY_HEADINGS = ("RESUMO DA CONVERSA ANTERIOR:\n", "TRECHOS ANTERIORES RELACIONADOS:\n", "CONVERSA RECENTE:\n")
+
+_answers = OrderedDict()
+_answers_lock = threading.Lock()
+
+SUMMARY_PROMPT = """Você mantém o resumo de uma conversa entre um usuário e o FinanBot, um consultor financeiro.
+Atualize o resumo abaixo com os novos trechos. Guarde fatos, objetivos, decisões e preferências do usuário;
+descarte cumprimentos e repetições. Responda apenas com o novo resumo, em Português (Brasil), com no máximo
+{max_chars} caracteres.
+
+RESUMO ATUAL:
+{summary}
+
+NOVOS TRECHOS:
+{transcript}"""
+
+def _clip(text, limit):
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def _line(turn):
+    return f"{ROLE_LABELS.get(turn['role'], turn['role'])}: {_clip(turn['content'], CHAT_TURN_MAX_CHARS)}"
+
+def generate(prompt, api_key=None, models=AI_MODELS):
+    """Asks the models in order and returns (text, model); raises RuntimeError with the last error when none answers."""
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        raise RuntimeError("Biblioteca 'google-generativeai' não instalada.") from None
+    api_key = api_key or config.get_setting("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("Chave GEMINI_API_KEY não configurada.")
+    genai.configure(api_key=api_key)
+
+    last_error = "Nenhum modelo disponível respondeu."
+    for model_name in models:
+        try:
+            response = genai.GenerativeModel(model_name).generate_content(prompt)
+            if response and response.text:
+                return response.text, model_name
+        except Exception as e:
+            # Quota and availability errors: try the next model
+            last_error = str(e)
+    raise RuntimeError(last_error)
+
+def context_fingerprint(context):
+    """Content hash of the financial context sent to the model."""
+    raw = json.dumps(context, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def cached_answer(user_id, question, fingerprint):
+    """Returns (text, model, answered_at) stored for this question and context, or None.
+
+    Entries are per (user, question, model); one whose fingerprint no longer matches (the
+    user's data changed) or older than AI_CACHE_TTL is dropped.
+    """
+    ttl = float(config.get_setting("AI_CACHE_TTL", AI_CACHE_TTL))
+    now = time.time()
+    with _answers_lock:
+        for model in AI_MODELS:
+            key = (user_id, question, model)
+            entry = _answers.get(key)
+            if entry is None:
+                continue
+            stored_fingerprint, text, answered_at = entry
+            if stored_fingerprint != fingerprint or now - answered_at > ttl:
+                del _answers[key]
+                continue
+            _answers.move_to_end(key)
+            return text, model, answered_at
+    return None
+
+def generate_cached(user_id, question, prompt, fingerprint, refresh=False):
+    """generate() for a question whose answer depends only on the prompt and the context.
+
+    Returns (text, model, answered_at); answered_at is None for a fresh answer. refresh skips
+    the stored answer and replaces it.
+    """
+    if not refresh:
+        hit = cached_answer(user_id, question, fingerprint)
+        if hit:
+            return hit
+    text, model = generate(prompt)
+    with _answers_lock:
+        for other in AI_MODELS:
+            _answers.pop((user_id, question, other), None)
+        _answers[(user_id, question, model)] = (fingerprint, text, time.time())
+        while len(_answers) > AI_CACHE_SIZE:
+            _answers.popitem(last=False)
+    return text, model, None
+
+def forget_answers(user_id):
+    """Drops the user's stored answers."""
+    with _answers_lock:
+        for key in [k for k in _answers if k[0] == user_id]:
+            del _answers[key]
+
+def history_for_prompt(user_id, question):
+    """Returns the history block for a new question (not yet stored), or "" for a new conversation."""
+    summary, covers_until = repository.get_chat_summary(user_id)
+    # The headings and the blank lines between sections are paid for up front
+    budget = CHAT_HISTORY_BUDGET - sum(len(heading) + 2 for heading in HISTORY_HEADINGS)
+    if summary:
+        summary = _clip(summary, min(CHAT_SUMMARY_MAX_CHARS, budget))
+        budget -= len(summary)
+
+    # Latest turns, newest first, until their share of the budget is spent
+    recent = repository.get_chat_messages(user_id, limit=CHAT_WINDOW)
+    if covers_until is not None:
+        recent = [t for t in recent if t['created_at'] > covers_until]
+    recent_budget = int(budget * CHAT_RECENT_SHARE)
+    chosen = []
+    for turn in reversed(recent):
+        line = _line(turn)
+        if len(line) + 1 > recent_budget:
+            break
+        chosen.append((turn, line))
+        recent_budget -= len(line) + 1
+    chosen.reverse()
+    budget -= int(budget * CHAT_RECENT_SHARE) - recent_budget
+
+    # Older turns about the same subject, in what is left
+    relevant = []
+    if recent or summary:
+        oldest = chosen[0][0] if chosen else None
+        before = (oldest['created_at'], oldest['id']) if oldest else (datetime.datetime.max, 0)
+        for turn in repository.search_chat_messages(user_id, question, before, CHAT_RELEVANT_TURNS):
+            line = _line(turn)
+            if len(line) + 1 > budget:
+                continue
+            relevant.append(line)
+            budget -= len(line) + 1
+
+    summary_heading, relevant_heading, recent_heading = HISTORY_HEADINGS
+    sections = []
+    if summary:
+        sections.append(summary_heading + summary)
+    if relevant:
+        sections.append(relevant_heading + "\n".join(relevant))
+    if chosen:
+        sections.append(recent_heading + "\n".join(line for _, line in chosen))
+    return "\n\n".join(sections)
+
+def needs_summary(user_id):
+    """True when more than CHAT_SUMMARIZE_AFTER turns are outside the rolling summary."""
+    _, covers_until = repository.get_chat_summary(user_id)
+    return repository.count_chat_messages_after(user_id, covers_until) > CHAT_SUMMARIZE_AFTER
+
+def summarize_old_turns(user_id, generate_text):
+    """Folds up to CHAT_SUMMARIZE_BATCH turns outside the summary (never the last CHAT_WINDOW) into it.
+
+    generate_text(prompt) returns the model's text. Returns the number of turns folded, 0 when
+    there is nothing to fold.
+    """
+    summary, covers_until = repository.get_chat_summary(user_id)
+    foldable = repository.count_chat_messages_after(user_id, covers_until) - CHAT_WINDOW
+    if foldable <= 0:
+        return 0
+    turns = repository.get_chat_messages_after(user_id, covers_until, limit=min(foldable, CHAT_SUMMARIZE_BATCH))
+    if not turns:
+        return 0
+
+    prompt = SUMMARY_PROMPT.format(
+        max_chars=CHAT_SUMMARY_MAX_CHARS,
+        summary=summary or "(vazio)",
+        transcript="\n".join(_line(t) for t in turns),
+    )
+    new_summary = _clip(generate_text(prompt).strip(), CHAT_SUMMARY_MAX_CHARS)
+    repository.save_chat_summary(user_id, new_summary, turns[-1]['created_at'])
+    return len(turns)
@@ -0,0 +1,50 @@
+import os
+import threading
+
+# Explicit settings win over sources; sources are asked in registration order, the environment last
+_settings = {}
+_sources = []
+_session_provider = None
+_local = threading.local()
+
+def configure(settings=None, source=None, session_state=None):
+    """Sets the library configuration.
+
+    settings: mapping of explicit values (DATABASE_URL, SESSION_SECRET, ...).
+    source: callable(key) -> value or None, asked for keys missing from settings (e.g. a secrets file).
+    session_state: callable returning the mutable mapping of the current user session; without it
+    every thread gets its own dict.
+    """
+    global _session_provider
+    if settings:
+        _settings.update(settings)
+    if source is not None and source not in _sources:
+        _sources.append(source)
+    if session_state is not None:
+        _session_provider = session_state
+
+def get_setting(key, default=None):
+    """Returns a setting from the explicit settings, the registered sources or the environment."""
+    if _settings.get(key) is not None:
+        return _settings[key]
+    for source in _sources:
+        try:
+            value = source(key)
+        except Exception:
+            value = None
+        if value is not None:
+            return value
+    value = os.environ.get(key)
+    return value if value is not None else default
+
+def session_state():
+    """Returns the state mapping of the current session (per thread outside an app session)."""
+    if _session_provider is not None:
+        try:
+            return _session_provider()
+        except Exception:
+            # Provider unavailable here (background thread, script)
+            pass
+    if not hasattr(_local, "state"):
+        _local.state = {}
+    return _local.state
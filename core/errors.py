@@ -0,0 +1,31 @@
+import logging
+
+logger = logging.getLogger("core")
+
+_handlers = []
+
+class FinanFlowError(Exception):
+    """Base class of the errors raised by the core library."""
+
+class DatabaseUnavailable(FinanFlowError):
+    """No connection could be made to the database (or shard) a call needs."""
+
+class QueryError(FinanFlowError):
+    """A statement failed; the database error is chained as __cause__."""
+
+class JobLimitReached(FinanFlowError):
+    """The user already has the maximum number of pending background jobs."""
+
+def add_error_handler(handler):
+    """Registers handler(error), called for errors the core recovers from (a read falling back to an empty result)."""
+    if handler not in _handlers:
+        _handlers.append(handler)
+
+def report_error(error):
+    """Logs a recovered error and hands it to the registered handlers."""
+    logger.warning("%s: %s", type(error).__name__, error)
+    for handler in _handlers:
+        try:
+            handler(error)
+        except Exception:
+            logger.exception("Error handler failed")
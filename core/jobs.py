@@ -0,0 +1,560 @@
+"""Background jobs: a persistent queue in the primary database worked by separate processes.
+
+Long operations (exports, imports, aggregate rebuilds, archival, anomaly scans) are enqueued from the app and
+run by worker processes, so they neither block a session nor restart on a rerun. The UI polls
+get_job() for progress; cancellation is cooperative (checked whenever a job reports progress).
+
+    python -m core.jobs --workers 2     # standalone workers (settings from the environment)
+"""
+import datetime
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import zlib
+from decimal import Decimal, InvalidOperation
+
+import pandas as pd
+import psycopg2
+
+from core import aggregations, config, repository
+from core.errors import DatabaseUnavailable, FinanFlowError, JobLimitReached, QueryError
+
+JOB_WORKERS = 2                # worker processes started by the app (JOB_WORKERS in secrets, 0 = none)
+JOB_MAX_RUNNING_PER_USER = 1   # jobs of one user running at the same time
+JOB_MAX_PENDING_PER_USER = 5   # queued + running jobs one user may have
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 30           # seconds before the first retry, doubled on each further attempt
+JOB_POLL_INTERVAL = 1.0        # seconds an idle worker waits before looking for work again
+JOB_HEARTBEAT_INTERVAL = 10    # seconds between heartbeats of a running job
+JOB_STALE_SECONDS = 120        # a running job without a heartbeat this long is requeued (its worker died)
+JOB_PROGRESS_INTERVAL = 0.5    # minimum seconds between progress writes of one job
+JOB_CLAIM_LOCK_KEY = 7304003   # advisory lock serializing claims, so per-user limits hold across workers
+
+# Settings handed to worker processes, which cannot read the app's secrets themselves
+WORKER_SETTINGS = ("DATABASE_URL", "DATABASE_SHARD_URLS", "DATABASE_REPLICA_URLS", "GEMINI_API_KEY")
+
+ACTIVE_STATUSES = ("queued", "running")
+JOB_COLUMNS = "id, user_id, kind, params, status, progress, message, result, error, attempts, created_at, started_at, finished_at"
+
+IMPORT_COLUMNS = ["date", "type", "category", "amount", "description"]
+IMPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_ROWS = 5000
+ANOMALY_BATCH_USERS = 500      # users whose aggregates are read and scanned together
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_workers = []
+_workers_lock = threading.Lock()
+
+class JobCancelled(Exception):
+    """Raised inside a handler when the job was cancelled."""
+
+def handler(kind):
+    """Registers fn(job, **params) as the handler of a job kind; its return value is stored as the job result."""
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+def _connection():
+    conn = repository.get_connection()
+    if not conn: raise DatabaseUnavailable(repository._NO_CONNECTION)
+    return conn
+
+def _row_to_job(row):
+    return dict(zip([col.strip() for col in JOB_COLUMNS.split(",")], row))
+
+# --- Queue API (used by the app) ---
+
+def enqueue(kind, user_id=None, params=None, payload=None, max_attempts=JOB_MAX_ATTEMPTS):
+    """Queues a job and returns its id.
+
+    An identical job (same kind, user, params and payload) still queued or running is reused
+    instead, so a rerun never starts the same work twice. Raises JobLimitReached when the user
+    already has JOB_MAX_PENDING_PER_USER pending jobs.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Tipo de job desconhecido: {kind}")
+    params = dict(params or {})
+    if payload is not None:
+        params["payload_digest"] = hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "SELECT id FROM jobs WHERE kind = %s AND user_id IS NOT DISTINCT FROM %s AND params = %s::jsonb "
+            "AND status IN ('queued', 'running') ORDER BY id LIMIT 1",
+            (kind, user_id, json.dumps(params))
+        )
+        existing = c.fetchone()
+        if existing:
+            return existing[0]
+        if user_id is not None:
+            c.execute("SELECT COUNT(*) FROM jobs WHERE user_id = %s AND status IN ('queued', 'running')", (user_id,))
+            if c.fetchone()[0] >= JOB_MAX_PENDING_PER_USER:
+                raise JobLimitReached(
+                    f"Você já tem {JOB_MAX_PENDING_PER_USER} tarefas em andamento. Aguarde alguma terminar."
+                )
+        c.execute(
+            "INSERT INTO jobs (user_id, kind, params, payload, max_attempts) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            (user_id, kind, json.dumps(params),
+             psycopg2.Binary(zlib.compress(payload)) if payload is not None else None, max_attempts)
+        )
+        job_id = c.fetchone()[0]
+        conn.commit()
+        return job_id
+    except FinanFlowError:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+
+def get_job(job_id, user_id=None):
+    """Returns a job as a dict (without its payload and output), or None; user_id restricts it to that user."""
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s AND (%s IS NULL OR user_id = %s)",
+            (job_id, user_id, user_id)
+        )
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+def latest_job(user_id, kind):
+    """Returns the user's most recent job of a kind, or None."""
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE user_id = %s AND kind = %s ORDER BY id DESC LIMIT 1",
+            (user_id, kind)
+        )
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return _row_to_job(row) if row else None
+
+def get_job_output(job_id, user_id=None):
+    """Returns the file a finished job produced (bytes), or None."""
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "SELECT output FROM jobs WHERE id = %s AND status = 'done' AND (%s IS NULL OR user_id = %s)",
+            (job_id, user_id, user_id)
+        )
+        row = c.fetchone()
+    finally:
+        conn.close()
+    return zlib.decompress(bytes(row[0])) if row and row[0] is not None else None
+
+def cancel_job(job_id, user_id=None):
+    """Cancels a queued job at once and asks a running one to stop; returns False when it already finished."""
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "UPDATE jobs SET status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+            "finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END, "
+            "cancel_requested = TRUE "
+            "WHERE id = %s AND status IN ('queued', 'running') AND (%s IS NULL OR user_id = %s) RETURNING id",
+            (job_id, user_id, user_id)
+        )
+        found = c.fetchone() is not None
+        conn.commit()
+    finally:
+        conn.close()
+    return found
+
+# --- Worker side ---
+
+class Job:
+    """A claimed job as seen by its handler."""
+
+    def __init__(self, job_id, user_id, kind, attempts, payload=None, state=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.attempts = attempts
+        self.payload = zlib.decompress(bytes(payload)) if payload is not None else None
+        self.state = dict(state or {})
+        self.output = None
+        self._last_progress = 0.0
+
+    def checkpoint(self, **values):
+        """Saves resumable state (kept in the job result until it finishes); a retry finds it in job.state."""
+        self.state.update(values)
+        conn = _connection()
+        try:
+            conn.cursor().execute("UPDATE jobs SET result = %s WHERE id = %s", (json.dumps(self.state, default=str), self.id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def progress(self, fraction, message=None, force=False):
+        """Records progress (0..1) and raises JobCancelled when a cancellation was requested.
+
+        Writes are throttled to one per JOB_PROGRESS_INTERVAL unless force is set.
+        """
+        now = time.time()
+        if not force and now - self._last_progress < JOB_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        conn = _connection()
+        c = conn.cursor()
+        try:
+            c.execute(
+                "UPDATE jobs SET progress = %s, message = COALESCE(%s, message), heartbeat_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s RETURNING cancel_requested",
+                (max(0.0, min(float(fraction), 1.0)), message, self.id)
+            )
+            row = c.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        if row and row[0]:
+            raise JobCancelled()
+
+def _claim(worker_id):
+    """Marks the oldest runnable job as running for this worker and returns it, or None.
+
+    Claims are serialized with an advisory lock so the per-user running limit sees every
+    earlier claim; SKIP LOCKED passes over rows another session is updating.
+    """
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT pg_advisory_xact_lock(%s)", (JOB_CLAIM_LOCK_KEY,))
+        c.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = %s, error = NULL,
+                   started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = (
+                SELECT j.id FROM jobs j
+                WHERE j.status = 'queued' AND j.run_after <= CURRENT_TIMESTAMP
+                  AND (j.user_id IS NULL OR (
+                      SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = 'running'
+                  ) < %s)
+                ORDER BY j.run_after, j.id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, kind, params, attempts, payload, result
+        ''', (worker_id, JOB_MAX_RUNNING_PER_USER))
+        row = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return row
+
+def _requeue_stale():
+    """Gives jobs whose worker stopped sending heartbeats back to the queue (or fails them when out of attempts)."""
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE jobs SET
+                status = CASE WHEN attempts < max_attempts AND NOT cancel_requested THEN 'queued'
+                              WHEN cancel_requested THEN 'cancelled' ELSE 'failed' END,
+                error = 'Worker interrompido durante a execução.',
+                worker = NULL,
+                finished_at = CASE WHEN attempts < max_attempts AND NOT cancel_requested THEN NULL
+                                   ELSE CURRENT_TIMESTAMP END
+            WHERE status = 'running' AND heartbeat_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+        ''', (JOB_STALE_SECONDS,))
+        if c.rowcount:
+            logger.warning("Requeued %d stale job(s)", c.rowcount)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _finish(job_id, status, result=None, output=None, error=None, retry_in=None):
+    conn = _connection()
+    c = conn.cursor()
+    try:
+        if retry_in is not None:
+            c.execute(
+                "UPDATE jobs SET status = 'queued', error = %s, worker = NULL, "
+                "run_after = CURRENT_TIMESTAMP + %s * INTERVAL '1 second' WHERE id = %s",
+                (error, retry_in, job_id)
+            )
+        else:
+            c.execute(
+                "UPDATE jobs SET status = %s, result = %s, output = %s, error = %s, "
+                "progress = CASE WHEN %s = 'done' THEN 1 ELSE progress END, finished_at = CURRENT_TIMESTAMP "
+                "WHERE id = %s",
+                (status, json.dumps(result, default=str) if result is not None else None,
+                 psycopg2.Binary(zlib.compress(output)) if output is not None else None,
+                 error, status, job_id)
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+def _heartbeat(job_id, stop):
+    """Keeps a running job's heartbeat fresh while its handler works between progress reports."""
+    while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            conn = _connection()
+            try:
+                conn.cursor().execute("UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = %s", (job_id,))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning("Heartbeat of job %s failed: %s", job_id, e)
+
+def run_job(row):
+    """Runs one claimed job and records its outcome, retrying failures with exponential backoff."""
+    job_id, user_id, kind, params, attempts, payload, state = row
+    params = dict(params or {})
+    params.pop("payload_digest", None)
+    job = Job(job_id, user_id, kind, attempts, payload, state)
+    fn = _handlers.get(kind)
+
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(job_id, stop), name=f"job-{job_id}-heartbeat", daemon=True)
+    beat.start()
+    try:
+        if fn is None:
+            raise ValueError(f"Tipo de job desconhecido: {kind}")
+        result = fn(job, **params)
+    except JobCancelled:
+        _finish(job_id, "cancelled", error="Cancelado pelo usuário.")
+    except Exception as e:
+        logger.exception("Job %s (%s) failed on attempt %s", job_id, kind, attempts)
+        # If the queue cannot be read here, run_worker logs the lost job and the stale check requeues it
+        conn = _connection()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT max_attempts, cancel_requested FROM jobs WHERE id = %s", (job_id,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            logger.warning("Job %s was deleted while running; its outcome is not recorded", job_id)
+            return
+        max_attempts, cancelled = row
+        # Bad input fails at once; other errors (database, network) are retried
+        if cancelled or isinstance(e, ValueError) or attempts >= max_attempts:
+            _finish(job_id, "cancelled" if cancelled else "failed", error=str(e))
+        else:
+            _finish(job_id, "queued", error=str(e), retry_in=JOB_RETRY_DELAY * 2 ** (attempts - 1))
+    else:
+        _finish(job_id, "done", result=result, output=job.output)
+    finally:
+        stop.set()
+
+def run_worker(worker_id=None, stop=None, poll_interval=JOB_POLL_INTERVAL):
+    """Claims and runs jobs until stop (a threading/multiprocessing Event) is set."""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    last_stale_check = 0.0
+    logger.info("Job worker %s started", worker_id)
+    while stop is None or not stop.is_set():
+        try:
+            if time.time() - last_stale_check > JOB_HEARTBEAT_INTERVAL:
+                _requeue_stale()
+                last_stale_check = time.time()
+            row = _claim(worker_id)
+        except Exception as e:
+            logger.warning("Job worker %s cannot reach the queue: %s", worker_id, e)
+            row = None
+        if row is None:
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+        try:
+            run_job(row)
+        except Exception:
+            # Outcome not recorded (queue unreachable); the stale check requeues the job
+            logger.exception("Job worker %s lost job %s", worker_id, row[0])
+    logger.info("Job worker %s stopped", worker_id)
+
+def _worker_main(worker_id, settings, stop):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    config.configure(settings)
+    run_worker(worker_id, stop)
+
+def start_workers(count=None):
+    """Starts the worker processes once per app process and returns them.
+
+    Workers get a snapshot of WORKER_SETTINGS, since secrets providers registered in the app
+    do not exist in a fresh process.
+    """
+    with _workers_lock:
+        alive = [p for p, _ in _workers if p.is_alive()]
+        if alive:
+            return alive
+        count = int(config.get_setting("JOB_WORKERS", JOB_WORKERS) if count is None else count)
+        settings = {key: config.get_setting(key) for key in WORKER_SETTINGS if config.get_setting(key) is not None}
+        ctx = multiprocessing.get_context("spawn")
+        _workers.clear()
+        for i in range(count):
+            stop = ctx.Event()
+            process = ctx.Process(
+                target=_worker_main, args=(f"{socket.gethostname()}:{os.getpid()}:{i}", settings, stop),
+                name=f"finanflow-job-worker-{i}", daemon=True
+            )
+            process.start()
+            _workers.append((process, stop))
+        return [p for p, _ in _workers]
+
+def stop_workers(timeout=10):
+    """Asks the worker processes to stop after their current job and waits for them."""
+    with _workers_lock:
+        for _, stop in _workers:
+            stop.set()
+        for process, _ in _workers:
+            process.join(timeout)
+        _workers.clear()
+
+# --- Handlers ---
+
+@handler("export_transactions")
+def export_transactions(job):
+    """Full transaction history (live and archived) as CSV."""
+    job.progress(0.05, "Lendo transações...", force=True)
+    df = repository.get_transactions_df(job.user_id)
+    total = len(df)
+    buffer = io.StringIO()
+    for start in range(0, max(total, 1), EXPORT_CHUNK_ROWS):
+        df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(buffer, index=False, header=start == 0)
+        job.progress(0.1 + 0.85 * min(start + EXPORT_CHUNK_ROWS, total) / max(total, 1),
+                     f"Gerando CSV ({min(start + EXPORT_CHUNK_ROWS, total)} de {total} linhas)...")
+    job.output = buffer.getvalue().encode('utf-8')
+    return {"rows": total, "file_name": f"FinanFlow_relatorio_{datetime.date.today()}.csv"}
+
+def _parse_import_row(record):
+    """Returns (date, type, category, amount, description) from one CSV record; raises ValueError."""
+    date = datetime.date.fromisoformat(str(record["date"]).strip()[:10])
+    type_ = str(record["type"]).strip()
+    if type_ not in aggregations.TRANSACTION_TYPES:
+        raise ValueError(f"tipo inválido '{type_}'")
+    category = str(record["category"]).strip()
+    if not category:
+        raise ValueError("categoria vazia")
+    try:
+        amount = Decimal(str(record["amount"]).strip().replace(",", "."))
+    except InvalidOperation:
+        raise ValueError(f"valor inválido '{record['amount']}'") from None
+    if amount <= 0:
+        raise ValueError("valor deve ser positivo")
+    description = record.get("description")
+    description = None if description is None or str(description) in ("", "nan") else str(description)
+    return date, type_, category, amount, description
+
+@handler("import_transactions")
+def import_transactions(job):
+    """Adds the rows of a CSV statement (columns date, type, category, amount[, description]) in batches."""
+    job.progress(0.02, "Lendo arquivo...", force=True)
+    df = pd.read_csv(io.BytesIO(job.payload), dtype=str, keep_default_na=False)
+    missing = [col for col in IMPORT_COLUMNS[:4] if col not in df.columns]
+    if missing:
+        raise ValueError(f"Colunas ausentes no arquivo: {', '.join(missing)}")
+
+    rows, errors = [], []
+    for line, record in enumerate(df.to_dict("records"), start=2):
+        try:
+            rows.append(_parse_import_row(record))
+        except (ValueError, KeyError) as e:
+            errors.append(f"linha {line}: {e}")
+    if errors and not rows:
+        raise ValueError("Nenhuma linha válida. " + "; ".join(errors[:5]))
+
+    # A retry resumes after the last committed batch: each batch commits its progress with its rows
+    done = repository.get_import_progress(job.user_id, job.id)
+    for start in range(done, len(rows), IMPORT_BATCH_SIZE):
+        job.progress(0.05 + 0.95 * start / len(rows), f"Importando ({start} de {len(rows)} linhas)...")
+        done = min(start + IMPORT_BATCH_SIZE, len(rows))
+        repository.add_transactions(job.user_id, rows[start:done], import_job=(job.id, done))
+    return {"imported": done, "skipped": len(errors), "errors": errors[:20]}
+
+@handler("rebuild_aggregates")
+def rebuild_aggregates(job):
+    """Recomputes the monthly totals and category counters of the job's user (or of every user)."""
+    if job.user_id is not None:
+        job.progress(0.1, "Recalculando totais...", force=True)
+        repository.rebuild_user_aggregates(job.user_id)
+        return {"users": 1}
+
+    user_ids = [int(i) for i in repository.get_users_df()['id']]
+    for i, user_id in enumerate(user_ids):
+        job.progress(i / max(len(user_ids), 1), f"Usuário {i + 1} de {len(user_ids)}...")
+        repository.rebuild_user_aggregates(user_id)
+    return {"users": len(user_ids)}
+
+@handler("archive_closed_years")
+def archive_closed_years(job, keep_years=repository.ARCHIVE_KEEP_YEARS):
+    """Moves closed years into cold storage (maintenance job without a user)."""
+    job.progress(0.1, "Arquivando anos fechados...", force=True)
+    return {"years": repository.archive_closed_years(keep_years)}
+
+@handler("summarize_chat")
+def summarize_chat(job):
+    """Rolls the user's FinanBot summary forward over the turns outside it (one model call per batch)."""
+    from core import chat  # only worker processes need it; keeps it off the app's start-up
+    folded = 0
+    while True:
+        job.progress(0.5, f"Resumindo conversa ({folded} mensagens)...", force=True)
+        count = chat.summarize_old_turns(job.user_id, lambda prompt: chat.generate(prompt)[0])
+        if not count:
+            return {"folded": folded}
+        folded += count
+
+@handler("detect_anomalies")
+def detect_anomalies(job, month=None):
+    """Stores the spending anomalies of a month (default the current one) for the job's user or every user."""
+    from core import anomalies  # only worker processes need it; keeps it off the app's start-up
+    month = datetime.date.fromisoformat(month) if month else datetime.date.today()
+    month = month.replace(day=1)
+    if job.user_id is not None:
+        user_ids = [job.user_id]
+    else:
+        users = repository.get_users_df()
+        user_ids = [int(i) for i in users.loc[users['role'] != 'admin', 'id']] if not users.empty else []
+
+    # A retry resumes after the last batch checkpointed as stored
+    done = int(job.state.get("users", 0))
+    flagged = int(job.state.get("anomalies", 0))
+    for start in range(done, len(user_ids), ANOMALY_BATCH_USERS):
+        job.progress(start / max(len(user_ids), 1), f"Analisando usuários ({start} de {len(user_ids)})...")
+        batch = user_ids[start:start + ANOMALY_BATCH_USERS]
+        monthly, daily = repository.get_expense_history_for_users(
+            batch, month, anomalies.ANOMALY_BASELINE_MONTHS, anomalies.DAY_BASELINE_DAYS
+        )
+        found = anomalies.detect(monthly, daily, month)
+        repository.save_spending_anomalies(batch, month, found)
+        done = start + len(batch)
+        flagged += len(found)
+        job.checkpoint(users=done, anomalies=flagged)
+    return {"users": done, "anomalies": flagged, "month": month.isoformat()}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="FinanFlow background job workers")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="worker processes to run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    processes = start_workers(args.workers)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        stop_workers()
@@ -0,0 +1,136 @@
+"""Monte Carlo projection of investment goals.
+
+Each goal's balance is simulated month by month over PROJECTION_PATHS paths: monthly returns are
+log-normal from the category's expected yield and volatility, and monthly contributions are
+drawn from the user's own net contributions to that category (so skipped months and irregular
+amounts are kept). All goals are simulated together in (goals, months, paths) arrays, a block of
+months at a time; a goal drops out once every one of its paths has reached the target.
+"""
+import numpy as np
+import pandas as pd
+
+PROJECTION_PATHS = 1000
+PROJECTION_MONTHS = 240        # horizon; goals not reached by then have no date
+PROJECTION_BLOCK = 12         # months simulated per step
+CONTRIBUTION_MONTHS = 12       # months of contribution history drawn from
+CONFIDENCE = (10, 50, 90)      # percentiles reported for the completion date and the balance bands
+
+def monthly_contributions(df, today=None, months=CONTRIBUTION_MONTHS):
+    """Net invested per month and category over the last `months` months (current one included).
+
+    Returns a DataFrame indexed by month (Period) with one column per investment category; months
+    without movement are 0.
+    """
+    today = pd.Timestamp(today or pd.Timestamp.today())
+    index = pd.period_range(end=today.to_period('M'), periods=months, freq='M')
+    if df.empty:
+        return pd.DataFrame(index=index)
+    inv = df[df['type'] == 'Investimento']
+    dates = pd.to_datetime(inv['date'])
+    recent = inv[dates.dt.to_period('M') >= index[0]]
+    table = recent.pivot_table(
+        index=pd.to_datetime(recent['date']).dt.to_period('M'), columns='category',
+        values='amount', aggfunc='sum'
+    )
+    return table.reindex(index).fillna(0.0).astype(float)
+
+def _history_matrix(history, categories):
+    """Padded (goals, months) contribution matrix and the months each goal has been funded."""
+    width = max(len(history.index), 1)
+    matrix = np.zeros((len(categories), width))
+    lengths = np.ones(len(categories), dtype=int)
+    for i, cat in enumerate(categories):
+        if cat not in history.columns:
+            continue
+        values = history[cat].to_numpy(dtype=float)
+        active = np.flatnonzero(values)
+        if active.size:
+            # Cadence since the first contribution in the window, not since the window start
+            values = values[active[0]:]
+            matrix[i, :values.size] = values
+            lengths[i] = values.size
+    return matrix, lengths
+
+def project_goals(goals, history, assumptions, today=None, paths=PROJECTION_PATHS,
+                  months=PROJECTION_MONTHS, seed=None):
+    """Simulates every goal and returns (summary, bands).
+
+    goals: DataFrame with 'category', 'current' and 'target'. history: monthly_contributions().
+    assumptions: {category: (expected annual yield %, annual volatility %)}.
+    summary has one row per goal with 'probability' (of reaching the target within the horizon)
+    and 'eta_p10'/'eta_p50'/'eta_p90' (month the target is reached, NaT beyond the horizon).
+    bands maps each category to a DataFrame of the balance percentiles ('p10', 'p50', 'p90')
+    per month, from the current balance until the last reported percentile reached the target.
+    """
+    today = pd.Timestamp(today or pd.Timestamp.today())
+    columns = ['category', 'current', 'target', 'probability'] + [f'eta_p{q}' for q in CONFIDENCE]
+    if goals.empty:
+        return pd.DataFrame(columns=columns), {}
+
+    categories = goals['category'].tolist()
+    n = len(categories)
+    current = goals['current'].to_numpy(dtype=np.float32)
+    target = goals['target'].to_numpy(dtype=np.float32)
+    perf, vol = (np.array(v, dtype=np.float32) / 100 for v in zip(*(assumptions[c] for c in categories)))
+    matrix, lengths = _history_matrix(history, categories)
+    matrix = matrix.astype(np.float32)
+    rng = np.random.default_rng(seed)
+
+    # Log-normal monthly returns with the expected annual yield as their mean
+    sigma = (vol / np.sqrt(12)).astype(np.float32)[:, None, None]
+    mu = (np.log1p(perf) / 12).astype(np.float32)[:, None, None] - sigma ** 2 / 2
+
+    # Simulated in blocks of months (arrays are goals x months x paths) for the goals with paths still short
+    balance = np.broadcast_to(current[:, None], (n, paths)).copy()
+    first = np.where(balance >= target[:, None], 0, months + 1)
+    ranks = [min(int(q / 100 * paths), paths - 1) for q in CONFIDENCE]
+    bands = [[np.repeat(current[i], len(CONFIDENCE))[None, :]] for i in range(n)]
+    simulated = 0
+    while simulated < months:
+        live = np.flatnonzero((first > months).any(axis=1))
+        if not live.size:
+            break
+        block = min(PROJECTION_BLOCK, months - simulated)
+        shape = (live.size, block, paths)
+        log_returns = mu[live] + sigma[live] * rng.standard_normal(shape, dtype=np.float32)
+        growth = np.exp(np.cumsum(log_returns, axis=1))
+
+        # Contributions bootstrapped from each goal's own monthly history
+        picks = (rng.random(shape, dtype=np.float32) * lengths[live, None, None]).astype(np.intp)
+        contributions = matrix[live[:, None, None], picks]
+
+        # b[t] = G[t] * (b0 + sum(c[s] / G[s], s <= t)) with G the growth since the block start
+        path = growth * (balance[live, None, :] + np.cumsum(contributions / growth, axis=1))
+
+        # Bands are only kept until the last reported percentile of paths got there
+        banded = (first[live] <= simulated).mean(axis=1) < CONFIDENCE[-1] / 100
+        if banded.any():
+            levels = np.partition(path[banded], ranks, axis=2)[:, :, ranks]
+            for i, goal_levels in zip(live[banded], levels):
+                bands[i].append(goal_levels)
+
+        reached = path >= target[live, None, None]
+        hit = reached.any(axis=1) & (first[live] > months)
+        rows, cols = np.nonzero(hit)
+        first[live[rows], cols] = simulated + 1 + reached.argmax(axis=1)[rows, cols]
+        balance[live] = path[:, -1, :]
+        simulated += block
+
+    first.sort(axis=1)
+    months_index = pd.period_range(start=today.to_period('M'), periods=months + 1, freq='M')
+    summary = pd.DataFrame({
+        'category': categories,
+        'current': current.astype(float),
+        'target': target.astype(float),
+        'probability': (first <= months).mean(axis=1),
+    })
+    for q, rank in zip(CONFIDENCE, ranks):
+        summary[f'eta_p{q}'] = [
+            months_index[m].to_timestamp() if m <= months else pd.NaT for m in first[:, rank]
+        ]
+
+    band_columns = [f'p{q}' for q in CONFIDENCE]
+    for i, cat in enumerate(categories):
+        levels = np.concatenate(bands[i]).astype(float)
+        bands[i] = pd.DataFrame(levels, index=months_index[:len(levels)].to_timestamp(), columns=band_columns)
+    return summary, dict(zip(categories, bands))
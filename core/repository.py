@@ -0,0 +1,2096 @@
+import psycopg2
+import psycopg2.extras
+import pandas as pd
+import datetime
+import time
+import itertools
+import logging
+import threading
+import bisect
+import copy
+import functools
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import re
+import zlib
+from decimal import Decimal
+
+from core import config
+from core.errors import DatabaseUnavailable, QueryError, report_error
+
+# Read replica routing (optional DATABASE_REPLICA_URLS in secrets)
+REPLICA_STICKY_SECONDS = 5       # a session reads from the primary this long after it writes
+REPLICA_HEALTH_INTERVAL = 10     # seconds between health checks of the same replica
+REPLICA_RETRY_SECONDS = 30       # how long a failing replica is skipped
+REPLICA_MAX_LAG_SECONDS = 5      # replicas lagging more than this are treated as unhealthy
+
+# Transactions partitioning and cold-data archival
+TRANSACTION_PARTITION_YEARS_AHEAD = 1   # yearly partitions created ahead of time
+ARCHIVE_KEEP_YEARS = 2                  # live years kept in partitions (including the current one)
+TRANSACTION_COLUMNS = "id, user_id, date, type, category, amount, description, created_at"
+TRANSACTION_ROW_COLUMNS = "id, user_id, date, type, category_id, amount_cents, description, created_at"  # stored layout
+TRANSACTION_PAGE_SIZE = 50              # rows per page of the transaction grids
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever _init_database changes; sessions only compare this number on boot
+SCHEMA_VERSION = 9
+
+# Background expiry sweeper
+EXPIRY_SWEEP_INTERVAL = 300      # seconds between sweeps (EXPIRY_SWEEP_INTERVAL in secrets)
+EXPIRY_SWEEP_LOCK_KEY = 7304001  # advisory lock shared by every app process
+
+# Admin user directory
+USER_DIRECTORY_COLUMNS = "id, email, role, status, expiry_date, created_at"
+USER_DIRECTORY_PAGE_SIZE = 25
+
+# Per-user category dictionary
+CATEGORY_LOCK_KEY = 7304002      # advisory lock class for assigning a user's next category id
+
+# User-id sharding (optional DATABASE_SHARD_URLS in secrets)
+SHARD_VIRTUAL_NODES = 64         # points per shard on the consistent hash ring
+
+# FinanBot chat history
+CHAT_PAGE_SIZE = 20              # turns per page when loading a conversation
+
+# Connection pooling (primary and shards; replicas connect per call)
+DB_POOL_SIZE = 8                 # idle connections kept per database (DB_POOL_SIZE in secrets)
+DB_POOL_IDLE_SECONDS = 60        # idle connections older than this are closed instead of reused
+
+# Per-user read cache, filled at login by prefetch_user_data and dropped on the user's writes
+USER_CACHE_TTL = 300             # seconds; upper bound when the version check cannot reach the database
+USER_CACHE_CHECK_INTERVAL = 1    # seconds between checks of a user's data version (writes by other processes)
+USER_CACHE_MAX_USERS = 256       # users kept per process (least recently used evicted)
+PREFETCH_WORKERS = 6
+
+_replica_down_until = {}
+_replica_checked_at = {}
+_replica_cycle = itertools.count()
+_shard_rings = {}
+_sweeper_lock = threading.Lock()
+_sweeper_thread = None
+_last_sweep = {}
+_pools = {}
+_pools_lock = threading.Lock()
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_versions = {}
+_user_writes = {}
+_prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def _replica_urls():
+    """Returns the configured replica DSNs (TOML list or comma separated string)."""
+    return _url_list("DATABASE_REPLICA_URLS")
+
+def _mark_session_write():
+    """Remembers that the current session wrote, so its next reads stay on the primary."""
+    config.session_state()["_db_last_write"] = time.time()
+
+def _session_wrote_recently():
+    last_write = config.session_state().get("_db_last_write", 0)
+    sticky = float(config.get_setting("REPLICA_STICKY_SECONDS", REPLICA_STICKY_SECONDS))
+    return time.time() - last_write < sticky
+
+def _user_wrote_recently(user_id):
+    """True while a write to user_id's data, by any session or process seen so far, may not have reached the replicas."""
+    sticky = float(config.get_setting("REPLICA_STICKY_SECONDS", REPLICA_STICKY_SECONDS))
+    return time.time() - _user_writes.get(user_id, 0) < sticky
+
+def _replica_is_healthy(url, conn):
+    """Checks replication lag at most every REPLICA_HEALTH_INTERVAL seconds."""
+    now = time.time()
+    interval = float(config.get_setting("REPLICA_HEALTH_INTERVAL", REPLICA_HEALTH_INTERVAL))
+    if now - _replica_checked_at.get(url, 0) < interval:
+        return True
+    _replica_checked_at[url] = now
+    c = conn.cursor()
+    # An idle primary makes the replay timestamp look old, so a fully replayed WAL counts as no lag
+    c.execute("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END
+    """)
+    lag = float(c.fetchone()[0] or 0)
+    c.close()
+    max_lag = float(config.get_setting("REPLICA_MAX_LAG_SECONDS", REPLICA_MAX_LAG_SECONDS))
+    return lag <= max_lag
+
+def _connect_replica():
+    """Returns a read-only connection to a healthy replica (round robin), or None."""
+    urls = _replica_urls()
+    if not urls: return None
+
+    start = next(_replica_cycle)
+    for i in range(len(urls)):
+        url = urls[(start + i) % len(urls)]
+        if _replica_down_until.get(url, 0) > time.time():
+            continue
+        conn = None
+        try:
+            conn = psycopg2.connect(url, connect_timeout=2)
+            conn.set_session(readonly=True, autocommit=True)
+            if _replica_is_healthy(url, conn):
+                return conn
+        except Exception:
+            pass
+        # Unreachable or lagging: skip it for a while and try the next one
+        if conn: conn.close()
+        _replica_down_until[url] = time.time() + float(config.get_setting("REPLICA_RETRY_SECONDS", REPLICA_RETRY_SECONDS))
+    return None
+
+def _url_list(key):
+    """Reads a list of DSNs from secrets (TOML list or comma separated string)."""
+    urls = config.get_setting(key, [])
+    if isinstance(urls, str):
+        urls = [u.strip() for u in urls.split(",") if u.strip()]
+    return list(urls)
+
+def _shard_urls():
+    """Returns the shard DSNs; without DATABASE_SHARD_URLS the primary is the only shard."""
+    urls = _url_list("DATABASE_SHARD_URLS")
+    if urls: return urls
+    primary = config.get_setting("DATABASE_URL")
+    return [primary] if primary else []
+
+def _sharded():
+    return len(_shard_urls()) > 1
+
+def _all_database_urls():
+    """Returns the primary and every shard, without duplicates."""
+    urls = [config.get_setting("DATABASE_URL")] + _shard_urls()
+    return list(dict.fromkeys(u for u in urls if u))
+
+def _ring_hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+def _shard_ring(urls):
+    """Builds (and caches) the consistent hash ring for a tuple of shard DSNs."""
+    ring = _shard_rings.get(urls)
+    if ring is None:
+        points = []
+        for url in urls:
+            # Credentials are not part of the shard identity, so rotating a password keeps placement
+            name = re.sub(r"//[^@/]*@", "//", url)
+            points.extend((_ring_hash(f"{name}#{i}"), url) for i in range(SHARD_VIRTUAL_NODES))
+        points.sort()
+        ring = ([p[0] for p in points], [p[1] for p in points])
+        _shard_rings[urls] = ring
+    return ring
+
+def shard_for_user(user_id):
+    """Maps a user_id to the DSN of the shard that owns its rows."""
+    urls = tuple(_shard_urls())
+    if len(urls) <= 1:
+        return urls[0] if urls else None
+    keys, owners = _shard_ring(urls)
+    idx = bisect.bisect(keys, _ring_hash(f"user:{user_id}")) % len(keys)
+    return owners[idx]
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Connection whose close() hands it back to its pool, so callers keep closing as before."""
+
+    def close(self):
+        pool = getattr(self, "_pool", None)
+        if pool is None or self.closed:
+            return super().close()
+        pool.release(self)
+
+class _ConnectionPool:
+    """Idle connections of one database, reused most recent first; there is no cap on connections in use."""
+
+    def __init__(self, dsn, size):
+        self.dsn = dsn
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if not candidate.closed and now - candidate._released_at < DB_POOL_IDLE_SECONDS:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for old in expired:
+            self._discard(old)
+        if conn is None:
+            conn = psycopg2.connect(self.dsn, connection_factory=_PooledConnection)
+            conn._pool = self
+        return conn
+
+    def release(self, conn):
+        try:
+            # Uncommitted work (a read, a failed write) must not leak into the next user
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except Exception:
+            self._discard(conn)
+            return
+        conn._released_at = time.time()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            psycopg2.extensions.connection.close(conn)
+        except Exception:
+            pass
+
+def _pool_for(db_url):
+    with _pools_lock:
+        pool = _pools.get(db_url)
+        if pool is None:
+            pool = _pools[db_url] = _ConnectionPool(db_url, int(config.get_setting("DB_POOL_SIZE", DB_POOL_SIZE)))
+        return pool
+
+def _connect(db_url):
+    max_retries = 3
+    retry_delay = 2 # seconds
+    
+    for attempt in range(max_retries):
+        try:
+            conn = _pool_for(db_url).acquire()
+            return conn
+        except Exception as e:
+            if attempt < max_retries - 1:
+                time.sleep(retry_delay)
+                continue
+            report_error(DatabaseUnavailable(f"Erro Crítico de Conexão: {e}"))
+            return None
+
+def get_connection(readonly=False, user_id=None, dsn=None):
+    """Establishes a connection to the PostgreSQL database using secrets with retries.
+
+    Per-user calls (user_id) go to the shard owning that user; dsn targets a database directly.
+    Read-only calls on the primary are routed to a replica when one is configured and healthy,
+    unless the current session, or anyone writing that user's data, wrote in the last
+    REPLICA_STICKY_SECONDS.
+    """
+    primary = config.get_setting("DATABASE_URL")
+    db_url = dsn or (shard_for_user(user_id) if user_id is not None else None) or primary
+    
+    if not db_url:
+        return None
+
+    if (readonly and db_url == primary and not _session_wrote_recently()
+            and (user_id is None or not _user_wrote_recently(user_id))):
+        conn = _connect_replica()
+        if conn: return conn
+
+    return _connect(db_url)
+
+def _scatter(fn, readonly=True):
+    """Runs fn(conn) on every shard in parallel and returns the results of the reachable ones."""
+    if not _sharded():
+        conn = get_connection(readonly=readonly)
+        if not conn: return []
+        try:
+            return [fn(conn)]
+        finally:
+            conn.close()
+
+    def run(url):
+        conn = get_connection(dsn=url)
+        if not conn: return None
+        try:
+            return fn(conn)
+        finally:
+            conn.close()
+
+    urls = _shard_urls()
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        results = list(pool.map(run, urls))
+    return [r for r in results if r is not None]
+
+def _transactions_relkind(c):
+    """Returns 'p' for the partitioned transactions table, 'r' for a legacy plain table, None if missing."""
+    c.execute("""
+        SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = 'transactions' AND n.nspname = current_schema()
+    """)
+    res = c.fetchone()
+    return res[0] if res else None
+
+def _create_year_partition(c, year):
+    """Creates the transactions partition for a year, moving matching rows out of the default partition."""
+    name = f"transactions_y{int(year)}"
+    c.execute("SELECT to_regclass(%s)", (name,))
+    if c.fetchone()[0]:
+        return
+    start, end = datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+    c.execute("SELECT to_regclass('transactions_default')")
+    has_default = c.fetchone()[0] is not None
+    if has_default:
+        # The new range may not overlap rows already sitting in the default partition
+        c.execute(
+            "CREATE TEMP TABLE _moved_transactions AS SELECT * FROM transactions_default WHERE date >= %s AND date < %s",
+            (start, end)
+        )
+        c.execute("DELETE FROM transactions_default WHERE date >= %s AND date < %s", (start, end))
+    c.execute(f"CREATE TABLE {name} PARTITION OF transactions FOR VALUES FROM ('{start}') TO ('{end}')")
+    if has_default:
+        c.execute("INSERT INTO transactions SELECT * FROM _moved_transactions")
+        c.execute("DROP TABLE _moved_transactions")
+
+def _create_transactions_table(c):
+    """Creates the partitioned transactions table, migrating a legacy plain table in place."""
+    relkind = _transactions_relkind(c)
+    if relkind == 'p':
+        return
+
+    if relkind == 'r':
+        # Keep the legacy rows and the id sequence, then swap the table out
+        c.execute("ALTER TABLE transactions RENAME TO transactions_legacy")
+        c.execute("ALTER INDEX IF EXISTS transactions_pkey RENAME TO transactions_legacy_pkey")
+        c.execute("ALTER SEQUENCE IF EXISTS transactions_id_seq OWNED BY NONE")
+
+    c.execute("CREATE SEQUENCE IF NOT EXISTS transactions_id_seq")
+    c.execute('''
+        CREATE TABLE transactions (
+            id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+            user_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            type transaction_type NOT NULL,
+            category_id SMALLINT NOT NULL,
+            amount_cents BIGINT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, date),
+            CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES users (id),
+            CONSTRAINT fk_transaction_category FOREIGN KEY (user_id, category_id)
+                REFERENCES categories (user_id, id) DEFERRABLE INITIALLY DEFERRED
+        ) PARTITION BY RANGE (date)
+    ''')
+    c.execute("ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id")
+    c.execute("CREATE TABLE transactions_default PARTITION OF transactions DEFAULT")
+
+    if relkind == 'r':
+        c.execute("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM transactions_legacy")
+        for (year,) in c.fetchall():
+            _create_year_partition(c, year)
+        _backfill_categories(c, [("transactions_legacy", "COUNT(*)", "MAX(date)")])
+        # LEFT JOIN: a row without its category fails the NOT NULL instead of being skipped
+        c.execute(f'''
+            INSERT INTO transactions ({TRANSACTION_ROW_COLUMNS})
+            SELECT l.id, l.user_id, l.date, l.type::transaction_type, k.id, ROUND(l.amount * 100), l.description, l.created_at
+            FROM transactions_legacy l
+            LEFT JOIN categories k ON k.user_id = l.user_id AND k.type = l.type::transaction_type AND k.name = l.category
+        ''')
+        copied = c.rowcount
+        # Checks the deferred category keys now: pending checks would block the index creation below
+        c.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        c.execute("SELECT COUNT(*) FROM transactions_legacy")
+        legacy = c.fetchone()[0]
+        if copied != legacy:
+            # Raising rolls the whole migration back, legacy table included
+            raise RuntimeError(f"Migração de transactions copiou {copied} de {legacy} linhas; tabela antiga mantida.")
+        c.execute("DROP TABLE transactions_legacy")
+
+def _ensure_transaction_partitions(c, years_ahead=TRANSACTION_PARTITION_YEARS_AHEAD):
+    """Creates partitions for the current and upcoming years and for any rows left in the default partition."""
+    this_year = datetime.date.today().year
+    c.execute("SELECT DISTINCT EXTRACT(YEAR FROM date)::int FROM transactions_default")
+    years = {r[0] for r in c.fetchall()} | set(range(this_year, this_year + years_ahead + 1))
+    for year in sorted(years):
+        _create_year_partition(c, year)
+
+def _year_partitions(c):
+    """Returns {year: partition_name} for the yearly transactions partitions."""
+    c.execute("""
+        SELECT child.relname FROM pg_inherits i
+        JOIN pg_class child ON child.oid = i.inhrelid
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        WHERE parent.relname = 'transactions'
+    """)
+    partitions = {}
+    for (name,) in c.fetchall():
+        match = re.fullmatch(r"transactions_y(\d{4})", name)
+        if match:
+            partitions[int(match.group(1))] = name
+    return partitions
+
+def init_db():
+    """Initializes the PostgreSQL databases (primary and every shard) with necessary tables."""
+    for url in _all_database_urls():
+        _init_database(url)
+
+def _init_database(url):
+    conn = get_connection(dsn=url)
+    if not conn: return
+    
+    c = conn.cursor()
+    
+    # Create Users Table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'user',
+            status TEXT DEFAULT 'active',
+            expiry_date TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Ensure column exists for older databases
+    try:
+        c.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS expiry_date TIMESTAMP")
+    except:
+        pass
+    conn.commit()
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_status ON users (status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry ON users (expiry_date) WHERE status <> 'blocked'")
+    conn.commit()
+    # Trigram index for the admin e-mail search; creating pg_trgm may need extra privileges
+    try:
+        c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING gin (email gin_trgm_ops)")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+    
+    # Compact row layout: enum type, small per-user category id and integer cents
+    c.execute('''
+        DO $$ BEGIN
+            CREATE TYPE transaction_type AS ENUM ('Entrada', 'Saída', 'Investimento');
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$
+    ''')
+    # Categories used per user and type; transactions reference them by (user_id, id)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            user_id INTEGER NOT NULL,
+            id SMALLINT NOT NULL,
+            type transaction_type NOT NULL,
+            name TEXT NOT NULL,
+            usage_count INTEGER NOT NULL DEFAULT 0,
+            last_used DATE,
+            PRIMARY KEY (user_id, id),
+            UNIQUE (user_id, type, name)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_categories_usage ON categories (user_id, type, usage_count DESC, last_used DESC)")
+    c.execute(f'''
+        CREATE OR REPLACE FUNCTION category_id_for(p_user_id INTEGER, p_type transaction_type, p_name TEXT)
+        RETURNS SMALLINT AS $$
+        DECLARE
+            cid SMALLINT;
+        BEGIN
+            SELECT id INTO cid FROM categories WHERE user_id = p_user_id AND type = p_type AND name = p_name;
+            IF cid IS NULL THEN
+                -- Serializes the user's new categories so two never get the same id
+                PERFORM pg_advisory_xact_lock({CATEGORY_LOCK_KEY}, p_user_id);
+                INSERT INTO categories (user_id, id, type, name)
+                SELECT p_user_id, COALESCE(MAX(id), 0) + 1, p_type, p_name FROM categories WHERE user_id = p_user_id
+                ON CONFLICT (user_id, type, name) DO NOTHING;
+                SELECT id INTO cid FROM categories WHERE user_id = p_user_id AND type = p_type AND name = p_name;
+            END IF;
+            RETURN cid;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+
+    # Create Transactions Table (range partitioned by date, one partition per year)
+    _create_transactions_table(c)
+    _ensure_transaction_partitions(c)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)")
+
+    # Cold storage: compressed rows and monthly rollups of archived years
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS transactions_archive (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            payload BYTEA NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_user ON transactions_archive (user_id, year)")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS transactions_rollup (
+            user_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            type transaction_type NOT NULL,
+            category_id SMALLINT NOT NULL,
+            total_cents BIGINT NOT NULL,
+            tx_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, type, category_id)
+        )
+    ''')
+    conn.commit()
+
+    # Triggers, derived tables and views are rebuilt under a lock that blocks writers,
+    # so no row is counted twice or missed
+    c.execute("LOCK TABLE transactions IN SHARE ROW EXCLUSIVE MODE")
+    c.execute("DROP TRIGGER IF EXISTS trg_monthly_totals ON transactions")
+    c.execute("DROP TRIGGER IF EXISTS trg_categories ON transactions")
+    c.execute("DROP TRIGGER IF EXISTS trg_transaction_aggregates ON transactions")
+    c.execute("DROP FUNCTION IF EXISTS track_categories()")
+    c.execute("DROP FUNCTION IF EXISTS track_monthly_totals()")
+    c.execute("DROP VIEW IF EXISTS transaction_details, transaction_ledger, monthly_ledger")
+    _migrate_to_compact_layout(c)
+
+    # Per-user monthly totals of live rows; monthly_ledger adds the archived rollups
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+            user_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            type transaction_type NOT NULL,
+            total_cents BIGINT NOT NULL,
+            tx_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month, type)
+        )
+    ''')
+    # One trigger keeps both the monthly totals and the category usage counters current
+    c.execute('''
+        CREATE OR REPLACE FUNCTION track_transaction_aggregates() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE monthly_totals SET total_cents = total_cents - OLD.amount_cents, tx_count = tx_count - 1
+                WHERE user_id = OLD.user_id AND month = date_trunc('month', OLD.date)::date AND type = OLD.type;
+                DELETE FROM monthly_totals
+                WHERE user_id = OLD.user_id AND month = date_trunc('month', OLD.date)::date AND type = OLD.type
+                  AND tx_count <= 0;
+                UPDATE categories SET usage_count = usage_count - 1
+                WHERE user_id = OLD.user_id AND id = OLD.category_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO monthly_totals (user_id, month, type, total_cents, tx_count)
+                VALUES (NEW.user_id, date_trunc('month', NEW.date)::date, NEW.type, NEW.amount_cents, 1)
+                ON CONFLICT (user_id, month, type) DO UPDATE
+                SET total_cents = monthly_totals.total_cents + EXCLUDED.total_cents,
+                    tx_count = monthly_totals.tx_count + 1;
+                UPDATE categories SET usage_count = usage_count + 1, last_used = GREATEST(last_used, NEW.date)
+                WHERE user_id = NEW.user_id AND id = NEW.category_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_transaction_aggregates AFTER INSERT OR UPDATE OR DELETE ON transactions
+        FOR EACH ROW EXECUTE FUNCTION track_transaction_aggregates()
+    ''')
+    c.execute("DELETE FROM monthly_totals")
+    c.execute('''
+        INSERT INTO monthly_totals (user_id, month, type, total_cents, tx_count)
+        SELECT user_id, date_trunc('month', date)::date, type, SUM(amount_cents), COUNT(*)
+        FROM transactions
+        GROUP BY 1, 2, 3
+    ''')
+
+    # Rows in the shape the app reads them (type and category as text, amount in reais)
+    c.execute(f'''
+        CREATE VIEW transaction_details AS
+            SELECT t.id, t.user_id, t.date, t.type::text AS type, k.name AS category,
+                   {_cents_to_amount("t.amount_cents")} AS amount, t.description, t.created_at
+            FROM transactions t
+            JOIN categories k ON k.user_id = t.user_id AND k.id = t.category_id
+    ''')
+    # Aggregates read live rows plus the rollups of archived years
+    c.execute('''
+        CREATE VIEW transaction_ledger AS
+            SELECT user_id, date, type, category_id, amount_cents FROM transactions
+            UNION ALL
+            SELECT user_id, month AS date, type, category_id, total_cents AS amount_cents FROM transactions_rollup
+    ''')
+    c.execute('''
+        CREATE VIEW monthly_ledger AS
+            SELECT user_id, month, type, total_cents FROM monthly_totals
+            UNION ALL
+            SELECT user_id, month, type, total_cents FROM transactions_rollup
+    ''')
+    conn.commit()
+    
+    # Revoked session tokens (denylist checked by auth with a short cache)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revoked_sessions (
+            jti TEXT PRIMARY KEY,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.commit()
+
+    # Background jobs (core.jobs); workers only use the primary's queue
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER,
+            kind TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}',
+            payload BYTEA,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result JSONB,
+            output BYTEA,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+            run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            worker TEXT,
+            heartbeat_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (run_after, id) WHERE status = 'queued'")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (user_id) WHERE status = 'running'")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, kind, id DESC)")
+    # Rows committed by each import job, written in the same transaction as the rows themselves
+    # (on the user's shard, where the jobs table may not be)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS import_progress (
+            job_id BIGINT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            imported INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    # FinanBot conversations; the summary folds every turn up to covers_until
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_user ON chat_messages (user_id, created_at DESC, id DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_search ON chat_messages USING gin (to_tsvector('portuguese', content))")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covers_until TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    # Spending anomalies found by the detect_anomalies job; period is the month or the day flagged
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS spending_anomalies (
+            user_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            kind TEXT NOT NULL,
+            category TEXT NOT NULL DEFAULT '',
+            period DATE NOT NULL,
+            amount DECIMAL(15,2) NOT NULL,
+            baseline DECIMAL(15,2) NOT NULL,
+            score REAL NOT NULL,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, month, kind, category, period)
+        )
+    ''')
+    conn.commit()
+
+    # Create Goals Table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS goals (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            target_amount DECIMAL(15,2) NOT NULL,
+            category_link TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            CONSTRAINT fk_user_goal FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Version of each user's data, bumped by every write to the tables the per-user cache reads,
+    # so processes can tell their cached reads are stale (writes made elsewhere)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_data_versions (
+            user_id INTEGER PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 1,
+            written_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+        )
+    ''')
+    c.execute('''
+        CREATE OR REPLACE FUNCTION bump_user_data_version() RETURNS trigger AS $$
+        DECLARE
+            uid INTEGER;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN uid := OLD.user_id; ELSE uid := NEW.user_id; END IF;
+            INSERT INTO user_data_versions (user_id) VALUES (uid)
+            ON CONFLICT (user_id) DO UPDATE
+            SET version = user_data_versions.version + 1, written_at = clock_timestamp();
+            IF TG_OP = 'UPDATE' AND OLD.user_id <> NEW.user_id THEN
+                INSERT INTO user_data_versions (user_id) VALUES (OLD.user_id)
+                ON CONFLICT (user_id) DO UPDATE
+                SET version = user_data_versions.version + 1, written_at = clock_timestamp();
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    for table in ("transactions", "transactions_rollup", "transactions_archive", "goals"):
+        c.execute(f"DROP TRIGGER IF EXISTS trg_user_data_version ON {table}")
+        c.execute(f'''
+            CREATE TRIGGER trg_user_data_version AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION bump_user_data_version()
+        ''')
+
+    c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    c.execute("DELETE FROM schema_version")
+    c.execute("INSERT INTO schema_version (version) VALUES (%s)", (SCHEMA_VERSION,))
+    conn.commit()
+    conn.close()
+
+def _column_type(c, table, column):
+    """Returns the type name of a column ('text', 'numeric', 'transaction_type', ...), None if it does not exist."""
+    c.execute(
+        "SELECT udt_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s",
+        (table, column)
+    )
+    res = c.fetchone()
+    return res[0] if res else None
+
+def _backfill_categories(c, sources):
+    """Adds to the category dictionary the (type, name) pairs found in text-layout tables.
+
+    sources are (table, usage expression, last-used expression); new ids continue after each
+    user's highest one, most used first.
+    """
+    used = " UNION ALL ".join(
+        f"SELECT user_id, type::text::transaction_type AS type, category AS name, {n} AS n, {last} AS last_used "
+        f"FROM {table} GROUP BY 1, 2, 3"
+        for table, n, last in sources
+    )
+    c.execute(f'''
+        WITH used AS ({used}), missing AS (
+            SELECT u.user_id, u.type, u.name, SUM(u.n) AS n, MAX(u.last_used) AS last_used
+            FROM used u
+            WHERE NOT EXISTS (
+                SELECT 1 FROM categories k WHERE k.user_id = u.user_id AND k.type = u.type AND k.name = u.name
+            )
+            GROUP BY 1, 2, 3
+        )
+        INSERT INTO categories (user_id, id, type, name, usage_count, last_used)
+        SELECT m.user_id,
+               COALESCE((SELECT MAX(k.id) FROM categories k WHERE k.user_id = m.user_id), 0)
+                   + ROW_NUMBER() OVER (PARTITION BY m.user_id ORDER BY m.n DESC, m.type, m.name),
+               m.type, m.name, m.n, m.last_used
+        FROM missing m
+    ''')
+
+def _migrate_to_compact_layout(c):
+    """Converts tables still in the text layout (type/category TEXT, amount DECIMAL) in place; no-op when current."""
+    if _column_type(c, "categories", "type") == "text":
+        c.execute("ALTER TABLE categories ALTER COLUMN type TYPE transaction_type USING type::transaction_type")
+
+    if _column_type(c, "transactions", "amount") is not None:
+        sources = [("transactions", "COUNT(*)", "MAX(date)")]
+        if _column_type(c, "transactions_rollup", "category") is not None:
+            sources.append(("transactions_rollup", "SUM(tx_count)", "MAX(month)"))
+        _backfill_categories(c, sources)
+        c.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS category_id SMALLINT, ADD COLUMN amount_cents BIGINT")
+        c.execute('''
+            UPDATE transactions t SET category_id = k.id, amount_cents = ROUND(t.amount * 100)
+            FROM categories k
+            WHERE k.user_id = t.user_id AND k.type = t.type::transaction_type AND k.name = t.category
+        ''')
+        c.execute("SELECT COUNT(*) FROM transactions WHERE category_id IS NULL")
+        unmatched = c.fetchone()[0]
+        if unmatched:
+            # Dropping the text columns would lose these rows' categories
+            raise RuntimeError(f"{unmatched} transações sem categoria correspondente; migração cancelada.")
+        c.execute('''
+            ALTER TABLE transactions
+                ALTER COLUMN type TYPE transaction_type USING type::transaction_type,
+                ALTER COLUMN category_id SET NOT NULL,
+                ALTER COLUMN amount_cents SET NOT NULL,
+                DROP COLUMN category,
+                DROP COLUMN amount,
+                ADD CONSTRAINT fk_transaction_category FOREIGN KEY (user_id, category_id)
+                    REFERENCES categories (user_id, id) DEFERRABLE INITIALLY DEFERRED
+        ''')
+
+    if _column_type(c, "transactions_rollup", "total") is not None:
+        c.execute("ALTER TABLE transactions_rollup ADD COLUMN category_id SMALLINT, ADD COLUMN total_cents BIGINT")
+        c.execute('''
+            UPDATE transactions_rollup r SET category_id = k.id, total_cents = ROUND(r.total * 100)
+            FROM categories k
+            WHERE k.user_id = r.user_id AND k.type = r.type::transaction_type AND k.name = r.category
+        ''')
+        c.execute('''
+            ALTER TABLE transactions_rollup
+                DROP CONSTRAINT IF EXISTS transactions_rollup_pkey,
+                ALTER COLUMN type TYPE transaction_type USING type::transaction_type,
+                ALTER COLUMN category_id SET NOT NULL,
+                ALTER COLUMN total_cents SET NOT NULL,
+                DROP COLUMN category,
+                DROP COLUMN total,
+                ADD PRIMARY KEY (user_id, month, type, category_id)
+        ''')
+
+    # Derived from transactions; recreated and rebuilt by _init_database
+    if _column_type(c, "monthly_totals", "total") is not None:
+        c.execute("DROP TABLE monthly_totals")
+
+def _cents_to_amount(expr):
+    """SQL turning an integer-cents expression back into the DECIMAL(15,2) amount the app works with."""
+    return f"({expr} / 100.0)::numeric(15,2)"
+
+def _schema_version(c):
+    """Returns the recorded schema version, 0 for a database that was never initialized."""
+    c.execute("SELECT to_regclass('schema_version')")
+    if c.fetchone()[0] is None:
+        return 0
+    c.execute("SELECT MAX(version) FROM schema_version")
+    res = c.fetchone()
+    return res[0] or 0
+
+def ensure_schema():
+    """Boot-time check: migrates only databases behind SCHEMA_VERSION and adds missing yearly partitions.
+
+    Costs one catalog query per database when everything is current; meant to run once per
+    server process (or via `python database.py init` at deploy).
+    """
+    this_year = datetime.date.today().year
+    for url in _all_database_urls():
+        conn = get_connection(dsn=url)
+        if not conn: continue
+        c = conn.cursor()
+        current = _schema_version(c)
+        if current < SCHEMA_VERSION:
+            conn.close()
+            logger.info("Migrating schema of %s from version %s to %s", re.sub(r"//[^@/]*@", "//", url), current, SCHEMA_VERSION)
+            _init_database(url)
+            continue
+        c.execute("SELECT to_regclass(%s)", (f"transactions_y{this_year + TRANSACTION_PARTITION_YEARS_AHEAD}",))
+        if c.fetchone()[0] is None:
+            _ensure_transaction_partitions(c)
+            conn.commit()
+        conn.close()
+
+def _note_user_write(user_id, written_at):
+    """Records the last known write to a user's data; callers hold _user_cache_lock."""
+    _user_writes[user_id] = max(_user_writes.get(user_id, 0), written_at)
+    if len(_user_writes) > USER_CACHE_MAX_USERS:
+        # Writes older than the sticky window no longer matter
+        sticky = float(config.get_setting("REPLICA_STICKY_SECONDS", REPLICA_STICKY_SECONDS))
+        for uid in [u for u, t in _user_writes.items() if time.time() - t >= sticky]:
+            del _user_writes[uid]
+
+def _check_user_version(user_id):
+    """Drops the user's cached reads when their data version moved since the last check.
+
+    Checks on the primary (or shard) at most every USER_CACHE_CHECK_INTERVAL seconds, so writes
+    from the API, the workers or other app processes are seen within that interval; a write
+    younger than REPLICA_STICKY_SECONDS also keeps this process's reads of the user off replicas.
+    """
+    now = time.time()
+    with _user_cache_lock:
+        known = _user_versions.get(user_id)
+        if known and now - known[1] < USER_CACHE_CHECK_INTERVAL:
+            return
+        # Claims the check so concurrent lookups do not repeat it
+        _user_versions[user_id] = (known[0] if known else None, now)
+
+    conn = get_connection(user_id=user_id)
+    if not conn: return
+    try:
+        c = conn.cursor()
+        c.execute(
+            "SELECT version, EXTRACT(EPOCH FROM clock_timestamp() - written_at) FROM user_data_versions WHERE user_id = %s",
+            (user_id,)
+        )
+        row = c.fetchone()
+        conn.commit()
+    except Exception as e:
+        logger.warning("Data version check for user %s failed: %s", user_id, e)
+        return
+    finally:
+        conn.close()
+
+    version, age = (row[0], float(row[1])) if row else (0, None)
+    with _user_cache_lock:
+        if known is None or known[0] != version:
+            _user_cache.pop(user_id, None)
+        _user_versions[user_id] = (version, now)
+        if age is not None:
+            _note_user_write(user_id, now - age)
+
+def _per_user_cache(fn):
+    """Serves fn(user_id, ...) from the per-user cache.
+
+    Callers asking for an entry that is still loading wait for that query instead of running
+    their own. Results are copies, since the pages add columns to the frames they get. Empty
+    frames and lists are not kept: they are cheap to recompute and also what a failed
+    connection returns. Entries are dropped when the user's data version moves (see
+    _check_user_version), whichever process wrote.
+    """
+    @functools.wraps(fn)
+    def wrapper(user_id, *args, **kwargs):
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        _check_user_version(user_id)
+        now = time.time()
+        with _user_cache_lock:
+            entries = _user_cache.setdefault(user_id, {})
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > USER_CACHE_MAX_USERS:
+                evicted, _ = _user_cache.popitem(last=False)
+                _user_versions.pop(evicted, None)
+            entry = entries.get(key)
+            load = entry is None or now - entry[0] > USER_CACHE_TTL
+            if load:
+                future = Future()
+                entries[key] = (now, future)
+            else:
+                future = entry[1]
+
+        if load:
+            try:
+                value = fn(user_id, *args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                with _user_cache_lock:
+                    if entries.get(key, (None, None))[1] is future:
+                        del entries[key]
+                raise
+            future.set_result(value)
+            frames = value if isinstance(value, tuple) else (value,)
+            if all(isinstance(f, (pd.DataFrame, list)) and len(f) == 0 for f in frames):
+                with _user_cache_lock:
+                    if entries.get(key, (None, None))[1] is future:
+                        del entries[key]
+
+        value = future.result()
+        return value.copy() if isinstance(value, pd.DataFrame) else copy.deepcopy(value)
+    return wrapper
+
+def invalidate_user_cache(user_id):
+    """Drops every cached read of a user; the user's writes call it.
+
+    Also keeps the user's reads in this process off replicas for REPLICA_STICKY_SECONDS.
+    """
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+        _user_versions.pop(user_id, None)
+        _note_user_write(user_id, time.time())
+
+def prefetch_user_data(user_id, calls):
+    """Starts the reads every tab needs on the prefetch pool and returns their futures without waiting.
+
+    calls are (fn, *args) with fn a per-user cached read taking user_id first; the results land
+    in the per-user cache, so a tab shown later is served from memory.
+    """
+    def load(fn, args):
+        try:
+            fn(user_id, *args)
+        except Exception as e:
+            logger.warning("Prefetch of %s for user %s failed: %s", fn.__name__, user_id, e)
+
+    return [_prefetch_pool.submit(load, fn, args) for fn, *args in calls]
+
+_NO_CONNECTION = "Erro de conexão: DATABASE_URL não encontrada ou inválida na configuração."
+
+def run_query(query, params=(), return_data=False, user_id=None, invalidate=True):
+    """Runs one SQL statement, on the shard of user_id when given.
+
+    Returns the fetched rows (return_data) or the number of rows written; raises
+    DatabaseUnavailable or QueryError.
+    A write for a user drops their cached reads unless invalidate is False (tables no cached read uses).
+    """
+    conn = get_connection(user_id=user_id)
+    if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+    
+    c = conn.cursor()
+    try:
+        c.execute(query, params)
+        if return_data:
+            return c.fetchall()
+        affected = c.rowcount
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+    _mark_session_write()
+    if user_id is not None and invalidate:
+        # After the commit, so a read racing the write cannot cache the old rows
+        invalidate_user_cache(user_id)
+    return affected
+
+def get_users_df():
+    """Returns a pandas DataFrame of all users (without password hashes), gathered from every shard."""
+    query = f"SELECT {USER_DIRECTORY_COLUMNS} FROM users"
+    frames = _scatter(lambda conn: pd.read_sql_query(query, conn))
+    frames = [f for f in frames if not f.empty]
+    if not frames: return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).sort_values('id', ignore_index=True)
+
+def _user_directory_filter(search=None, status=None):
+    """Builds the WHERE clauses shared by the directory page and its counts."""
+    clauses, params = [], []
+    if search:
+        # ILIKE '%term%' is served by the trigram index; LIKE wildcards typed in the search are literal
+        term = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        clauses.append("email ILIKE %s")
+        params.append(f"%{term}%")
+    if status:
+        clauses.append("status = %s")
+        params.append(status)
+    return clauses, params
+
+def get_user_directory(search=None, status=None, after_id=None, limit=USER_DIRECTORY_PAGE_SIZE):
+    """Returns one page of users ordered by id, starting after after_id (keyset pagination)."""
+    clauses, params = _user_directory_filter(search, status)
+    if after_id is not None:
+        clauses.append("id > %s")
+        params.append(int(after_id))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"SELECT {USER_DIRECTORY_COLUMNS} FROM users {where} ORDER BY id LIMIT %s"
+    params = tuple(params) + (int(limit),)
+
+    frames = _scatter(lambda conn: pd.read_sql_query(query, conn, params=params))
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=[col.strip() for col in USER_DIRECTORY_COLUMNS.split(",")])
+    # Every shard returned its first rows after the cursor, so the page is the smallest ids overall
+    return pd.concat(frames).sort_values('id').head(limit).reset_index(drop=True)
+
+def get_user_status_counts(search=None):
+    """Returns {status: count} for users matching search, summed across shards."""
+    clauses, params = _user_directory_filter(search)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    def count(conn):
+        c = conn.cursor()
+        c.execute(f"SELECT status, COUNT(*) FROM users {where} GROUP BY status", tuple(params))
+        return c.fetchall()
+
+    counts = {}
+    for rows in _scatter(count):
+        for status, total in rows:
+            counts[status] = counts.get(status, 0) + total
+    return counts
+
+def find_user_by_email(email):
+    """Looks a user up by email on every shard. Returns rows like run_query(return_data=True)."""
+    query = "SELECT id, email, password_hash, role, status, expiry_date FROM users WHERE email = %s"
+    if not _sharded():
+        return run_query(query, (email,), return_data=True)
+
+    def lookup(conn):
+        c = conn.cursor()
+        c.execute(query, (email,))
+        return c.fetchall()
+
+    try:
+        return [row for rows in _scatter(lookup, readonly=False) for row in rows]
+    except Exception as e:
+        raise QueryError(str(e)) from e
+
+def create_user(email, password_hash, role='user', status='pending'):
+    """Creates a user on its shard. Ids come from the primary's sequence so they are unique across shards."""
+    if not _sharded():
+        return run_query(
+            "INSERT INTO users (email, password_hash, role, status) VALUES (%s, %s, %s, %s)",
+            (email, password_hash, role, status)
+        )
+    ids = run_query("SELECT nextval('users_id_seq')", return_data=True)
+    user_id = ids[0][0]
+    return run_query(
+        "INSERT INTO users (id, email, password_hash, role, status) VALUES (%s, %s, %s, %s, %s)",
+        (user_id, email, password_hash, role, status), user_id=user_id
+    )
+
+def revoke_session(jti, expires_at):
+    """Adds a session token id to the denylist until the token would have expired anyway."""
+    run_query("DELETE FROM revoked_sessions WHERE expires_at < now()")
+    return run_query(
+        "INSERT INTO revoked_sessions (jti, expires_at) VALUES (%s, %s) ON CONFLICT (jti) DO NOTHING",
+        (jti, expires_at)
+    )
+
+def get_revoked_sessions():
+    """Returns the set of revoked session token ids that have not expired yet."""
+    try:
+        rows = run_query("SELECT jti FROM revoked_sessions WHERE expires_at >= now()", return_data=True)
+    except (DatabaseUnavailable, QueryError) as e:
+        report_error(e)
+        return set()
+    return {r[0] for r in rows}
+
+def _bulk_update_users(query, user_ids, params=()):
+    """Runs a statement ending in `id = ANY(%s)` once per shard, each in a single transaction.
+
+    Returns the number of affected users; raises DatabaseUnavailable or QueryError.
+    """
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(int(user_id)), []).append(int(user_id))
+
+    affected = 0
+    for url, ids in by_shard.items():
+        conn = get_connection(dsn=url)
+        if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+        c = conn.cursor()
+        try:
+            c.execute(query, tuple(params) + (ids,))
+            affected += c.rowcount
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise QueryError(str(e)) from e
+        finally:
+            conn.close()
+    _mark_session_write()
+    return affected
+
+def set_users_status(user_ids, status):
+    """Sets the status ('active', 'blocked', ...) of several users at once."""
+    return _bulk_update_users("UPDATE users SET status = %s WHERE id = ANY(%s)", user_ids, (status,))
+
+def set_users_role(user_ids, role):
+    """Sets the role of several users at once."""
+    return _bulk_update_users("UPDATE users SET role = %s WHERE id = ANY(%s)", user_ids, (role,))
+
+def set_users_expiry(user_ids, expiry_date):
+    """Sets the access expiry date of several users at once."""
+    return _bulk_update_users("UPDATE users SET expiry_date = %s WHERE id = ANY(%s)", user_ids, (expiry_date,))
+
+def delete_users(user_ids):
+    """Deletes several users at once."""
+    return _bulk_update_users("DELETE FROM users WHERE id = ANY(%s)", user_ids)
+
+@_per_user_cache
+def get_transactions_df(user_id):
+    """Returns a pandas DataFrame of transactions for a specific user."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame()
+    df = pd.read_sql_query(f"SELECT {TRANSACTION_COLUMNS} FROM transaction_details WHERE user_id = %s", conn, params=(user_id,))
+    archived = _load_archived_transactions(conn, user_id)
+    conn.close()
+    if not archived.empty:
+        df = pd.concat([archived, df], ignore_index=True)
+    return df
+
+def get_transactions_page(user_id, start=None, end=None, type_filter=None, limit=TRANSACTION_PAGE_SIZE, offset=0):
+    """Returns (page DataFrame, total rows) of a user's transactions in [start, end), newest first.
+
+    Live rows are paged in SQL; only when the range reaches an archived year are the archived
+    rows decompressed and merged in memory. The 'archived' column marks those read-only rows.
+    """
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame(), 0
+
+    clauses, params = ["user_id = %s"], [user_id]
+    if start is not None:
+        clauses.append("date >= %s")
+        params.append(start)
+    if end is not None:
+        clauses.append("date < %s")
+        params.append(end)
+    if type_filter:
+        clauses.append("type = %s")
+        params.append(type_filter)
+    where = " AND ".join(clauses)
+
+    c = conn.cursor()
+    c.execute("SELECT DISTINCT year FROM transactions_archive WHERE user_id = %s", (user_id,))
+    archived_years = {r[0] for r in c.fetchall()}
+    first_year = start.year if start is not None else None
+    last_year = (end - datetime.timedelta(days=1)).year if end is not None else None
+    touches_archive = any(
+        (first_year is None or y >= first_year) and (last_year is None or y <= last_year)
+        for y in archived_years
+    )
+
+    if not touches_archive:
+        c.execute(f"SELECT COUNT(*) FROM transactions WHERE {where}", tuple(params))
+        total = c.fetchone()[0]
+        df = pd.read_sql_query(
+            f"SELECT {TRANSACTION_COLUMNS} FROM transaction_details WHERE {where} ORDER BY date DESC, id DESC LIMIT %s OFFSET %s",
+            conn, params=tuple(params) + (int(limit), int(offset))
+        )
+        conn.close()
+        df['archived'] = False
+        return df, total
+
+    df = pd.read_sql_query(f"SELECT {TRANSACTION_COLUMNS} FROM transaction_details WHERE {where}", conn, params=tuple(params))
+    df['archived'] = False
+    archived = _load_archived_transactions(conn, user_id)
+    conn.close()
+    if not archived.empty:
+        archived['archived'] = True
+        keep = pd.Series(True, index=archived.index)
+        if start is not None: keep &= archived['date'] >= start
+        if end is not None: keep &= archived['date'] < end
+        if type_filter: keep &= archived['type'] == type_filter
+        df = pd.concat([archived[keep], df], ignore_index=True)
+    df = df.sort_values(['date', 'id'], ascending=False, ignore_index=True)
+    return df.iloc[offset:offset + limit].reset_index(drop=True), len(df)
+
+def _load_archived_transactions(conn, user_id):
+    """Decompresses a user's archived years back into transaction rows."""
+    c = conn.cursor()
+    c.execute("SELECT payload FROM transactions_archive WHERE user_id = %s ORDER BY year", (user_id,))
+    rows = []
+    for (payload,) in c.fetchall():
+        rows.extend(json.loads(zlib.decompress(bytes(payload))))
+    c.close()
+    if not rows: return pd.DataFrame()
+
+    df = pd.DataFrame(rows, columns=[col.strip() for col in TRANSACTION_COLUMNS.split(",")])
+    # Same Python types psycopg2 returns for live rows
+    df['date'] = df['date'].map(datetime.date.fromisoformat)
+    df['amount'] = df['amount'].map(Decimal)
+    df['created_at'] = df['created_at'].map(lambda v: datetime.datetime.fromisoformat(v) if v else None)
+    return df
+
+def add_transaction(user_id, date, type, category, amount, description):
+    """Adds a new transaction."""
+    return run_query(
+        "INSERT INTO transactions (user_id, date, type, category_id, amount_cents, description) "
+        "VALUES (%s, %s, %s, category_id_for(%s, %s, %s), ROUND(%s::numeric * 100), %s)",
+        (user_id, date, type, user_id, type, category, amount, description), user_id=user_id
+    )
+
+def add_transactions(user_id, rows, import_job=None):
+    """Adds several transactions of a user in one statement; rows are (date, type, category, amount, description).
+
+    import_job=(job_id, imported) records the import's progress in the same transaction, so a
+    retry resumes exactly after the committed rows (see get_import_progress).
+    """
+    if not rows: return True
+    conn = get_connection(user_id=user_id)
+    if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+
+    c = conn.cursor()
+    try:
+        psycopg2.extras.execute_values(
+            c,
+            "INSERT INTO transactions (user_id, date, type, category_id, amount_cents, description) "
+            "SELECT v.user_id, v.date::date, v.type::transaction_type, "
+            "category_id_for(v.user_id, v.type::transaction_type, v.category), ROUND(v.amount::numeric * 100), v.description "
+            "FROM (VALUES %s) AS v (user_id, date, type, category, amount, description)",
+            [(user_id, *row) for row in rows]
+        )
+        if import_job is not None:
+            c.execute(
+                "INSERT INTO import_progress (job_id, user_id, imported) VALUES (%s, %s, %s) "
+                "ON CONFLICT (job_id) DO UPDATE SET imported = EXCLUDED.imported, updated_at = CURRENT_TIMESTAMP",
+                (import_job[0], user_id, import_job[1])
+            )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+    _mark_session_write()
+    invalidate_user_cache(user_id)
+    return True
+
+def get_import_progress(user_id, job_id):
+    """Rows an import job has committed for the user so far (0 before its first batch)."""
+    rows = run_query(
+        "SELECT imported FROM import_progress WHERE job_id = %s AND user_id = %s",
+        (job_id, user_id), return_data=True, user_id=user_id
+    )
+    return rows[0][0] if rows else 0
+
+def update_transaction(transaction_id, date, type, category, amount, description, user_id):
+    """Updates a live transaction; returns 0 when none matched (deleted, archived or another user's)."""
+    return run_query(
+        "UPDATE transactions SET date=%s, type=%s, category_id=category_id_for(%s, %s, %s), amount_cents=ROUND(%s::numeric * 100), "
+        "description=%s WHERE id=%s AND user_id=%s",
+        (date, type, user_id, type, category, amount, description, transaction_id, user_id), user_id=user_id
+    )
+
+def delete_transaction(transaction_id, user_id):
+    """Deletes a live transaction; returns the number of rows deleted (0 or 1)."""
+    return run_query("DELETE FROM transactions WHERE id = %s AND user_id = %s", (transaction_id, user_id), user_id=user_id)
+
+def delete_transactions(transaction_ids, user_id):
+    """Deletes several live transactions of a user in one statement; returns how many were deleted."""
+    return run_query(
+        "DELETE FROM transactions WHERE user_id = %s AND id = ANY(%s)",
+        (user_id, [int(i) for i in transaction_ids]), user_id=user_id
+    )
+
+def create_goal(user_id, name, target, category):
+    """Creates a new investment goal."""
+    return run_query(
+        "INSERT INTO goals (user_id, name, target_amount, category_link) VALUES (%s, %s, %s, %s)", 
+        (user_id, name, target, category), user_id=user_id
+    )
+
+def update_goal_target(user_id, category, new_target):
+    """Updates the target amount for a specific category goal."""
+    conn = get_connection(user_id=user_id)
+    if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+    c = conn.cursor()
+    # Check if goal exists
+    c.execute("SELECT id FROM goals WHERE user_id = %s AND category_link = %s", (user_id, category))
+    exists = c.fetchone()
+    if exists:
+        c.execute("UPDATE goals SET target_amount = %s WHERE user_id = %s AND category_link = %s", (new_target, user_id, category))
+    else:
+        # Create if doesn't exist
+        c.execute("INSERT INTO goals (user_id, name, target_amount, category_link) VALUES (%s, %s, %s, %s)", 
+                     (user_id, f"Meta: {category}", new_target, category))
+    conn.commit()
+    conn.close()
+    _mark_session_write()
+    invalidate_user_cache(user_id)
+    return True
+
+def delete_goal(goal_id, user_id):
+    """Deletes a goal of the user; returns the number of rows deleted (0 or 1)."""
+    return run_query("DELETE FROM goals WHERE id = %s AND user_id = %s", (goal_id, user_id), user_id=user_id)
+
+@_per_user_cache
+def get_goals(user_id):
+    """Returns list of goals for user."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame()
+    df = pd.read_sql_query("SELECT * FROM goals WHERE user_id = %s", conn, params=(user_id,))
+    conn.close()
+    return df
+
+def get_goal_progress(user_id, category_link):
+    """Calculates total invested in a specific category."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return 0.0
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT SUM(amount_cents) FROM transaction_ledger
+        WHERE user_id = %s AND type = 'Investimento'
+        AND category_id = (SELECT id FROM categories WHERE user_id = %s AND type = 'Investimento' AND name = %s)
+        """,
+        (user_id, user_id, category_link)
+    )
+    res = c.fetchone()
+    total = int(res[0]) / 100 if res and res[0] is not None else 0.0
+    conn.close()
+    return total
+
+def month_bounds(month, year):
+    """Returns the [start, end) dates of a month."""
+    start = datetime.date(int(year), int(month), 1)
+    end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+def get_monthly_summary(user_id, month, year):
+    """Calculates totals for a specific month."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return 0.0, 0.0, 0.0
+    c = conn.cursor()
+    # Date range instead of EXTRACT() so partitions are pruned and the index is used
+    start, end = month_bounds(month, year)
+    c.execute(
+        "SELECT type, SUM(amount_cents) FROM transaction_ledger WHERE user_id = %s AND date >= %s AND date < %s GROUP BY type",
+        (user_id, start, end)
+    )
+    totals = {type_: int(cents) / 100 for type_, cents in c.fetchall()}
+    income = totals.get('Entrada', 0.0)
+    expense = totals.get('Saída', 0.0)
+    investment = totals.get('Investimento', 0.0)
+    
+    conn.close()
+    return income, expense, investment
+
+@_per_user_cache
+def get_monthly_series(user_id, month=None, year=None, months=12):
+    """Returns the last `months` months (ending at month/year, default the current one) of totals per type.
+
+    One grouped query over the precomputed monthly totals; DataFrame indexed by month start with
+    'Entrada', 'Saída', 'Investimento' and 'Saldo' columns, months without data filled with zeros.
+    """
+    today = datetime.date.today()
+    last_start, end = month_bounds(month or today.month, year or today.year)
+    start = (pd.Timestamp(last_start) - pd.DateOffset(months=months - 1)).date()
+    index = pd.date_range(start, last_start, freq='MS')
+    columns = ['Entrada', 'Saída', 'Investimento']
+
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn:
+        series = pd.DataFrame(0.0, index=index, columns=columns)
+    else:
+        c = conn.cursor()
+        c.execute(
+            "SELECT month, type, SUM(total_cents) / 100.0 FROM monthly_ledger WHERE user_id = %s AND month >= %s AND month < %s GROUP BY month, type",
+            (user_id, start, end)
+        )
+        rows = c.fetchall()
+        conn.close()
+        series = pd.DataFrame(rows, columns=['month', 'type', 'total'])
+        series['month'] = pd.to_datetime(series['month'])
+        series['total'] = series['total'].astype(float)
+        series = series.pivot_table(index='month', columns='type', values='total', aggfunc='sum')
+        series = series.reindex(index=index, columns=columns).fillna(0.0)
+
+    series['Saldo'] = series['Entrada'] - series['Saída'] - series['Investimento']
+    return series
+
+def _load_expense_history(conn, user_ids, month, months, days):
+    """(monthly, daily) expense aggregates of user_ids up to the end of `month` (a month start date).
+
+    monthly: user_id, month, category, total over the `months` months before it plus the month
+    itself; daily: user_id, date, total over the `days` days before it plus the month.
+    """
+    start, end = month_bounds(month.month, month.year)
+    month_from = (pd.Timestamp(start) - pd.DateOffset(months=months)).date()
+    day_from = start - datetime.timedelta(days=days)
+    monthly = pd.read_sql_query(
+        f"""
+        SELECT s.user_id, s.month, k.name AS category, s.total
+        FROM (
+            SELECT user_id, date_trunc('month', date)::date AS month, category_id,
+                   {_cents_to_amount("SUM(amount_cents)")} AS total
+            FROM transaction_ledger
+            WHERE user_id = ANY(%s) AND type = 'Saída' AND date >= %s AND date < %s
+            GROUP BY 1, 2, 3
+        ) s
+        JOIN categories k ON k.user_id = s.user_id AND k.id = s.category_id
+        """,
+        conn, params=(user_ids, month_from, end)
+    )
+    daily = pd.read_sql_query(
+        f"""
+        SELECT user_id, date, {_cents_to_amount("SUM(amount_cents)")} AS total
+        FROM transactions
+        WHERE user_id = ANY(%s) AND type = 'Saída' AND date >= %s AND date < %s
+        GROUP BY 1, 2
+        """,
+        conn, params=(user_ids, day_from, end)
+    )
+    for frame, column in ((monthly, 'month'), (daily, 'date')):
+        frame[column] = pd.to_datetime(frame[column])
+        frame['total'] = frame['total'].astype(float)
+    return monthly, daily
+
+@_per_user_cache
+def get_expense_history(user_id, month, months=12, days=90):
+    """The user's (monthly, daily) expense aggregates for anomaly detection (see _load_expense_history)."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame(), pd.DataFrame()
+    try:
+        return _load_expense_history(conn, [user_id], month, months, days)
+    finally:
+        conn.close()
+
+def get_expense_history_for_users(user_ids, month, months=12, days=90):
+    """Same as get_expense_history for many users at once, one query pair per shard."""
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(int(user_id)), []).append(int(user_id))
+
+    monthly, daily = [], []
+    for url, ids in by_shard.items():
+        conn = get_connection(readonly=True, dsn=url)
+        if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+        try:
+            m, d = _load_expense_history(conn, ids, month, months, days)
+        except Exception as e:
+            raise QueryError(str(e)) from e
+        finally:
+            conn.close()
+        monthly.append(m)
+        daily.append(d)
+    if not monthly: return pd.DataFrame(), pd.DataFrame()
+    return pd.concat(monthly, ignore_index=True), pd.concat(daily, ignore_index=True)
+
+def save_spending_anomalies(user_ids, month, anomalies):
+    """Replaces the stored anomalies of user_ids for `month` with the rows of `anomalies`.
+
+    anomalies has user_id, kind, category, period, amount, baseline and score (core.anomalies.detect).
+    """
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(int(user_id)), []).append(int(user_id))
+
+    for url, ids in by_shard.items():
+        rows = [
+            (int(r.user_id), month, r.kind, r.category or '', r.period.date(), round(r.amount, 2), round(r.baseline, 2), float(r.score))
+            for r in anomalies[anomalies['user_id'].isin(ids)].itertuples()
+        ]
+        conn = get_connection(dsn=url)
+        if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM spending_anomalies WHERE user_id = ANY(%s) AND month = %s", (ids, month))
+            if rows:
+                psycopg2.extras.execute_values(
+                    c, "INSERT INTO spending_anomalies (user_id, month, kind, category, period, amount, baseline, score) VALUES %s", rows
+                )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise QueryError(str(e)) from e
+        finally:
+            conn.close()
+
+@_per_user_cache
+def get_all_categories(user_id, type_filter):
+    """Returns the categories used by user for a specific type, most used first."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return []
+    c = conn.cursor()
+    c.execute(
+        "SELECT name FROM categories WHERE user_id = %s AND type = %s AND usage_count > 0 ORDER BY usage_count DESC, last_used DESC",
+        (user_id, type_filter)
+    )
+    rows = c.fetchall()
+    conn.close()
+    return [r[0] for r in rows]
+
+@_per_user_cache
+def get_portfolio_summary(user_id, as_of_date=None):
+    """Returns total accumulated investments by category, optionally up to a specific date."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame()
+    
+    # Summed per category id, names joined only onto the aggregated rows
+    date_filter = " AND date <= %s" if as_of_date else ""
+    query = f"""
+        SELECT k.name AS category, s.total
+        FROM (
+            SELECT category_id, {_cents_to_amount("SUM(amount_cents)")} AS total
+            FROM transaction_ledger
+            WHERE user_id = %s AND type = 'Investimento'{date_filter}
+            GROUP BY category_id
+        ) s
+        JOIN categories k ON k.user_id = %s AND k.id = s.category_id
+        ORDER BY s.total DESC
+    """
+    params = [user_id] + ([as_of_date] if as_of_date else []) + [user_id]
+    
+    df = pd.read_sql_query(query, conn, params=tuple(params))
+    conn.close()
+    return df
+
+@_per_user_cache
+def get_portfolio_evolution(user_id):
+    """Returns monthly evolution of total investments."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return pd.DataFrame()
+    # Postgres TO_CHAR for date formatting
+    df = pd.read_sql_query(
+        f"""
+        SELECT 
+            TO_CHAR(date, 'YYYY-MM') as month,
+            {_cents_to_amount("SUM(amount_cents)")} as monthly_total
+        FROM transaction_ledger 
+        WHERE user_id = %s AND type = 'Investimento'
+        GROUP BY month
+        ORDER BY month
+        """, 
+        conn, 
+        params=(user_id,)
+    )
+    conn.close()
+    
+    if not df.empty:
+        df['cumulative_total'] = df['monthly_total'].cumsum()
+    return df
+
+@_per_user_cache
+def get_total_portfolio_value(user_id, as_of_date=None):
+    """Returns total value of all investments, optionally up to a specific date."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return 0.0
+    c = conn.cursor()
+    
+    query = "SELECT SUM(amount_cents) FROM transaction_ledger WHERE user_id = %s AND type = 'Investimento'"
+    params = [user_id]
+    
+    if as_of_date:
+        query += " AND date <= %s"
+        params.append(as_of_date)
+        
+    c.execute(query, tuple(params))
+    res = c.fetchone()
+    total = int(res[0]) / 100 if res and res[0] is not None else 0.0
+    conn.close()
+    return total
+
+def goal_exists_for_category(user_id, category):
+    """Checks if a goal already exists for a specific category."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return False
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM goals WHERE user_id = %s AND category_link = %s", (user_id, category))
+    res = c.fetchone()
+    conn.close()
+    return res[0] > 0 if res else False
+
+def create_auto_goal(user_id, category):
+    """Creates an automatic goal for an investment category."""
+    default_target = 10000.0
+    goal_name = f"Meta: {category}"
+    if not goal_exists_for_category(user_id, category):
+        return create_goal(user_id, goal_name, default_target, category)
+    return True
+
+def rebuild_user_aggregates(user_id):
+    """Recomputes a user's monthly totals and category usage counters from their live and archived rows."""
+    conn = get_connection(user_id=user_id)
+    if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+
+    c = conn.cursor()
+    try:
+        # Every insert or delete of the user touches these rows, so holding them keeps writers out
+        c.execute("SELECT id FROM categories WHERE user_id = %s FOR UPDATE", (user_id,))
+        c.execute("DELETE FROM monthly_totals WHERE user_id = %s", (user_id,))
+        c.execute('''
+            INSERT INTO monthly_totals (user_id, month, type, total_cents, tx_count)
+            SELECT user_id, date_trunc('month', date)::date, type, SUM(amount_cents), COUNT(*)
+            FROM transactions WHERE user_id = %s
+            GROUP BY 1, 2, 3
+        ''', (user_id,))
+        # Usage counts include archived years, as the trigger never decrements them on archival
+        c.execute('''
+            UPDATE categories k SET usage_count = COALESCE(u.uses, 0), last_used = u.last_used
+            FROM (
+                SELECT k2.id, SUM(used.n) AS uses, MAX(used.last_used) AS last_used
+                FROM categories k2
+                LEFT JOIN (
+                    SELECT category_id, COUNT(*) AS n, MAX(date) AS last_used
+                    FROM transactions WHERE user_id = %(user_id)s GROUP BY 1
+                    UNION ALL
+                    SELECT category_id, SUM(tx_count), MAX(month)
+                    FROM transactions_rollup WHERE user_id = %(user_id)s GROUP BY 1
+                ) used ON used.category_id = k2.id
+                WHERE k2.user_id = %(user_id)s
+                GROUP BY k2.id
+            ) u
+            WHERE k.user_id = %(user_id)s AND k.id = u.id
+        ''', {"user_id": user_id})
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+    invalidate_user_cache(user_id)
+    return True
+
+@_per_user_cache
+def get_ai_financial_context(user_id):
+    """Consolidates complete financial data into a JSON-ready dictionary for AI analysis."""
+    now = datetime.datetime.now()
+    cur_month, cur_year = now.month, now.year
+    prev_month = 12 if cur_month == 1 else cur_month - 1
+    prev_year = cur_year - 1 if cur_month == 1 else cur_year
+
+    cur_inc, cur_exp, cur_inv = get_monthly_summary(user_id, cur_month, cur_year)
+    pre_inc, pre_exp, pre_inv = get_monthly_summary(user_id, prev_month, prev_year)
+
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return {}
+    
+    categories_df = pd.read_sql_query(
+        f"""
+        SELECT k.name AS category, s.total
+        FROM (
+            SELECT category_id, {_cents_to_amount("SUM(amount_cents)")} AS total
+            FROM transaction_ledger
+            WHERE user_id = %s AND type = 'Saída'
+            AND date >= %s AND date < %s
+            GROUP BY category_id
+        ) s
+        JOIN categories k ON k.user_id = %s AND k.id = s.category_id
+        ORDER BY s.total DESC
+        """,
+        conn, params=(user_id, *month_bounds(cur_month, cur_year), user_id)
+    )
+    
+    portfolio_df = get_portfolio_summary(user_id)
+    goals_df = get_goals(user_id)
+    conn.close()
+
+    # Convert Timestamps/Dates to strings to avoid JSON serialization errors
+    def safe_to_dict(df):
+        if df.empty: return []
+        # Convert any column with 'date' or 'created_at' to string
+        for col in df.columns:
+            if 'date' in col.lower() or 'created' in col.lower() or 'at' in col.lower():
+                try:
+                    df[col] = df[col].astype(str)
+                except:
+                    pass
+        return df.to_dict(orient='records')
+
+    context = {
+        "resumo_mensal_atual": {
+            "mes": cur_month, "ano": cur_year,
+            "receita_total": cur_inc,
+            "despesa_total": cur_exp,
+            "investimento_total": cur_inv,
+            "saldo_liquido": cur_inc - cur_exp - cur_inv
+        },
+        "comparativo_mes_anterior": {
+            "receita_variacao_pct": ((cur_inc / pre_inc - 1) * 100) if pre_inc > 0 else 0,
+            "despesa_variacao_pct": ((cur_exp / pre_exp - 1) * 100) if pre_exp > 0 else 0
+        },
+        "maiores_gastos_categoria": safe_to_dict(categories_df),
+        "patrimonio": {
+            "valor_total": get_total_portfolio_value(user_id),
+            "composicao": safe_to_dict(portfolio_df)
+        },
+        "metas_ativas": safe_to_dict(goals_df)
+    }
+    return context
+
+CHAT_COLUMNS = "id, role, content, created_at"
+
+def _chat_rows(rows):
+    return [dict(zip(("id", "role", "content", "created_at"), row)) for row in rows]
+
+def add_chat_message(user_id, role, content):
+    """Appends one turn ('user' or 'assistant') to the user's FinanBot conversation."""
+    return run_query(
+        "INSERT INTO chat_messages (user_id, role, content) VALUES (%s, %s, %s)",
+        (user_id, role, content), user_id=user_id, invalidate=False
+    )
+
+def get_chat_messages(user_id, limit=CHAT_PAGE_SIZE, offset=0):
+    """Returns the user's latest turns, skipping the `offset` newest ones, oldest first."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return []
+    c = conn.cursor()
+    c.execute(
+        f"SELECT {CHAT_COLUMNS} FROM chat_messages WHERE user_id = %s ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s",
+        (user_id, limit, offset)
+    )
+    rows = c.fetchall()
+    conn.close()
+    return _chat_rows(reversed(rows))
+
+def get_chat_messages_after(user_id, after=None, limit=None):
+    """Returns the turns newer than the timestamp `after` (all when None), oldest first."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return []
+    c = conn.cursor()
+    c.execute(
+        f"SELECT {CHAT_COLUMNS} FROM chat_messages WHERE user_id = %s AND (%s::timestamp IS NULL OR created_at > %s) "
+        "ORDER BY created_at, id LIMIT %s",
+        (user_id, after, after, limit)
+    )
+    rows = c.fetchall()
+    conn.close()
+    return _chat_rows(rows)
+
+def count_chat_messages_after(user_id, after=None):
+    """Counts the turns newer than the timestamp `after` (all when None)."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return 0
+    c = conn.cursor()
+    c.execute(
+        "SELECT COUNT(*) FROM chat_messages WHERE user_id = %s AND (%s::timestamp IS NULL OR created_at > %s)",
+        (user_id, after, after)
+    )
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+def search_chat_messages(user_id, text, before, limit):
+    """Returns the turns older than the cursor `before` that best match `text` (full-text, Portuguese), oldest first."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return []
+    c = conn.cursor()
+    c.execute(
+        f"""
+        SELECT {CHAT_COLUMNS} FROM chat_messages
+        WHERE user_id = %s AND (created_at, id) < (%s, %s)
+          AND to_tsvector('portuguese', content) @@ plainto_tsquery('portuguese', %s)
+        ORDER BY ts_rank(to_tsvector('portuguese', content), plainto_tsquery('portuguese', %s)) DESC
+        LIMIT %s
+        """,
+        (user_id, before[0], before[1], text, text, limit)
+    )
+    rows = sorted(c.fetchall(), key=lambda r: (r[3], r[0]))
+    conn.close()
+    return _chat_rows(rows)
+
+def get_chat_summary(user_id):
+    """Returns (summary, covers_until) of the user's older turns, or (None, None)."""
+    conn = get_connection(readonly=True, user_id=user_id)
+    if not conn: return None, None
+    c = conn.cursor()
+    c.execute("SELECT summary, covers_until FROM chat_summaries WHERE user_id = %s", (user_id,))
+    row = c.fetchone()
+    conn.close()
+    return row if row else (None, None)
+
+def save_chat_summary(user_id, summary, covers_until):
+    """Stores the rolling summary of every turn up to covers_until."""
+    return run_query(
+        "INSERT INTO chat_summaries (user_id, summary, covers_until) VALUES (%s, %s, %s) "
+        "ON CONFLICT (user_id) DO UPDATE SET summary = EXCLUDED.summary, covers_until = EXCLUDED.covers_until, "
+        "updated_at = CURRENT_TIMESTAMP",
+        (user_id, summary, covers_until), user_id=user_id, invalidate=False
+    )
+
+def clear_chat_history(user_id):
+    """Deletes the user's conversation and its summary."""
+    conn = get_connection(user_id=user_id)
+    if not conn: raise DatabaseUnavailable(_NO_CONNECTION)
+    c = conn.cursor()
+    try:
+        c.execute("DELETE FROM chat_messages WHERE user_id = %s", (user_id,))
+        c.execute("DELETE FROM chat_summaries WHERE user_id = %s", (user_id,))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise QueryError(str(e)) from e
+    finally:
+        conn.close()
+    _mark_session_write()
+    return True
+
+def archive_closed_years(keep_years=ARCHIVE_KEEP_YEARS):
+    """Moves yearly partitions older than keep_years into compressed cold storage.
+
+    Each archived year becomes one zlib-compressed JSON blob per user in transactions_archive
+    plus monthly totals in transactions_rollup, so lifetime aggregates and full history stay intact.
+    Returns the list of archived years.
+    """
+    archived = set()
+    for url in _all_database_urls():
+        archived.update(_archive_database(url, keep_years))
+    return sorted(archived)
+
+def _archive_database(url, keep_years):
+    conn = get_connection(dsn=url)
+    if not conn: return []
+    c = conn.cursor()
+    cutoff = datetime.date.today().year - max(int(keep_years), 1) + 1
+    archived = []
+    try:
+        for year, partition in sorted(_year_partitions(c).items()):
+            if year >= cutoff:
+                continue
+            # Archived payloads keep the readable shape, so they never depend on category ids
+            c.execute(
+                f"SELECT {TRANSACTION_COLUMNS} FROM transaction_details WHERE date >= %s AND date < %s ORDER BY user_id, date, id",
+                (datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1))
+            )
+            per_user = {}
+            for row in c.fetchall():
+                per_user.setdefault(row[1], []).append(row)
+            for user_id, rows in per_user.items():
+                payload = zlib.compress(json.dumps(rows, default=str).encode('utf-8'), 9)
+                c.execute(
+                    "INSERT INTO transactions_archive (user_id, year, row_count, payload) VALUES (%s, %s, %s, %s)",
+                    (user_id, year, len(rows), psycopg2.Binary(payload))
+                )
+            c.execute(f"""
+                INSERT INTO transactions_rollup (user_id, month, type, category_id, total_cents, tx_count)
+                SELECT user_id, date_trunc('month', date)::date, type, category_id, SUM(amount_cents), COUNT(*)
+                FROM {partition}
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (user_id, month, type, category_id) DO UPDATE
+                SET total_cents = transactions_rollup.total_cents + EXCLUDED.total_cents,
+                    tx_count = transactions_rollup.tx_count + EXCLUDED.tx_count
+            """)
+            # Dropping the partition fires no row trigger; its months now live in the rollup
+            c.execute(
+                "DELETE FROM monthly_totals WHERE month >= %s AND month < %s",
+                (datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1))
+            )
+            c.execute(f"DROP TABLE {partition}")
+            # One transaction per year: a failure never leaves a year half archived
+            conn.commit()
+            archived.append(year)
+    except Exception as e:
+        conn.rollback()
+        report_error(QueryError(f"Erro ao arquivar transações: {e}"))
+    conn.close()
+    return archived
+
+def maintain_partitions():
+    """Creates upcoming yearly partitions; meant to run periodically or at deploy."""
+    for url in _all_database_urls():
+        conn = get_connection(dsn=url)
+        if not conn: continue
+        c = conn.cursor()
+        _ensure_transaction_partitions(c)
+        conn.commit()
+        conn.close()
+
+def sweep_expired_users():
+    """Blocks every expired user with one set-based UPDATE per database.
+
+    A transaction-scoped advisory lock lets only one process sweep a database at a time;
+    the others skip it. Returns the list of (id, email) that were blocked.
+    """
+    blocked = []
+    for url in _shard_urls():
+        conn = get_connection(dsn=url)
+        if not conn: continue
+        c = conn.cursor()
+        try:
+            c.execute("SELECT pg_try_advisory_xact_lock(%s)", (EXPIRY_SWEEP_LOCK_KEY,))
+            if c.fetchone()[0]:
+                c.execute("""
+                    UPDATE users SET status = 'blocked'
+                    WHERE expiry_date < now() AND status <> 'blocked'
+                    RETURNING id, email
+                """)
+                blocked.extend(c.fetchall())
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.warning("Expiry sweep failed: %s", e)
+        finally:
+            conn.close()
+
+    _last_sweep.update(at=datetime.datetime.now(), blocked=len(blocked))
+    if blocked:
+        logger.info("Expiry sweep blocked %d user(s): %s", len(blocked), ", ".join(email for _, email in blocked))
+    return blocked
+
+def get_last_sweep():
+    """Returns {'at': datetime, 'blocked': int} for the last sweep of this process, or {}."""
+    return dict(_last_sweep)
+
+def start_expiry_sweeper(interval=None):
+    """Starts the background expiry sweeper thread once per process."""
+    global _sweeper_thread
+    with _sweeper_lock:
+        if _sweeper_thread and _sweeper_thread.is_alive():
+            return _sweeper_thread
+        interval = float(interval or config.get_setting("EXPIRY_SWEEP_INTERVAL", EXPIRY_SWEEP_INTERVAL))
+
+        def loop():
+            while True:
+                try:
+                    sweep_expired_users()
+                except Exception:
+                    logger.exception("Expiry sweep crashed")
+                time.sleep(interval)
+
+        _sweeper_thread = threading.Thread(target=loop, name="expiry-sweeper", daemon=True)
+        _sweeper_thread.start()
+    return _sweeper_thread
+
+def locate_user(user_id):
+    """Returns the DSN of the shard currently holding the user's row, or None."""
+    for url in _shard_urls():
+        conn = get_connection(dsn=url)
+        if not conn: continue
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM users WHERE id = %s", (user_id,))
+        found = c.fetchone()
+        conn.close()
+        if found: return url
+    return None
+
+def find_misplaced_users():
+    """Returns [(user_id, current_dsn, ring_dsn)] for users not on the shard the ring assigns them."""
+    misplaced = []
+    for url in _shard_urls():
+        conn = get_connection(dsn=url)
+        if not conn: continue
+        c = conn.cursor()
+        c.execute("SELECT id FROM users ORDER BY id")
+        for (user_id,) in c.fetchall():
+            target = shard_for_user(user_id)
+            if target != url:
+                misplaced.append((user_id, url, target))
+        conn.close()
+    return misplaced
+
+def rebalance_user(user_id, source_url=None):
+    """Moves one user's rows to the shard the ring assigns them to.
+
+    The target copy is replaced in one transaction and committed before the source rows are
+    deleted, so an interrupted move can simply be run again. Row ids are kept, so ids already
+    handed out (API clients, links) stay valid; a row whose id is taken on the target aborts the
+    move before anything is deleted. Returns the target DSN, or None when the user is already in place.
+    """
+    target_url = shard_for_user(user_id)
+    source_url = source_url or locate_user(user_id)
+    if source_url is None or source_url == target_url:
+        return None
+
+    src = get_connection(dsn=source_url)
+    dst = get_connection(dsn=target_url)
+    if not src or not dst:
+        raise RuntimeError("Shard indisponível para rebalanceamento.")
+    sc, dc = src.cursor(), dst.cursor()
+    try:
+        sc.execute(
+            "SELECT id, email, password_hash, role, status, expiry_date, created_at FROM users WHERE id = %s FOR UPDATE",
+            (user_id,)
+        )
+        user = sc.fetchone()
+        if not user:
+            raise ValueError(f"Usuário {user_id} não encontrado em {source_url}")
+
+        # Per-user tables, children first when deleting and parents first when inserting.
+        # Categories go last: the category foreign key is deferred, and copying them after the
+        # transactions keeps the source usage counts instead of the trigger's recount
+        tables = [
+            ("transactions", "id, user_id, date, type, category_id, amount_cents, description, created_at"),
+            ("goals", "id, user_id, name, target_amount, category_link, created_at"),
+            ("transactions_archive", "id, user_id, year, row_count, payload, archived_at"),
+            ("transactions_rollup", "user_id, month, type, category_id, total_cents, tx_count"),
+            ("chat_messages", "id, user_id, role, content, created_at"),
+            ("chat_summaries", "user_id, summary, covers_until, updated_at"),
+            ("spending_anomalies", "user_id, month, kind, category, period, amount, baseline, score, detected_at"),
+            ("import_progress", "job_id, user_id, imported, updated_at"),
+            ("categories", "user_id, id, type, name, usage_count, last_used"),
+        ]
+        for table, _ in tables:
+            dc.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+        dc.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        dc.execute(
+            "INSERT INTO users (id, email, password_hash, role, status, expiry_date, created_at) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            user
+        )
+        for table, columns in tables:
+            sc.execute(f"SELECT {columns} FROM {table} WHERE user_id = %s", (user_id,))
+            rows = sc.fetchall()
+            if rows:
+                psycopg2.extras.execute_values(dc, f"INSERT INTO {table} ({columns}) VALUES %s", rows)
+            if rows and "id" in columns.split(", "):
+                # Keep the target's id sequence ahead of the copied ids (categories number theirs per user)
+                dc.execute(
+                    "SELECT setval(s::regclass, GREATEST(%s, pg_sequence_last_value(s::regclass))) "
+                    "FROM pg_get_serial_sequence(%s, 'id') AS s WHERE s IS NOT NULL",
+                    (max(row[0] for row in rows), table)
+                )
+        dst.commit()
+
+        for table, _ in tables:
+            sc.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+        sc.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        src.commit()
+    except Exception:
+        src.rollback()
+        dst.rollback()
+        raise
+    finally:
+        src.close()
+        dst.close()
+    return target_url
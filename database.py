@@ -1,376 +1,102 @@
-import psycopg2
-import pandas as pd
-import datetime
-import streamlit as st
-import time
+import functools
 
-def get_connection():
-    """Establishes a connection to the PostgreSQL database using secrets with retries."""
-    # Check both top-level and [general] for DATABASE_URL
-    db_url = st.secrets.get("DATABASE_URL") or st.secrets.get("general", {}).get("DATABASE_URL")
-    
-    if not db_url:
-        return None
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
-    max_retries = 3
-    retry_delay = 2 # seconds
-    
-    for attempt in range(max_retries):
-        try:
-            conn = psycopg2.connect(db_url)
-            return conn
-        except Exception as e:
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                continue
-            st.error(f"❌ Erro Crítico de Conexão: {e}")
-            return None
+from core import config, errors, repository
+from core.errors import FinanFlowError
 
-def init_db():
-    """Initializes the PostgreSQL database with necessary tables."""
-    conn = get_connection()
-    if not conn: return
-    
-    c = conn.cursor()
-    
-    # Create Users Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            role TEXT DEFAULT 'user',
-            status TEXT DEFAULT 'active',
-            expiry_date TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    # Ensure column exists for older databases
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS expiry_date TIMESTAMP")
-    except:
-        pass
-    conn.commit()
-    
-    # Create Transactions Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            date DATE NOT NULL,
-            type TEXT NOT NULL,
-            category TEXT NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            CONSTRAINT fk_user FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create Goals Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS goals (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            target_amount DECIMAL(15,2) NOT NULL,
-            category_link TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            CONSTRAINT fk_user_goal FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+# Streamlit side of the data layer: core.repository reads its settings from st.secrets, keeps
+# replica stickiness in st.session_state and reports recovered errors with st.error. Any other
+# attribute (db.get_transactions_df, db.TRANSACTION_PAGE_SIZE, ...) is core.repository's.
 
-def run_query(query, params=(), return_data=False):
-    """Helper function to run SQL queries in PostgreSQL."""
-    conn = get_connection()
-    if not conn: return "Erro de conexão: DATABASE_URL não encontrada ou inválida nos Secrets."
-    
-    c = conn.cursor()
+def _streamlit_secret(key):
+    """Reads a secret from the top level or the [general] section."""
     try:
-        c.execute(query, params)
-        if return_data:
-            data = c.fetchall()
-            conn.close()
-            return data
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        if conn: conn.close()
-        return str(e)
-
-def get_users_df():
-    """Returns a pandas DataFrame of all users."""
-    conn = get_connection()
-    if not conn: return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM users", conn)
-    conn.close()
-    return df
-
-def get_transactions_df(user_id):
-    """Returns a pandas DataFrame of transactions for a specific user."""
-    conn = get_connection()
-    if not conn: return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM transactions WHERE user_id = %s", conn, params=(user_id,))
-    conn.close()
-    return df
-
-def add_transaction(user_id, date, type, category, amount, description):
-    """Adds a new transaction."""
-    return run_query(
-        "INSERT INTO transactions (user_id, date, type, category, amount, description) VALUES (%s, %s, %s, %s, %s, %s)",
-        (user_id, date, type, category, amount, description)
-    )
-
-def update_transaction(transaction_id, date, type, category, amount, description):
-    """Updates an existing transaction."""
-    return run_query(
-        "UPDATE transactions SET date=%s, type=%s, category=%s, amount=%s, description=%s WHERE id=%s",
-        (date, type, category, amount, description, transaction_id)
-    )
-
-def delete_transaction(transaction_id):
-    """Deletes a transaction."""
-    return run_query("DELETE FROM transactions WHERE id = %s", (transaction_id,))
-
-def create_goal(user_id, name, target, category):
-    """Creates a new investment goal."""
-    return run_query(
-        "INSERT INTO goals (user_id, name, target_amount, category_link) VALUES (%s, %s, %s, %s)", 
-        (user_id, name, target, category)
-    )
-
-def update_goal_target(user_id, category, new_target):
-    """Updates the target amount for a specific category goal."""
-    conn = get_connection()
-    if not conn: return False
-    c = conn.cursor()
-    # Check if goal exists
-    c.execute("SELECT id FROM goals WHERE user_id = %s AND category_link = %s", (user_id, category))
-    exists = c.fetchone()
-    if exists:
-        c.execute("UPDATE goals SET target_amount = %s WHERE user_id = %s AND category_link = %s", (new_target, user_id, category))
-    else:
-        # Create if doesn't exist
-        c.execute("INSERT INTO goals (user_id, name, target_amount, category_link) VALUES (%s, %s, %s, %s)", 
-                     (user_id, f"Meta: {category}", new_target, category))
-    conn.commit()
-    conn.close()
-    return True
-
-def delete_goal(goal_id):
-    return run_query("DELETE FROM goals WHERE id = %s", (goal_id,))
-
-def get_goals(user_id):
-    """Returns list of goals for user."""
-    conn = get_connection()
-    if not conn: return pd.DataFrame()
-    df = pd.read_sql_query("SELECT * FROM goals WHERE user_id = %s", conn, params=(user_id,))
-    conn.close()
-    return df
-
-def get_goal_progress(user_id, category_link):
-    """Calculates total invested in a specific category."""
-    conn = get_connection()
-    if not conn: return 0.0
-    c = conn.cursor()
-    c.execute(
-        "SELECT SUM(amount) FROM transactions WHERE user_id = %s AND type = 'Investimento' AND category = %s", 
-        (user_id, category_link)
-    )
-    res = c.fetchone()
-    total = float(res[0]) if res and res[0] is not None else 0.0
-    conn.close()
-    return total
-
-def get_monthly_summary(user_id, month, year):
-    """Calculates totals for a specific month."""
-    conn = get_connection()
-    if not conn: return 0.0, 0.0, 0.0
-    c = conn.cursor()
-    
-    # Income
-    c.execute(
-        "SELECT SUM(amount) FROM transactions WHERE user_id = %s AND type = 'Entrada' AND EXTRACT(MONTH FROM date) = %s AND EXTRACT(YEAR FROM date) = %s", 
-        (user_id, month, year)
-    )
-    res = c.fetchone()
-    income = float(res[0]) if res and res[0] is not None else 0.0
-    
-    # Expense
-    c.execute(
-        "SELECT SUM(amount) FROM transactions WHERE user_id = %s AND type = 'Saída' AND EXTRACT(MONTH FROM date) = %s AND EXTRACT(YEAR FROM date) = %s", 
-        (user_id, month, year)
-    )
-    res = c.fetchone()
-    expense = float(res[0]) if res and res[0] is not None else 0.0
-    
-    # Investment
-    c.execute(
-        "SELECT SUM(amount) FROM transactions WHERE user_id = %s AND type = 'Investimento' AND EXTRACT(MONTH FROM date) = %s AND EXTRACT(YEAR FROM date) = %s", 
-        (user_id, month, year)
-    )
-    res = c.fetchone()
-    investment = float(res[0]) if res and res[0] is not None else 0.0
-    
-    conn.close()
-    return income, expense, investment
-
-def get_all_categories(user_id, type_filter):
-    """Returns distinct categories used by user for a specific type."""
-    conn = get_connection()
-    if not conn: return []
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT category FROM transactions WHERE user_id = %s AND type = %s", (user_id, type_filter))
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-def get_portfolio_summary(user_id, as_of_date=None):
-    """Returns total accumulated investments by category, optionally up to a specific date."""
-    conn = get_connection()
-    if not conn: return pd.DataFrame()
-    
-    query = """
-        SELECT category, SUM(amount) as total
-        FROM transactions 
-        WHERE user_id = %s AND type = 'Investimento'
-    """
-    params = [user_id]
-    
-    if as_of_date:
-        query += " AND date <= %s"
-        params.append(as_of_date)
-        
-    query += " GROUP BY category ORDER BY total DESC"
-    
-    df = pd.read_sql_query(query, conn, params=tuple(params))
-    conn.close()
-    return df
-
-def get_portfolio_evolution(user_id):
-    """Returns monthly evolution of total investments."""
-    conn = get_connection()
-    if not conn: return pd.DataFrame()
-    # Postgres TO_CHAR for date formatting
-    df = pd.read_sql_query(
-        """
-        SELECT 
-            TO_CHAR(date, 'YYYY-MM') as month,
-            SUM(amount) as monthly_total
-        FROM transactions 
-        WHERE user_id = %s AND type = 'Investimento'
-        GROUP BY month
-        ORDER BY month
-        """, 
-        conn, 
-        params=(user_id,)
-    )
-    conn.close()
-    
-    if not df.empty:
-        df['cumulative_total'] = df['monthly_total'].cumsum()
-    return df
-
-def get_total_portfolio_value(user_id, as_of_date=None):
-    """Returns total value of all investments, optionally up to a specific date."""
-    conn = get_connection()
-    if not conn: return 0.0
-    c = conn.cursor()
-    
-    query = "SELECT SUM(amount) FROM transactions WHERE user_id = %s AND type = 'Investimento'"
-    params = [user_id]
-    
-    if as_of_date:
-        query += " AND date <= %s"
-        params.append(as_of_date)
-        
-    c.execute(query, tuple(params))
-    res = c.fetchone()
-    total = float(res[0]) if res and res[0] is not None else 0.0
-    conn.close()
-    return total
-
-def goal_exists_for_category(user_id, category):
-    """Checks if a goal already exists for a specific category."""
-    conn = get_connection()
-    if not conn: return False
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM goals WHERE user_id = %s AND category_link = %s", (user_id, category))
-    res = c.fetchone()
-    conn.close()
-    return res[0] > 0 if res else False
-
-def create_auto_goal(user_id, category):
-    """Creates an automatic goal for an investment category."""
-    default_target = 10000.0
-    goal_name = f"Meta: {category}"
-    if not goal_exists_for_category(user_id, category):
-        return create_goal(user_id, goal_name, default_target, category)
-    return True
+        return st.secrets.get(key) or st.secrets.get("general", {}).get(key)
+    except Exception:
+        # No secrets.toml available
+        return None
 
-def get_ai_financial_context(user_id):
-    """Consolidates complete financial data into a JSON-ready dictionary for AI analysis."""
-    now = datetime.datetime.now()
-    cur_month, cur_year = now.month, now.year
-    prev_month = 12 if cur_month == 1 else cur_month - 1
-    prev_year = cur_year - 1 if cur_month == 1 else cur_year
+def _session_state():
+    if get_script_run_ctx() is None:
+        raise RuntimeError("outside a Streamlit session")
+    return st.session_state
 
-    cur_inc, cur_exp, cur_inv = get_monthly_summary(user_id, cur_month, cur_year)
-    pre_inc, pre_exp, pre_inv = get_monthly_summary(user_id, prev_month, prev_year)
+def _show_error(error):
+    if get_script_run_ctx() is not None:
+        st.error(f"❌ {error}")
 
-    conn = get_connection()
-    if not conn: return {}
-    
-    # Postgres syntax for month/year filter
-    categories_df = pd.read_sql_query(
-        """
-        SELECT category, SUM(amount) as total 
-        FROM transactions 
-        WHERE user_id = %s AND type = 'Saída' 
-        AND EXTRACT(MONTH FROM date) = %s AND EXTRACT(YEAR FROM date) = %s
-        GROUP BY category 
-        ORDER BY total DESC
-        """,
-        conn, params=(user_id, cur_month, cur_year)
-    )
-    
-    portfolio_df = get_portfolio_summary(user_id)
-    goals_df = get_goals(user_id)
-    conn.close()
+config.configure(source=_streamlit_secret, session_state=_session_state)
+errors.add_error_handler(_show_error)
 
-    # Convert Timestamps/Dates to strings to avoid JSON serialization errors
-    def safe_to_dict(df):
-        if df.empty: return []
-        # Convert any column with 'date' or 'created_at' to string
-        for col in df.columns:
-            if 'date' in col.lower() or 'created' in col.lower() or 'at' in col.lower():
-                try:
-                    df[col] = df[col].astype(str)
-                except:
-                    pass
-        return df.to_dict(orient='records')
+get_secret = config.get_setting
 
-    context = {
-        "resumo_mensal_atual": {
-            "mes": cur_month, "ano": cur_year,
-            "receita_total": cur_inc,
-            "despesa_total": cur_exp,
-            "investimento_total": cur_inv,
-            "saldo_liquido": cur_inc - cur_exp - cur_inv
-        },
-        "comparativo_mes_anterior": {
-            "receita_variacao_pct": ((cur_inc / pre_inc - 1) * 100) if pre_inc > 0 else 0,
-            "despesa_variacao_pct": ((cur_exp / pre_exp - 1) * 100) if pre_exp > 0 else 0
-        },
-        "maiores_gastos_categoria": safe_to_dict(categories_df),
-        "patrimonio": {
-            "valor_total": get_total_portfolio_value(user_id),
-            "composicao": safe_to_dict(portfolio_df)
-        },
-        "metas_ativas": safe_to_dict(goals_df)
-    }
-    return context
+def _message_on_error(fn):
+    """Returns the error message instead of raising, which is what the pages check for."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except FinanFlowError as e:
+            return str(e)
+    return wrapper
+
+run_query = _message_on_error(repository.run_query)
+find_user_by_email = _message_on_error(repository.find_user_by_email)
+create_user = _message_on_error(repository.create_user)
+revoke_session = _message_on_error(repository.revoke_session)
+set_users_status = _message_on_error(repository.set_users_status)
+set_users_role = _message_on_error(repository.set_users_role)
+set_users_expiry = _message_on_error(repository.set_users_expiry)
+delete_users = _message_on_error(repository.delete_users)
+add_transaction = _message_on_error(repository.add_transaction)
+update_transaction = _message_on_error(repository.update_transaction)
+delete_transaction = _message_on_error(repository.delete_transaction)
+delete_transactions = _message_on_error(repository.delete_transactions)
+create_goal = _message_on_error(repository.create_goal)
+update_goal_target = _message_on_error(repository.update_goal_target)
+delete_goal = _message_on_error(repository.delete_goal)
+create_auto_goal = _message_on_error(repository.create_auto_goal)
+add_chat_message = _message_on_error(repository.add_chat_message)
+clear_chat_history = _message_on_error(repository.clear_chat_history)
+
+def __getattr__(name):
+    return getattr(repository, name)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="FinanFlow database maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="create or migrate the schema")
+    commands.add_parser("partitions", help="create upcoming transaction partitions")
+    commands.add_parser("sweep", help="block every expired user once")
+    archive_parser = commands.add_parser("archive", help="archive closed years into cold storage")
+    archive_parser.add_argument("--keep-years", type=int, default=repository.ARCHIVE_KEEP_YEARS)
+    rebalance_parser = commands.add_parser("rebalance", help="move users to the shard the ring assigns them")
+    rebalance_parser.add_argument("--user-id", type=int, help="move only this user")
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="only list misplaced users")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        repository.init_db()
+    elif args.command == "partitions":
+        repository.maintain_partitions()
+    elif args.command == "sweep":
+        blocked = repository.sweep_expired_users()
+        print(f"Blocked users: {', '.join(email for _, email in blocked) or 'none'}")
+    elif args.command == "archive":
+        years = repository.archive_closed_years(args.keep_years)
+        print(f"Archived years: {', '.join(map(str, years)) or 'none'}")
+    elif args.command == "rebalance":
+        if args.user_id is not None:
+            moves = [(args.user_id, repository.locate_user(args.user_id), repository.shard_for_user(args.user_id))]
+        else:
+            moves = repository.find_misplaced_users()
+        for user_id, source, target in moves:
+            if args.dry_run:
+                print(f"user {user_id}: {source} -> {target}")
+            else:
+                moved_to = repository.rebalance_user(user_id, source)
+                print(f"user {user_id}: {'moved to ' + moved_to if moved_to else 'already in place'}")
@@ -1,19 +1,21 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+import calendar
+import charts
 import datetime
 import database as db
 import auth
 import json
+import styles
 import time
-from streamlit_option_menu import option_menu
-from streamlit_extras.metric_cards import style_metric_cards
+from core import aggregations
+from core.errors import FinanFlowError
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    genai = None
+# Heavy UI dependencies (plotly, google.generativeai, streamlit_option_menu) and the core modules
+# only some tabs use (jobs, chat, anomalies, projections) are imported inside the functions that
+# need them, so the login page never pays for them.
+
+ANOMALY_CARDS = 3  # spending anomaly cards shown on the dashboard (the rest are counted)
 
 # Page Config
 st.set_page_config(
@@ -23,192 +25,21 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Initialize Database
-if "db_initialized" not in st.session_state:
-    db.init_db()
-    st.session_state.db_initialized = True
+# Server start-up, once per process: schema version check (DDL only when behind), the
+# background expiry sweeper and the job worker processes. New sessions run no DDL at all.
+@st.cache_resource(show_spinner=False)
+def start_backend():
+    from core import jobs
+    db.ensure_schema()
+    db.start_expiry_sweeper()
+    jobs.start_workers()
+    return True
+
+start_backend()
 
 # --- Styles ---
 def local_css():
-    st.markdown("""
-    <style>
-        /* Modern Fintech Theme - Premium Overhaul */
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;500;600;700&family=Outfit:wght@400;600;700&display=swap');
-        
-        :root {
-            --primary: #10b981; /* Emerald Green */
-            --primary-dark: #059669;
-            --secondary: #0f172a; /* Deep Navy */
-            --bg-main: #f8fafc;
-            --text-main: #0f172a;
-            --text-light: #64748b;
-            --card-bg: #ffffff;
-            --border: #e2e8f0;
-            --shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1);
-            --shadow-lg: 0 10px 15px -3px rgba(0, 0, 0, 0.1);
-        }
-
-        /* Essential Streamlit Overrides for Desktop */
-        .main .block-container {
-            max-width: 1200px;
-            padding-top: 2rem;
-            padding-bottom: 2rem;
-        }
-
-        * {
-            font-family: 'Inter', sans-serif;
-        }
-
-        h1, h2, h3, .metric-value {
-            font-family: 'Outfit', sans-serif;
-            letter-spacing: -0.02em;
-        }
-
-        .main {
-            background-color: var(--background);
-        }
-        
-        /* Modern Glass/Elevated KPI Cards */
-        .metric-card {
-            background: var(--surface);
-            padding: 1.75rem;
-            border-radius: 20px;
-            border: 1px solid var(--border);
-            box-shadow: var(--shadow-md);
-            transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1);
-            height: 100%;
-            display: flex;
-            flex-direction: column;
-            justify-content: space-between;
-        }
-
-        .metric-card:hover {
-            transform: translateY(-4px);
-            box-shadow: var(--shadow-lg);
-            border-color: var(--primary);
-        }
-        
-        .metric-label {
-            color: var(--text-muted);
-            font-size: 0.85rem;
-            font-weight: 600;
-            margin-bottom: 1rem;
-            letter-spacing: 0.05em;
-            text-transform: uppercase;
-        }
-        
-        .metric-value {
-            color: var(--text-main);
-            font-size: 1.6rem;
-            font-weight: 700;
-            line-height: 1.1;
-            white-space: nowrap;
-            overflow: hidden;
-            text-overflow: ellipsis;
-        }
-        
-        .metric-delta {
-            font-size: 0.8rem;
-            font-weight: 600;
-            display: flex;
-            align-items: center;
-            gap: 4px;
-            margin-top: 1rem;
-            padding: 4px 10px;
-            border-radius: 8px;
-            width: fit-content;
-        }
-        
-        .delta-up { background-color: #dcfce7; color: #15803d; }
-        .delta-down { background-color: #fee2e2; color: #b91c1c; }
-        
-        /* Containers */
-        .section-card {
-            background-color: var(--surface);
-            padding: 2.5rem;
-            border-radius: 24px;
-            border: 1px solid var(--border);
-            box-shadow: var(--shadow-sm);
-            margin-bottom: 2rem;
-        }
-        
-        .insight-card {
-            background-color: var(--surface);
-            padding: 1.5rem;
-            border-radius: 16px;
-            border: 1px solid var(--border);
-            border-left: 6px solid var(--primary);
-            margin-bottom: 1.25rem;
-            box-shadow: var(--shadow-sm);
-            transition: transform 0.2s;
-        }
-
-        .insight-card:hover {
-            transform: scale(1.01);
-        }
-
-        /* Buttons */
-        .stButton>button {
-            border-radius: 12px;
-            padding: 0.6rem 2rem;
-            background: linear-gradient(135deg, var(--primary) 0%, var(--primary-dark) 100%);
-            color: white;
-            border: none;
-            font-weight: 600;
-            box-shadow: 0 4px 6px -1px rgba(59, 130, 246, 0.3);
-            transition: all 0.2s ease;
-        }
-        
-        .stButton>button:hover {
-            box-shadow: 0 10px 15px -3px rgba(59, 130, 246, 0.4);
-            transform: translateY(-1px);
-        }
-
-        /* Sidebar Styling - Premium Look */
-        [data-testid="stSidebar"] {
-            background-color: #ffffff !important;
-            border-right: 1px solid #e2e8f0 !important;
-            box-shadow: 2px 0 10px rgba(0,0,0,0.02);
-        }
-        
-        /* Ensure sidebar content is always visible */
-        [data-testid="stSidebar"] [data-testid="stVerticalBlock"] {
-            padding-top: 2rem;
-        }
-
-        /* Menu Link Styling */
-        [data-testid="stSidebar"] .nav-link {
-            color: #0f172a !important; /* Deeper navy */
-            background-color: transparent !important;
-        }
-
-        [data-testid="stSidebar"] .nav-link .nav-link-text {
-            color: #0f172a !important;
-        }
-
-        /* Active Item Style */
-        [data-testid="stSidebar"] .nav-link.active {
-            background-color: var(--primary) !important;
-            color: white !important;
-        }
-        
-        [data-testid="stSidebar"] .nav-link.active .nav-link-text {
-            color: white !important;
-        }
-
-        /* Hide Streamlit components for cleaner UI */
-        #MainMenu {visibility: hidden;}
-        footer {visibility: hidden;}
-        /* header {visibility: hidden;}  <- DO NOT HIDE HEADER, it contains the sidebar toggle */
-
-        /* Responsive */
-        @media (max-width: 768px) {
-            .main .block-container { padding-left: 1rem; padding-right: 1rem; }
-            .metric-value { font-size: 1.5rem; }
-            .metric-card { padding: 1.25rem; }
-        }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(styles.style_block("style.css"), unsafe_allow_html=True)
 
 local_css()
 
@@ -244,18 +75,7 @@ def render_kpi_card(label, value, delta=None, icon="💰", sparkline_data=None,
     st.markdown(card_html, unsafe_allow_html=True)
     
     if sparkline_data is not None and not sparkline_data.empty:
-        fig = px.line(sparkline_data, x=sparkline_data.index, y=sparkline_data.columns[0], 
-                      color_discrete_sequence=['#3b82f6' if delta >= 0 else '#ef4444'])
-        fig.update_layout(
-            margin=dict(l=0, r=0, t=0, b=0),
-            height=40,
-            xaxis_visible=False,
-            yaxis_visible=False,
-            showlegend=False,
-            paper_bgcolor="rgba(0,0,0,0)",
-            plot_bgcolor="rgba(0,0,0,0)",
-            hovermode=False
-        )
+        fig = charts.sparkline(sparkline_data, '#3b82f6' if (delta or 0) >= 0 else '#ef4444')
         st.plotly_chart(fig, config={'displayModeBar': False}, use_container_width=True)
 
 # --- Helper Functions ---
@@ -301,12 +121,12 @@ def edit_transaction_dialog(row):
     # Get current categories for the selected type
     user_id = st.session_state.user['id']
     existing = db.get_all_categories(user_id, new_type)
-    options = sorted(list(set(defaults.get(new_type, []) + existing)))
+    # Most used first, then the suggestions not used yet
+    options = existing + [c for c in defaults.get(new_type, []) if c not in existing]
     
     # Ensure current category is in options if type hasn't changed
     if row['category'] not in options:
         options.append(row['category'])
-    options = sorted(list(set(options)))
     options.append("➕ Nova Categoria...")
     
     # Set default index for category
@@ -322,43 +142,113 @@ def edit_transaction_dialog(row):
     else:
         final_category = sel_cat
 
-    new_amount = st.number_input("Valor", value=float(row['amount']), min_value=0.01)
+    # Redemptions are stored as negative investments: the value is edited and the sign kept
+    redemption = float(row['amount']) < 0 and new_type == "Investimento"
+    new_amount = st.number_input("Valor do resgate" if redemption else "Valor", value=max(abs(float(row['amount'])), 0.01), min_value=0.01)
     new_desc = st.text_input("Descrição", value=row['description'])
     
     if st.button("Salvar Alterações", use_container_width=True):
         if sel_cat == "➕ Nova Categoria..." and not final_category:
             st.error("Digite o nome da categoria")
         else:
-            db.update_transaction(row['id'], new_date, new_type, final_category, new_amount, new_desc)
-            st.success("Atualizado!")
-            st.rerun()
+            if db.update_transaction(row['id'], new_date, new_type, final_category, -new_amount if redemption else new_amount, new_desc, user_id):
+                st.success("Atualizado!")
+                st.rerun()
+            else:
+                st.warning("Nada foi alterado: o registro não existe mais ou está arquivado.")
 
 @st.dialog("Confirmar Exclusão")
-def confirm_delete_transaction(transaction_id):
-    st.warning("⚠️ Tem certeza que deseja excluir esta transação?")
+def confirm_delete_transactions(transaction_ids, user_id):
+    st.warning(f"⚠️ Tem certeza que deseja excluir {len(transaction_ids)} transação(ões)?")
     st.caption("Esta ação não pode ser desfeita.")
     
     col1, col2 = st.columns(2)
     if col1.button("✅ Sim, excluir", type="primary"):
-        db.delete_transaction(transaction_id)
-        st.success("Transação excluída!")
-        st.rerun()
+        deleted = db.delete_transactions(transaction_ids, user_id)
+        if deleted == len(transaction_ids):
+            st.success("Transação excluída!")
+            st.rerun()
+        elif deleted:
+            st.warning(f"{deleted} de {len(transaction_ids)} transação(ões) excluída(s); as demais não existem mais.")
+        else:
+            st.warning("Nenhuma transação foi excluída: os registros não existem mais ou estão arquivados.")
     if col2.button("❌ Cancelar"):
         st.rerun()
 
 @st.dialog("Confirmar Exclusão")
-def confirm_delete_goal(goal_id):
+def confirm_delete_goal(goal_id, user_id):
     st.warning("⚠️ Tem certeza que deseja excluir esta meta?")
     st.caption("Esta ação não pode ser desfeita.")
     
     col1, col2 = st.columns(2)
     if col1.button("✅ Sim, excluir", type="primary"):
-        db.delete_goal(goal_id)
+        db.delete_goal(goal_id, user_id)
         st.success("Meta excluída!")
         st.rerun()
     if col2.button("❌ Cancelar"):
         st.rerun()
 
+@st.dialog("Confirmar Exclusão")
+def confirm_delete_users(user_ids):
+    st.warning(f"⚠️ Tem certeza que deseja excluir {len(user_ids)} usuário(s)?")
+    st.caption("Esta ação não pode ser desfeita.")
+    
+    col1, col2 = st.columns(2)
+    if col1.button("✅ Sim, excluir", type="primary"):
+        result = db.delete_users(user_ids)
+        if isinstance(result, str):
+            st.error(f"Erro: {result}")
+        else:
+            st.success(f"{result} usuário(s) excluído(s)!")
+            st.rerun()
+    if col2.button("❌ Cancelar"):
+        st.rerun()
+
+# --- Background Jobs ---
+def start_job(kind, user_id, payload=None):
+    """Queues a job for the user; errors (queue full, no database) are shown instead of raised."""
+    from core import jobs
+    try:
+        return jobs.enqueue(kind, user_id, payload=payload)
+    except FinanFlowError as e:
+        st.error(f"❌ {e}")
+        return None
+
+def job_panel(user_id, kind):
+    """Shows the state of the user's latest job of a kind and returns it (None when there is none)."""
+    from core import jobs
+    try:
+        job = jobs.latest_job(user_id, kind)
+    except FinanFlowError as e:
+        st.error(f"❌ {e}")
+        return None
+    if job is None:
+        return None
+    if job['status'] in jobs.ACTIVE_STATUSES:
+        job_progress(job['id'], user_id)
+    elif job['status'] == 'failed':
+        st.error(f"❌ A tarefa falhou: {job['error']}")
+    elif job['status'] == 'cancelled':
+        st.caption("🚫 Tarefa cancelada.")
+    return job
+
+@st.fragment(run_every=1)
+def job_progress(job_id, user_id):
+    # Polls only this block while the job is pending; the finished job is shown by a full rerun
+    from core import jobs
+    job = jobs.get_job(job_id, user_id)
+    if job is None or job['status'] not in jobs.ACTIVE_STATUSES:
+        # The worker wrote in another process: drop this process's cached reads of the user
+        db.invalidate_user_cache(user_id)
+        st.rerun()
+    label = job['message'] or ("⏳ Na fila..." if job['status'] == 'queued' else "⚙️ Processando...")
+    if job['attempts'] > 1:
+        label += f" (tentativa {job['attempts']})"
+    col_bar, col_cancel = st.columns([5, 1])
+    col_bar.progress(float(job['progress']), text=label)
+    if col_cancel.button("Cancelar", key=f"cancel_job_{job_id}", use_container_width=True):
+        jobs.cancel_job(job_id, user_id)
+
 # --- Tab Functions ---
 def tab_registros(user):
     st.subheader("📝 Registros Financeiros")
@@ -366,23 +256,39 @@ def tab_registros(user):
     # Filter
     mes, ano = get_month_year_filter()
     
-    # Summary Cards
-    income, expense, investment = db.get_monthly_summary(user['id'], mes, ano)
-    balance = income - expense - investment
+    # Each block below is a fragment: interacting with it reruns (and re-queries) only that block
+    registros_kpis(user['id'], mes, ano)
+    
+    st.divider()
+    
+    new_transaction_form(user, mes, ano)
+
+    # Exports and imports run as background jobs
+    report_jobs(user)
+
+    # History Table
+    st.subheader("Histórico do Mês")
+    transaction_history(user, mes, ano)
+
+@st.fragment
+def registros_kpis(user_id, mes, ano):
+    # Summary Cards: 12 months ending at the selected one, from a single aggregate query
+    series = db.get_monthly_series(user_id, mes, ano)
+    income, expense, investment, balance = series.iloc[-1][['Entrada', 'Saída', 'Investimento', 'Saldo']]
     
     # Responsive cards
     c1, c2, c3, c4 = st.columns(4)
     with c1:
-        render_kpi_card("Ganhos", income, icon="💰", show_delta=False)
+        render_kpi_card("Ganhos", income, icon="💰", sparkline_data=series[['Entrada']], show_delta=False)
     with c2:
-        render_kpi_card("Gastos", expense, icon="📉", show_delta=False) # Delta removed as requested
+        render_kpi_card("Gastos", expense, icon="📉", sparkline_data=series[['Saída']], show_delta=False) # Delta removed as requested
     with c3:
-        render_kpi_card("Investimentos", investment, icon="🏦", show_delta=False)
+        render_kpi_card("Investimentos", investment, icon="🏦", sparkline_data=series[['Investimento']], show_delta=False)
     with c4:
-        render_kpi_card("Saldo", balance, icon="⚖️", show_delta=False)
-    
-    st.divider()
-    
+        render_kpi_card("Saldo", balance, icon="⚖️", sparkline_data=series[['Saldo']], show_delta=False)
+
+@st.fragment
+def new_transaction_form(user, mes, ano):
     # New Register Form
     with st.expander("➕ Novo Registro", expanded=True):
         # Type selection OUTSIDE form for dynamic filtering
@@ -398,7 +304,8 @@ def tab_registros(user):
         # Show category selection based on type
         if r_type != "Selecione...":
             existing = db.get_all_categories(user['id'], r_type)
-            options = sorted(list(set(defaults.get(r_type, []) + existing)))
+            # Most used first, then the suggestions not used yet
+            options = existing + [c for c in defaults.get(r_type, []) if c not in existing]
             options.insert(0, "Selecione...")  # Add default option
             options.append("➕ Nova Categoria...")
             
@@ -453,61 +360,107 @@ def tab_registros(user):
                     else:
                         st.success("✅ Registro salvo com sucesso!")
                     
+                    # Totals and history changed: full rerun
                     st.rerun()
 
+def report_jobs(user):
+    """CSV export and statement import, run by the job workers with a progress bar here."""
+    from core import jobs
+    col_export, col_import = st.columns(2)
+    with col_export:
+        if st.button("📥 Preparar Relatório (CSV)", use_container_width=True):
+            start_job("export_transactions", user['id'])
+        export = job_panel(user['id'], "export_transactions")
+        if export and export['status'] == 'done':
+            data = jobs.get_job_output(export['id'], user['id'])
+            if data is not None:
+                st.download_button(
+                    label=f"📥 Baixar Relatório ({export['result']['rows']} registros)",
+                    data=data,
+                    file_name=export['result']['file_name'],
+                    mime="text/csv",
+                    use_container_width=True,
+                )
+    with col_import:
+        with st.popover("📤 Importar Extrato (CSV)", use_container_width=True):
+            st.caption("Colunas: date (AAAA-MM-DD), type (Entrada/Saída/Investimento), category, amount e description (opcional).")
+            uploaded = st.file_uploader("Arquivo CSV", type=["csv"], key="import_csv")
+            if st.button("Importar", disabled=uploaded is None, key="import_csv_start"):
+                start_job("import_transactions", user['id'], payload=uploaded.getvalue())
+        imported = job_panel(user['id'], "import_transactions")
+        if imported and imported['status'] == 'done' and imported['result']:
+            result = imported['result']
+            message = f"✅ Última importação: {result['imported']} registros"
+            if result['skipped']:
+                message += f", {result['skipped']} linhas ignoradas"
+            st.caption(message)
+            for error in result.get('errors', []):
+                st.caption(f"⚠️ {error}")
+
+@st.fragment
+def transaction_history(user, mes, ano):
+    start, end = db.month_bounds(mes, ano)
+    transaction_grid(user['id'], f"reg_{ano}_{mes}", start, end, empty_message="Nenhum registro neste mês.")
+
+@st.fragment
+def transaction_grid(user_id, key, start=None, end=None, type_filter=None, empty_message="Nenhum registro."):
+    """One paged grid instead of widgets per row; edit/delete act on the selected rows."""
+    page_size = db.TRANSACTION_PAGE_SIZE
+    page = st.session_state.get(f"page_{key}", 1)
+    df, total = db.get_transactions_page(user_id, start, end, type_filter, limit=page_size, offset=(page - 1) * page_size)
+    if df.empty and page > 1 and total > 0:
+        # Rows were deleted: jump back to the last existing page
+        page = st.session_state[f"page_{key}"] = (total + page_size - 1) // page_size
+        df, total = db.get_transactions_page(user_id, start, end, type_filter, limit=page_size, offset=(page - 1) * page_size)
+    if total == 0:
+        st.info(empty_message)
+        return
 
-
-    # History Table
-    st.subheader("Histórico do Mês")
-    
-    df = db.get_transactions_df(user['id'])
-    
-    if not df.empty:
-        # CSV Export
-        csv = df.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Baixar Relatório (CSV)",
-            data=csv,
-            file_name=f"FinanFlow_relatorio_{datetime.date.today()}.csv",
-            mime="text/csv",
-        )
-        
-        df['date'] = pd.to_datetime(df['date'])
-        mask = (df['date'].dt.month == mes) & (df['date'].dt.year == ano)
-        filtered_df = df[mask]
-        
-        if filtered_df.empty:
-            st.info("Nenhum registro neste mês.")
-        else:
-            # Responsive Card View
-            for idx, row in filtered_df.iterrows():
-                with st.container():
-                    st.markdown('<div class="insight-card" style="border-left-width: 0; padding: 1rem; margin-bottom: 0.5rem;">', unsafe_allow_html=True)
-                    # Flex-like layout using columns with specific weights
-                    col_info, col_actions = st.columns([6, 1], gap="small")
-                    
-                    with col_info:
-                        # Top row: Date and Category
-                        c_date, c_cat = st.columns([1, 4])
-                        c_date.caption(row['date'].strftime('%d/%m'))
-                        
-                        color = "green" if row['type'] == 'Entrada' else "red" if row['type'] == 'Saída' else "blue"
-                        c_cat.markdown(f"**{row['category']}** :{color}[ (R$ {row['amount']:.2f})]")
-                        
-                        # Bottom row: Description
-                        if row['description']:
-                            st.caption(f"📝 {row['description']}")
-                    
-                    with col_actions:
-                         # Buttons side by side or stacked based on mobile
-                         b1, b2 = st.columns(2)
-                         if b1.button("✏️", key=f"ed_{row['id']}", help="Editar"):
-                             edit_transaction_dialog(row)
-                         if b2.button("🗑️", key=f"del_{row['id']}", help="Excluir"):
-                             confirm_delete_transaction(row['id'])
-                    st.markdown('</div>', unsafe_allow_html=True)
+    df['date'] = pd.to_datetime(df['date'])
+    df['amount'] = df['amount'].astype(float)
+    grid = pd.DataFrame({
+        "date": df['date'],
+        "type": df['type'].map({"Entrada": "🟢 Entrada", "Saída": "🔴 Saída"}).fillna(
+            # Negative investments are redemptions
+            df['amount'].map(lambda a: "🟩 Resgate" if a < 0 else "🔵 Aporte")),
+        "category": df['category'],
+        "amount": df['amount'].abs(),
+        "description": df['description'],
+        "archived": df['archived'],
+    })
+    event = st.dataframe(
+        grid,
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=f"grid_{key}_{page}",
+        column_config={
+            "date": st.column_config.DateColumn("Data", format="DD/MM/YYYY"),
+            "type": st.column_config.TextColumn("Tipo"),
+            "category": st.column_config.TextColumn("Categoria"),
+            "amount": st.column_config.NumberColumn("Valor", format="R$ %.2f"),
+            "description": st.column_config.TextColumn("Descrição"),
+            "archived": st.column_config.CheckboxColumn("Arquivado", help="Anos arquivados são somente leitura"),
+        },
+        column_order=None if df['archived'].any() else ["date", "type", "category", "amount", "description"],
+    )
+    selected = df.iloc[event.selection.rows]
+    # Archived years live in cold storage: their rows can be seen but not edited or deleted
+    read_only = bool(selected['archived'].any())
+
+    n_pages = (total + page_size - 1) // page_size
+    b1, b2, b_info, b_page = st.columns([1, 1, 2, 1])
+    if b1.button("✏️ Editar", key=f"edit_{key}", disabled=len(selected) != 1 or read_only, use_container_width=True):
+        edit_transaction_dialog(selected.iloc[0])
+    if b2.button("🗑️ Excluir", key=f"delete_{key}", disabled=selected.empty or read_only, use_container_width=True):
+        confirm_delete_transactions(selected['id'].tolist(), user_id)
+    b_info.caption(f"{total} registros • {len(selected)} selecionado(s)" + (" • arquivados são somente leitura" if read_only else ""))
+    if n_pages > 1:
+        b_page.number_input("Página", min_value=1, max_value=n_pages, key=f"page_{key}", label_visibility="collapsed")
 
 def tab_dashboard(user):
+    from core import anomalies
     st.markdown("### 📊 Dashboard Estratégico")
     
     df_all = db.get_transactions_df(user['id'])
@@ -537,31 +490,21 @@ def tab_dashboard(user):
         df_chart = df_all
         df_prev = pd.DataFrame()
 
-    def calc_totals(df):
-        if df.empty: return 0.0, 0.0, 0.0, 0.0
-        income = df[df['type'] == 'Entrada']['amount'].sum()
-        expense = df[df['type'] == 'Saída']['amount'].sum()
-        invest = df[df['type'] == 'Investimento']['amount'].sum()
-        balance = income - expense - invest
-        return income, expense, invest, balance
-
-    cur_inc, cur_exp, cur_inv, cur_bal = calc_totals(df_chart)
-    pre_inc, pre_exp, pre_inv, pre_bal = calc_totals(df_prev)
-    
-    def get_delta(cur, pre):
-        if pre == 0: return 0.0
-        return ((cur - pre) / pre) * 100
+    cur_inc, cur_exp, cur_inv, cur_bal = aggregations.period_totals(df_chart)
+    pre_inc, pre_exp, pre_inv, pre_bal = aggregations.period_totals(df_prev)
+    get_delta = aggregations.pct_change
         
-    # KPIs
+    # KPIs with the 12 months up to the selected (or current) month as sparklines
+    series = db.get_monthly_series(user['id'], mes, ano) if time_filter == "Mês" else db.get_monthly_series(user['id'])
     kpi_col1, kpi_col2, kpi_col3, kpi_col4 = st.columns(4)
     with kpi_col1:
-        render_kpi_card("Receita", cur_inc, get_delta(cur_inc, pre_inc), "📈")
+        render_kpi_card("Receita", cur_inc, get_delta(cur_inc, pre_inc), "📈", sparkline_data=series[['Entrada']])
     with kpi_col2:
-        render_kpi_card("Despesas", cur_exp, get_delta(cur_exp, pre_exp), "📉")
+        render_kpi_card("Despesas", cur_exp, get_delta(cur_exp, pre_exp), "📉", sparkline_data=series[['Saída']])
     with kpi_col3:
-        render_kpi_card("Investimentos", cur_inv, get_delta(cur_inv, pre_inv), "🏦")
+        render_kpi_card("Investimentos", cur_inv, get_delta(cur_inv, pre_inv), "🏦", sparkline_data=series[['Investimento']])
     with kpi_col4:
-        render_kpi_card("Saldo Líquido", cur_bal, get_delta(cur_bal, pre_bal), "⚖️")
+        render_kpi_card("Saldo Líquido", cur_bal, get_delta(cur_bal, pre_bal), "⚖️", sparkline_data=series[['Saldo']])
 
     st.write("") 
 
@@ -570,32 +513,16 @@ def tab_dashboard(user):
     with col_main:
         st.subheader("Fluxo de Caixa e Tendência")
         
-        df_daily = df_chart.copy()
-        df_daily['date_day'] = df_daily['date'].dt.strftime('%d/%m')
-        
-        daily_pivot = df_daily.pivot_table(index='date_day', columns='type', values='amount', aggfunc='sum').fillna(0)
-        for col in ['Entrada', 'Saída', 'Investimento']:
-            if col not in daily_pivot.columns: daily_pivot[col] = 0
-            
-        daily_pivot['Saldo'] = daily_pivot['Entrada'] - daily_pivot['Saída'] - daily_pivot['Investimento']
-        daily_pivot['Saldo Acumulado'] = daily_pivot['Saldo'].cumsum()
-        
-        import plotly.graph_objects as go
-        fig_combined = go.Figure()
-        fig_combined.add_trace(go.Bar(x=daily_pivot.index, y=daily_pivot['Entrada'], name='Receita', marker_color='#10b981'))
-        fig_combined.add_trace(go.Bar(x=daily_pivot.index, y=daily_pivot['Saída'], name='Despesa', marker_color='#ef4444'))
-        fig_combined.add_trace(go.Scatter(x=daily_pivot.index, y=daily_pivot['Saldo Acumulado'], name='Saldo Acum.', 
-                                        line=dict(color='#3b82f6', width=3), yaxis='y2'))
+        # Real-date buckets (day/week/month by range size), gaps filled, capped number of points
+        if time_filter == "Mês":
+            start, end = db.month_bounds(mes, ano)
+            daily_pivot, granularity = aggregations.cashflow_series(df_chart, start, end - datetime.timedelta(days=1))
+        else:
+            daily_pivot, granularity = aggregations.cashflow_series(df_chart)
+        st.caption(f"Agrupado por {granularity}")
         
-        fig_combined.update_layout(
-            yaxis=dict(title="Valores (R$)"),
-            yaxis2=dict(title="Acumulado (R$)", overlaying='y', side='right'),
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-            margin=dict(l=0, r=0, t=30, b=0),
-            hovermode="x unified",
-            height=400,
-            template="plotly_white"
-        )
+        # Figures are cached by data fingerprint: an unchanged chart is not rebuilt on rerun
+        fig_combined = charts.cashflow_chart(daily_pivot)
         st.plotly_chart(fig_combined, use_container_width=True)
 
 
@@ -604,14 +531,7 @@ def tab_dashboard(user):
         expenses = df_chart[df_chart['type'] == 'Saída'].groupby('category')['amount'].sum().reset_index()
         if not expenses.empty:
             expenses = expenses.sort_values(by='amount', ascending=False)
-            fig_donut = px.pie(expenses, values='amount', names='category', hole=0.6,
-                              color_discrete_sequence=px.colors.sequential.RdBu)
-            fig_donut.update_layout(
-                showlegend=True,
-                margin=dict(l=0, r=0, t=0, b=0),
-                height=350,
-                annotations=[dict(text=f'Total Gastos<br>R$ {cur_exp:,.2f}', x=0.5, y=0.5, font_size=12, showarrow=False)]
-            )
+            fig_donut = charts.expense_donut(expenses, cur_exp)
             st.plotly_chart(fig_donut, use_container_width=True)
         else:
             st.info("Nenhuma despesa registrada para este período.")
@@ -637,6 +557,106 @@ def tab_dashboard(user):
         color = "#10b981" if cur_bal > 0 else "#ef4444"
         st.markdown(f"""<div class="insight-card" style="border-left-color: {color};"><b>Fluxo de Caixa</b><br>Seu saldo está {status}.</div>""", unsafe_allow_html=True)
 
+    # Unusual spending of the selected (or current) month against the user's own history
+    month = datetime.date(ano, mes, 1) if time_filter == "Mês" else datetime.date.today().replace(day=1)
+    monthly, daily = db.get_expense_history(user['id'], month, anomalies.ANOMALY_BASELINE_MONTHS, anomalies.DAY_BASELINE_DAYS)
+    found = anomalies.detect(monthly, daily, month)
+    st.write("")
+    if found.empty:
+        st.caption("✅ Nenhum gasto fora do padrão no mês.")
+    else:
+        for col, anomaly in zip(st.columns(ANOMALY_CARDS), found.head(ANOMALY_CARDS).itertuples()):
+            with col:
+                st.markdown(f"""<div class="insight-card" style="border-left-color: #f59e0b;">{anomaly_text(anomaly)}</div>""", unsafe_allow_html=True)
+        if len(found) > ANOMALY_CARDS:
+            st.caption(f"+{len(found) - ANOMALY_CARDS} outros gastos fora do padrão no mês.")
+
+def anomaly_text(anomaly):
+    """Card text of one row of core.anomalies.detect."""
+    from core import anomalies
+    if anomaly.kind == 'pico':
+        if anomaly.baseline <= 0:
+            return f"<b>Gasto Atípico</b><br>'{anomaly.category}' somou R$ {anomaly.amount:,.2f}, em geral sem gastos no mês."
+        return (f"<b>Gasto Atípico</b><br>'{anomaly.category}' somou R$ {anomaly.amount:,.2f}, "
+                f"{anomaly.amount / anomaly.baseline:.1f}x o habitual (R$ {anomaly.baseline:,.2f} por mês).")
+    if anomaly.kind == 'recorrente':
+        return (f"<b>Nova Cobrança Recorrente</b><br>'{anomaly.category}' subiu cerca de "
+                f"R$ {anomaly.amount - anomaly.baseline:,.2f} por mês nos últimos {anomalies.RECURRING_MONTHS} meses.")
+    return (f"<b>Dia Atípico</b><br>Em {anomaly.period:%d/%m} você gastou R$ {anomaly.amount:,.2f}, "
+            f"contra R$ {anomaly.baseline:,.2f} num dia típico.")
+
+def current_month_end():
+    """Last day of the current month as 'YYYY-MM-DD' (the portfolio snapshot date of the default filters)."""
+    today = datetime.date.today()
+    return f"{today.year}-{today.month:02d}-{calendar.monthrange(today.year, today.month)[1]}"
+
+def project_goals(user_id, goals, profile_of):
+    """Monte Carlo completion of goals (DataFrame with category, current, target) from the user's contributions."""
+    from core import projections
+    history = projections.monthly_contributions(db.get_transactions_df(user_id))
+    assumptions = {cat: (profile_of(cat)['perf'], profile_of(cat)['vol']) for cat in goals['category']}
+    # Seeded per user so the dates do not jump between reruns
+    return projections.project_goals(goals, history, assumptions, seed=user_id)
+
+def goal_eta_caption(container, projection):
+    """Estimated completion month with the 10%-90% range, or how likely the goal is within the horizon."""
+    from core import projections
+    if pd.isna(projection['eta_p50']):
+        years = projections.PROJECTION_MONTHS // 12
+        container.caption(f"🔮 {projection['probability']*100:.0f}% de chance de atingir em {years} anos no ritmo atual")
+        return
+    eta = f"🔮 Previsão: {projection['eta_p50']:%m/%Y}"
+    if pd.isna(projection['eta_p90']):
+        container.caption(f"{eta} (a partir de {projection['eta_p10']:%m/%Y})")
+    else:
+        container.caption(f"{eta} (entre {projection['eta_p10']:%m/%Y} e {projection['eta_p90']:%m/%Y})")
+
+@st.fragment
+def portfolio_row(user_id, row, prof, target, projection=None):
+    # Saving the goal reruns only this row; the redemption dialog reruns the app after writing
+    target = st.session_state.get("goal_targets", {}).get(row['category'], target)
+    progress = min(row['total'] / target, 1.0) if target > 0 else 0.0
+    if target > 0 and progress < 1.0 and (projection is None or projection['target'] != target):
+        current = projection['current'] if projection is not None else row['total']
+        goal = pd.DataFrame({'category': [row['category']], 'current': [current], 'target': [target]})
+        projection = project_goals(user_id, goal, lambda _: prof)[0].iloc[0]
+    
+    with st.container(border=True):
+        col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+        
+        # Asset & Progress
+        col1.write(f"**{row['category']}**")
+        col1.caption(prof['type'])
+        if target > 0:
+            prog_color = "green" if progress >= 1.0 else "blue"
+            col1.progress(progress)
+            col1.caption(f":{prog_color}[**{progress*100:.1f}% da meta (R$ {target:,.0f})**]")
+            if progress < 1.0:
+                goal_eta_caption(col1, projection)
+        else:
+            col1.caption("🏁 Nenhuma meta definida")
+        
+        # Value & Liquidity
+        col2.write(f"R$ {row['total']:,.2f}")
+        badge_html = f'<span style="background-color: {prof["color"]}; color: white; padding: 2px 8px; border-radius: 4px; font-size: 0.7rem;">{prof["term"]}</span>'
+        col2.markdown(badge_html, unsafe_allow_html=True)
+        
+        # Actions: Goal & Redemption
+        with col3:
+            with st.popover("🎯 Meta"):
+                new_target = st.number_input("Definir Alvo (R$)", value=float(target), step=1000.0, key=f"target_{row['category']}")
+                if st.button("Salvar Meta", key=f"btn_target_{row['category']}", use_container_width=True):
+                    db.update_goal_target(user_id, row['category'], new_target)
+                    st.session_state.goal_targets[row['category']] = new_target
+                    st.success("Meta salva!")
+                    st.rerun(scope="fragment")
+
+        if prof['status'] == "Disponível":
+            if col4.button("Resgatar", key=f"res_{row['category']}"):
+                redemption_dialog(user_id, row['category'], row['total'])
+        else:
+            col4.write("🔒 Bloqueado")
+
 @st.dialog("Resgate de Investimento")
 def redemption_dialog(user_id, category, current_balance):
     st.write(f"Você está resgatando de: **{category}**")
@@ -666,17 +686,17 @@ def redemption_dialog(user_id, category, current_balance):
             final_description
         )
         
-        if success is True:
+        if success:
             st.success(f"✅ Resgate de R$ {amount_to_redeem:,.2f} realizado!")
             st.balloons()
             # Adding a small sleep to ensure user sees success before rerun
-            import time
             time.sleep(1)
             st.rerun()
         else:
             st.error(f"Erro: {success}")
 
 def tab_investimentos(user):
+    from core import projections
     st.markdown("### 🎯 Gestão de Investimentos")
     
     # 1. Filtros de Período (Igual ao Dashboard)
@@ -707,23 +727,15 @@ def tab_investimentos(user):
     # The user asked to see "what happened in the month". 
     # Let's show KPIs of "Aportes" and "Resgates" in the month, while keeping "Total" as cumulative.
     
-    def get_period_stats(df):
-        if df.empty: return 0.0, 0.0
-        inv_df = df[df['type'] == 'Investimento']
-        aportes = inv_df[inv_df['amount'] > 0]['amount'].sum()
-        resgates = abs(inv_df[inv_df['amount'] < 0]['amount'].sum())
-        return aportes, resgates
-
     as_of_date = None
     label_patrimonio = "Patrimônio Total"
     if time_filter == "Mês":
         # Get last day of the selected month
-        import calendar
         last_day = calendar.monthrange(ano, mes)[1]
         as_of_date = f"{ano}-{mes:02d}-{last_day}"
         label_patrimonio = f"Patrimônio em {calendar.month_name[mes][:3].capitalize()}/{ano % 100}"
     
-    aportes_mes, resgates_mes = get_period_stats(df_filtered)
+    aportes_mes, resgates_mes = aggregations.investment_flows(df_filtered)
     # Get portfolio value UP TO the selected date (with fallback for sync issues)
     try:
         total_patrimonio = db.get_total_portfolio_value(user['id'], as_of_date)
@@ -731,16 +743,20 @@ def tab_investimentos(user):
         total_patrimonio = db.get_total_portfolio_value(user['id'])
     
     # Mapping for simulated liquidity profiles
+    # perf: expected annual yield (%); vol: annual volatility (%), used by the goal projections
     liquidity_profiles = {
-        "Reserva de Emergência": {"term": "D+0", "type": "Pós-fixado", "perf": 10.5, "color": "#10b981", "status": "Disponível"},
-        "CDB": {"term": "D+0", "type": "CDB Pós", "perf": 11.2, "color": "#10b981", "status": "Disponível"},
-        "Tesouro Direto": {"term": "D+1", "type": "Tesouro Selic", "perf": 10.8, "color": "#3b82f6", "status": "Disponível"},
-        "Ações": {"term": "D+2", "type": "Renda Variável", "perf": 14.2, "color": "#f59e0b", "status": "Disponível"},
-        "Fundos Imobiliários": {"term": "D+2", "type": "FIIs", "perf": 9.5, "color": "#f59e0b", "status": "Disponível"},
-        "Crypto": {"term": "D+0", "type": "Altcoins", "perf": 45.0, "color": "#10b981", "status": "Disponível"},
-        "Default": {"term": "D+30+", "type": "Outros", "perf": 8.0, "color": "#ef4444", "status": "Em Carência"}
+        "Reserva de Emergência": {"term": "D+0", "type": "Pós-fixado", "perf": 10.5, "vol": 0.5, "color": "#10b981", "status": "Disponível"},
+        "CDB": {"term": "D+0", "type": "CDB Pós", "perf": 11.2, "vol": 0.8, "color": "#10b981", "status": "Disponível"},
+        "Tesouro Direto": {"term": "D+1", "type": "Tesouro Selic", "perf": 10.8, "vol": 1.5, "color": "#3b82f6", "status": "Disponível"},
+        "Ações": {"term": "D+2", "type": "Renda Variável", "perf": 14.2, "vol": 25.0, "color": "#f59e0b", "status": "Disponível"},
+        "Fundos Imobiliários": {"term": "D+2", "type": "FIIs", "perf": 9.5, "vol": 15.0, "color": "#f59e0b", "status": "Disponível"},
+        "Crypto": {"term": "D+0", "type": "Altcoins", "perf": 45.0, "vol": 70.0, "color": "#10b981", "status": "Disponível"},
+        "Default": {"term": "D+30+", "type": "Outros", "perf": 8.0, "vol": 5.0, "color": "#ef4444", "status": "Em Carência"}
     }
 
+    def get_profile(cat):
+        return liquidity_profiles.get(cat, liquidity_profiles["Default"])
+
     t1, t2 = st.tabs(["🛡️ Patrimônio e Liquidez", "📊 Análise de Portfólio"])
     
     # Fetch goals to display progress
@@ -754,14 +770,22 @@ def tab_investimentos(user):
     except TypeError:
         portfolio_df = db.get_portfolio_summary(user['id'])
 
+    # Goal projections start from today's balances, whatever period is selected
+    current_df = db.get_portfolio_summary(user['id'], current_month_end())
+    current_totals = dict(zip(current_df['category'], current_df['total'])) if not current_df.empty else {}
+    open_goals = pd.DataFrame({
+        'category': [cat for cat, t in goals_dict.items() if t > 0 and current_totals.get(cat, 0.0) < t],
+    })
+    open_goals['current'] = [float(current_totals.get(cat, 0.0)) for cat in open_goals['category']]
+    open_goals['target'] = [float(goals_dict[cat]) for cat in open_goals['category']]
+    goal_summary, goal_bands = project_goals(user['id'], open_goals, get_profile)
+    goal_summary = goal_summary.set_index('category', drop=False)
+
     with t1:
         if total_patrimonio <= 0 and aportes_mes == 0:
             st.info("📊 Selecione um período com movimentações ou adicione novos investimentos.")
         else:
             # Prepare liquidity data from the SNAPSHOT balance
-            def get_profile(cat):
-                return liquidity_profiles.get(cat, liquidity_profiles["Default"])
-            
             portfolio_df['term'] = portfolio_df['category'].apply(lambda x: get_profile(x)['term'])
             portfolio_df['status'] = portfolio_df['category'].apply(lambda x: get_profile(x)['status'])
             portfolio_df['color'] = portfolio_df['category'].apply(lambda x: get_profile(x)['color'])
@@ -784,69 +808,23 @@ def tab_investimentos(user):
             # Asset Availability Table (Full Width)
             st.subheader("Disponibilidade e Resgate")
             
+            # Goals saved from a row's popover during fragment reruns; a full run reads them from goals_dict
+            st.session_state.goal_targets = {}
             for _, row in portfolio_df.iterrows():
-                prof = get_profile(row['category'])
                 if row['total'] <= 0.01: continue
-                
-                target = goals_dict.get(row['category'], 0.0)
-                progress = min(row['total'] / target, 1.0) if target > 0 else 0.0
-                
-                with st.container(border=True):
-                    col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
-                    
-                    # Asset & Progress
-                    col1.write(f"**{row['category']}**")
-                    col1.caption(prof['type'])
-                    if target > 0:
-                        prog_color = "green" if progress >= 1.0 else "blue"
-                        col1.progress(progress)
-                        col1.caption(f":{prog_color}[**{progress*100:.1f}% da meta (R$ {target:,.0f})**]")
-                    else:
-                        col1.caption("🏁 Nenhuma meta definida")
-                    
-                    # Value & Liquidity
-                    col2.write(f"R$ {row['total']:,.2f}")
-                    badge_html = f'<span style="background-color: {prof["color"]}; color: white; padding: 2px 8px; border-radius: 4px; font-size: 0.7rem;">{prof["term"]}</span>'
-                    col2.markdown(badge_html, unsafe_allow_html=True)
-                    
-                    # Actions: Goal & Redemption
-                    with col3:
-                        with st.popover("🎯 Meta"):
-                            new_target = st.number_input("Definir Alvo (R$)", value=float(target), step=1000.0, key=f"target_{row['category']}")
-                            if st.button("Salvar Meta", key=f"btn_target_{row['category']}", use_container_width=True):
-                                db.update_goal_target(user['id'], row['category'], new_target)
-                                st.success("Meta salva!")
-                                st.rerun()
-
-                    if prof['status'] == "Disponível":
-                        if col4.button("Resgatar", key=f"res_{row['category']}"):
-                            redemption_dialog(user['id'], row['category'], row['total'])
-                    else:
-                        col4.write("🔒 Bloqueado")
-
+                projection = goal_summary.loc[row['category']] if row['category'] in goal_summary.index else None
+                portfolio_row(user['id'], row, get_profile(row['category']), goals_dict.get(row['category'], 0.0), projection)
 
             # Investment History - FILTERED by period
             st.write("")
             st.subheader(f"⌛ Movimentações - {time_filter}")
             
-            # Using df_filtered which respects the selected month/all period
-            inv_history = df_filtered[df_filtered['type'] == 'Investimento'].sort_values('date', ascending=False)
-            
-            if inv_history.empty:
-                st.caption(f"Nenhuma movimentação de investimento em {time_filter.lower()}.")
-            else:
-                for _, row in inv_history.iterrows():
-                    c1, c2, c3 = st.columns([1, 3, 2])
-                    date_obj = pd.to_datetime(row['date'])
-                    c1.caption(date_obj.strftime('%d/%m/%y'))
-                    c2.write(f"**{row['category']}**")
-                    # Transparently show the reason/description
-                    desc = row['description'] if row['description'] else "Aporte"
-                    c2.caption(f"Nota: {desc}")
-                    
-                    color = "green" if row['amount'] < 0 else "blue" 
-                    label = "Resgate" if row['amount'] < 0 else "Aporte"
-                    c3.markdown(f":{color}[**{label}: R$ {abs(row['amount']):,.2f}**]")
+            # Same period as the filter: the selected month or everything
+            start, end = db.month_bounds(mes, ano) if time_filter == "Mês" else (None, None)
+            transaction_grid(
+                user['id'], f"inv_{time_filter}_{start}", start, end, type_filter="Investimento",
+                empty_message=f"Nenhuma movimentação de investimento em {time_filter.lower()}."
+            )
 
 
     with t2:
@@ -856,40 +834,95 @@ def tab_investimentos(user):
             col1, col2 = st.columns(2)
             with col1:
                 st.subheader("🥧 Composição")
-                fig_pie = px.pie(portfolio_df, values='total', names='category', hole=0.4)
+                fig_pie = charts.composition_pie(portfolio_df)
                 st.plotly_chart(fig_pie, use_container_width=True)
             
             with col2:
                 evolution_df = db.get_portfolio_evolution(user['id'])
                 if not evolution_df.empty:
                     st.subheader("📈 Evolução")
-                    fig_line = px.line(evolution_df, x='month', y='cumulative_total', markers=True)
+                    fig_line = charts.evolution_line(evolution_df)
                     st.plotly_chart(fig_line, use_container_width=True)
         else:
             st.info("Sem dados para análise.")
 
+        if goal_bands:
+            st.subheader("🔮 Projeção das Metas")
+            st.caption(
+                f"{projections.PROJECTION_PATHS} simulações com o seu ritmo de aportes dos últimos "
+                f"{projections.CONTRIBUTION_MONTHS} meses e o rendimento e a volatilidade esperados de cada categoria."
+            )
+            goal = st.selectbox("Meta", list(goal_bands), key="projection_goal", label_visibility="collapsed")
+            projection = goal_summary.loc[goal]
+            goal_eta_caption(st, projection)
+            st.plotly_chart(charts.goal_projection(goal_bands[goal], projection['target']), use_container_width=True)
+
+GREETING = "Olá! Sou o FinanBot. Analisei seus dados e estou pronto para ajudar você a otimizar suas finanças. O que gostaria de saber?"
+
+def remember_turn(role, content, cached_at=None):
+    """Adds a turn to the session window, dropping the oldest beyond CHAT_WINDOW (they stay in the database)."""
+    from core import chat
+    messages = st.session_state.messages
+    messages.append({"role": role, "content": content, "cached_at": cached_at})
+    if len(messages) > chat.CHAT_WINDOW:
+        del messages[:len(messages) - chat.CHAT_WINDOW]
+        st.session_state.chat_has_older = True
+
+def cached_note(cached_at):
+    """Caption marking an answer reused from the response cache."""
+    generated = datetime.datetime.fromtimestamp(cached_at).strftime('%H:%M')
+    st.caption(f"⚡ Resposta em cache, gerada às {generated} — seus dados não mudaram desde então.")
+
 def tab_ia(user):
+    from core import chat, jobs
     st.markdown("### 🤖 FinanBot - Consultor Estratégico")
     
-    # Initialize message history
-    if "messages" not in st.session_state:
+    # Only the last CHAT_WINDOW turns live in the session; the conversation itself is in the database
+    if st.session_state.get("chat_user") != user['id']:
+        st.session_state.chat_user = user['id']
         st.session_state.messages = [
-            {"role": "assistant", "content": "Olá! Sou o FinanBot. Analisei seus dados e estou pronto para ajudar você a otimizar suas finanças. O que gostaria de saber?"}
+            {"role": m['role'], "content": m['content']} for m in db.get_chat_messages(user['id'], limit=chat.CHAT_WINDOW)
         ]
+        st.session_state.chat_older = []
+        st.session_state.chat_has_older = len(st.session_state.messages) == chat.CHAT_WINDOW
 
     # Sidebar / Toolbar for Chat
     col_chat1, col_chat2 = st.columns([5, 1])
     with col_chat2:
-        if st.button("🗑️ Limpar", use_container_width=True, help="Limpar histórico da conversa"):
-            st.session_state.messages = [
-                {"role": "assistant", "content": "Histórico limpo! Como posso ajudar agora?"}
-            ]
-            st.rerun()
+        if st.button("🗑️ Limpar", use_container_width=True, help="Apagar o histórico da conversa"):
+            result = db.clear_chat_history(user['id'])
+            if isinstance(result, str):
+                st.error(f"Erro: {result}")
+            else:
+                st.session_state.messages = []
+                st.session_state.chat_older = []
+                st.session_state.chat_has_older = False
+                chat.forget_answers(user['id'])
+                st.rerun()
+
+    # Older turns are paged in on demand, up to CHAT_OLDER_MAX per session
+    older = st.session_state.chat_older
+    if st.session_state.chat_has_older and len(older) < chat.CHAT_OLDER_MAX:
+        if st.button("⬆️ Carregar mensagens anteriores"):
+            shown = len(older) + len(st.session_state.messages)
+            page = db.get_chat_messages(user['id'], limit=db.CHAT_PAGE_SIZE, offset=shown)
+            st.session_state.chat_older = older = [{"role": m['role'], "content": m['content']} for m in page] + older
+            st.session_state.chat_has_older = len(page) == db.CHAT_PAGE_SIZE
+    if older:
+        with st.expander(f"Mensagens anteriores ({len(older)})"):
+            for message in older:
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
 
     # Display chat history
+    if not st.session_state.messages and not older:
+        with st.chat_message("assistant"):
+            st.markdown(GREETING)
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if message.get("cached_at"):
+                cached_note(message["cached_at"])
 
     # Quick Suggestions (Auto-stacks on mobile)
     st.write("")
@@ -906,14 +939,22 @@ def tab_ia(user):
     if q2: selected_suggestion = "Com base no meu saldo e metas, qual a melhor estratégia de investimento agora?"
     if q3: selected_suggestion = "Faça um resumo executivo da minha saúde financeira comparando com o mês passado."
 
+    # A cached suggestion answer can be regenerated on request
+    refresh = st.session_state.pop("chat_refresh", None)
+    if refresh:
+        selected_suggestion = refresh
+
     # Chat input
     prompt = st.chat_input("Perqunte sobre seus gastos, investimentos ou peça uma dica...")
     if selected_suggestion:
         prompt = selected_suggestion
 
     if prompt:
-        # Add user message to history
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        # Fixed-size history (summary, related and latest turns), read before the question is stored.
+        # Suggestions are answered from the data alone, so their answers can be reused.
+        history = "" if selected_suggestion else chat.history_for_prompt(user['id'], prompt)
+        db.add_chat_message(user['id'], "user", prompt)
+        remember_turn("user", prompt)
         with st.chat_message("user"):
             st.markdown(prompt)
 
@@ -922,74 +963,82 @@ def tab_ia(user):
         
         # Prepare AI response
         with st.chat_message("assistant"):
-            if genai is None:
-                st.error("Erro: Biblioteca 'google-generativeai' não instalada.")
+            if not db.get_secret("GEMINI_API_KEY"):
+                st.warning("⚠️ Chave GEMINI_API_KEY não configurada nos Secrets.")
                 return
 
-            try:
-                # Configuration from secrets
-                if "GEMINI_API_KEY" not in st.secrets:
-                    st.warning("⚠️ Chave GEMINI_API_KEY não configurada nos Secrets.")
-                    return
-                    
-                genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-                
-                # Stable models based on API model list
-                available_models = [
-                    'gemini-1.5-flash',
-                    'gemini-flash-latest', 
-                    'gemini-pro-latest',
-                    'gemini-2.0-flash'
-                ]
-                last_error = "Nenhum modelo disponível respondeu."
-                success_ai = False
-                
+            # Context Injection
+            system_prompt = f"""
+            Você é o FinanBot, um consultor financeiro brasileiro.
+            DADOS DO USUÁRIO EM JSON:
+            {json.dumps(context, indent=2, ensure_ascii=False)}
+            
+            REGRAS:
+            1. Analise os gastos e identifique categorias críticas.
+            2. Sugira economia onde houver aumento no mês.
+            3. Responda em Português (Brasil) com tom profissional.
+            4. Use Markdown (listas, negrito).
+            5. Use o histórico da conversa só como contexto; responda à PERGUNTA.
+            """
+            history_block = f"\n\n{history}" if history else ""
+
+            full_prompt = f"{system_prompt}{history_block}\n\nPERGUNTA: {prompt}"
+
+            fingerprint = chat.context_fingerprint(context) if selected_suggestion else None
+            cached = None
+            if selected_suggestion and not refresh:
+                cached = chat.cached_answer(user['id'], prompt, fingerprint)
+            if cached:
+                full_response, _, cached_at = cached
+            else:
+                cached_at = None
                 with st.status("🤖 FinanBot está analisando seus dados...", expanded=True) as status:
-                    for model_name in available_models:
-                        try:
-                            # Log and try each model
-                            model = genai.GenerativeModel(model_name)
-                            
-                            # Context Injection
-                            system_prompt = f"""
-                            Você é o FinanBot, um consultor financeiro brasileiro.
-                            DADOS DO USUÁRIO EM JSON:
-                            {json.dumps(context, indent=2, ensure_ascii=False)}
-                            
-                            REGRAS:
-                            1. Analise os gastos e identifique categorias críticas.
-                            2. Sugira economia onde houver aumento no mês.
-                            3. Responda em Português (Brasil) com tom profissional.
-                            4. Use Markdown (listas, negrito).
-                            """
-                            
-                            # Simple completion instead of chat for faster response
-                            response = model.generate_content(f"{system_prompt}\n\nPERGUNTA: {prompt}")
-                            
-                            if response and response.text:
-                                full_response = response.text
-                                status.update(label="✅ Análise concluída!", state="complete", expanded=False)
-                                st.markdown(full_response)
-                                # Add assistant response to history
-                                st.session_state.messages.append({"role": "assistant", "content": full_response})
-                                success_ai = True
-                                break 
-                        except Exception as inner_e:
-                            last_error = str(inner_e)
-                            # Silently continue to next model to avoid cluterring the UI with quote errors
-                            continue 
-                    
-                    if not success_ai:
+                    try:
+                        # Simple completion instead of chat for faster response
+                        if selected_suggestion:
+                            full_response, _, _ = chat.generate_cached(
+                                user['id'], prompt, full_prompt, fingerprint, refresh=True
+                            )
+                        else:
+                            full_response, _ = chat.generate(full_prompt)
+                    except RuntimeError as e:
                         status.update(label="❌ Falha na análise", state="error", expanded=True)
-                        st.error(f"Não foi possível obter resposta de nenhum modelo da IA.\n\nÚltimo erro: {last_error}")
-                        st.session_state.messages.append({"role": "assistant", "content": f"Erro técnico: {last_error}"})
-                    # st.rerun() removed to avoid flashing/reset issues
-
-            except Exception as e:
-                error_msg = f"Ocorreu um erro na IA: {str(e)}"
-                st.error(error_msg)
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
-
+                        st.error(f"Não foi possível obter resposta de nenhum modelo da IA.\n\nÚltimo erro: {e}")
+                        return
+                    status.update(label="✅ Análise concluída!", state="complete", expanded=False)
+            st.markdown(full_response)
+            if cached_at:
+                cached_note(cached_at)
+                # The callback runs before the next script run, when this button is no longer drawn
+                st.button("🔄 Gerar nova resposta", key="chat_refresh_button",
+                          on_click=st.session_state.__setitem__, args=("chat_refresh", prompt))
+            db.add_chat_message(user['id'], "assistant", full_response)
+            remember_turn("assistant", full_response, cached_at)
+
+        # Old turns are folded into the rolling summary by a background job
+        try:
+            if chat.needs_summary(user['id']):
+                jobs.enqueue("summarize_chat", user['id'])
+        except FinanFlowError:
+            pass
+
+
+def prefetch_tab_data(user):
+    """Starts loading in parallel what each tab reads with its default filters (current month)."""
+    from core import anomalies
+    today = datetime.date.today()
+    month_end = current_month_end()
+    db.prefetch_user_data(user['id'], [
+        (db.get_transactions_df,),
+        (db.get_monthly_series, today.month, today.year),
+        (db.get_expense_history, today.replace(day=1), anomalies.ANOMALY_BASELINE_MONTHS, anomalies.DAY_BASELINE_DAYS),
+        (db.get_monthly_series,),
+        (db.get_goals,),
+        (db.get_total_portfolio_value, month_end),
+        (db.get_portfolio_summary, month_end),
+        (db.get_portfolio_evolution,),
+        (db.get_ai_financial_context,),
+    ])
 
 # --- Main App Logic ---
 def main():
@@ -997,6 +1046,11 @@ def main():
         return
 
     user = st.session_state.user
+
+    # Once per login: tabs opened later are served from the per-user cache
+    if user['role'] != 'admin' and st.session_state.get("prefetched_user") != user['id']:
+        st.session_state.prefetched_user = user['id']
+        prefetch_tab_data(user)
     
     # Sidebar
     with st.sidebar:
@@ -1022,6 +1076,7 @@ def main():
         st.markdown("---")
             
         # Navigation
+        from streamlit_option_menu import option_menu
         if user['role'] == 'admin':
             menu_options = ["🏠 Início", "🛡️ Painel Admin"]
             icons = ["house", "shield-lock"]
@@ -1044,7 +1099,7 @@ def main():
         # Logout at bottom
         st.markdown('<div style="height: 100px;"></div>', unsafe_allow_html=True)
         if st.button("🚪 Encerrar Sessão", use_container_width=True):
-            st.session_state.clear()
+            auth.end_session()
             st.rerun()
 
     # Routing
@@ -1077,9 +1132,9 @@ def admin_dashboard():
         </div>
     """, unsafe_allow_html=True)
     
-    users = db.get_users_df()
+    status_counts = db.get_user_status_counts()
     
-    if users.empty:
+    if not status_counts:
         st.error("📊 Nenhum usuário encontrado no banco de dados.")
         st.info("Isso acontece quando o aplicativo não consegue se conectar ao banco Neon.")
         return
@@ -1088,13 +1143,11 @@ def admin_dashboard():
     st.subheader("📊 Visão do Clã")
     c1, c2, c3 = st.columns(3)
     with c1:
-        render_kpi_card("Total Usuários", len(users), icon="👥", is_currency=False, color_theme="info")
+        render_kpi_card("Total Usuários", sum(status_counts.values()), icon="👥", is_currency=False, color_theme="info")
     with c2:
-        active_count = len(users[users['status'] == 'active']) if 'status' in users.columns else 0
-        render_kpi_card("Ativos", active_count, icon="✅", is_currency=False, color_theme="success")
+        render_kpi_card("Ativos", status_counts.get('active', 0), icon="✅", is_currency=False, color_theme="success")
     with c3:
-        pending_count = len(users[users['status'] == 'pending']) if 'status' in users.columns else 0
-        render_kpi_card("Pendentes", pending_count, icon="⏳", is_currency=False, color_theme="warning")
+        render_kpi_card("Pendentes", status_counts.get('pending', 0), icon="⏳", is_currency=False, color_theme="warning")
 
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -1112,78 +1165,80 @@ def admin_dashboard():
     with cf2:
         status_filter = st.selectbox("📂 Filtrar Status", ["Todos", "active", "pending", "blocked"], index=0)
 
-    # Apply Filters
-    filtered_users = users.copy()
-    if search:
-        filtered_users = filtered_users[filtered_users['email'].str.contains(search, case=False)]
-    if status_filter != "Todos":
-        filtered_users = filtered_users[filtered_users['status'] == status_filter]
-
-    st.markdown(f"Exibindo **{len(filtered_users)}** usuários")
+    # Server-side filters with keyset pagination (stack of cursors of the visited pages)
+    status_value = None if status_filter == "Todos" else status_filter
+    filter_key = (search, status_filter)
+    if st.session_state.get("users_filter_key") != filter_key:
+        st.session_state.users_filter_key = filter_key
+        st.session_state.users_cursors = [None]
+    cursors = st.session_state.users_cursors
+
+    page_size = db.USER_DIRECTORY_PAGE_SIZE
+    # One extra row tells whether there is a next page
+    page_users = db.get_user_directory(search, status_value, after_id=cursors[-1], limit=page_size + 1)
+    has_next = len(page_users) > page_size
+    page_users = page_users.head(page_size)
+
+    filtered_counts = db.get_user_status_counts(search) if search else status_counts
+    filtered_total = filtered_counts.get(status_value, 0) if status_value else sum(filtered_counts.values())
+    st.markdown(f"Exibindo **{len(page_users)}** de **{filtered_total}** usuários (página {len(cursors)})")
     
-    for index, row in filtered_users.iterrows():
-        # Auto-block check if expired
-        expiry = row.get('expiry_date')
-        from datetime import datetime
-        if expiry and not pd.isna(expiry) and datetime.now() > expiry and row['status'] != 'blocked':
-            db.run_query("UPDATE users SET status = 'blocked' WHERE id = %s", (row['id'],))
-            st.rerun()
+    # Multi-select grid: one widget for the whole page, actions apply to the selected rows
+    grid = page_users.copy()
+    status_labels = {'active': '🟢 active', 'pending': '🟡 pending', 'blocked': '🔴 blocked'}
+    grid['status'] = grid['status'].map(lambda s: status_labels.get(s, s))
+    grid['role'] = grid['role'].str.upper()
+    grid['expiry_date'] = grid['expiry_date'].map(lambda d: d.strftime('%d/%m/%Y') if pd.notna(d) else "Vitalício")
+    event = st.dataframe(
+        grid,
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=f"users_grid_{search}_{status_filter}_{cursors[-1]}",
+        column_config={
+            "id": st.column_config.NumberColumn("ID", width="small"),
+            "email": st.column_config.TextColumn("E-mail"),
+            "role": st.column_config.TextColumn("Perfil", width="small"),
+            "status": st.column_config.TextColumn("Status", width="small"),
+            "expiry_date": st.column_config.TextColumn("Expira em", width="small"),
+            "created_at": st.column_config.DatetimeColumn("Criado em", format="DD/MM/YYYY"),
+        },
+    )
+    selected = page_users.iloc[event.selection.rows]
+    selected_ids = [int(i) for i in selected['id']]
+    # The logged-in admin can never delete their own account
+    deletable_ids = [int(i) for i in selected[selected['email'] != st.session_state.user['email']]['id']]
+
+    st.caption(f"{len(selected_ids)} usuário(s) selecionado(s)")
+    a1, a2, a3, a4, a5 = st.columns(5)
+    result = None
+    if a1.button("✅ Aprovar / Ativar", disabled=not selected_ids, use_container_width=True):
+        result = db.set_users_status(selected_ids, 'active')
+    if a2.button("🚫 Bloquear", disabled=not selected_ids, use_container_width=True):
+        result = db.set_users_status(selected_ids, 'blocked')
+    if a3.button("⭐ Promover", disabled=not selected_ids, use_container_width=True):
+        result = db.set_users_role(selected_ids, 'admin')
+    with a4.popover("📅 Prazo", use_container_width=True, disabled=not selected_ids):
+        dias = st.number_input("Dias de Acesso", min_value=1, max_value=365, value=30, key="bulk_days")
+        if st.button("Confirmar", key="bulk_set_expiry"):
+            result = db.set_users_expiry(selected_ids, datetime.datetime.now() + datetime.timedelta(days=dias))
+    if a5.button("🗑️ Excluir", disabled=not deletable_ids, use_container_width=True):
+        confirm_delete_users(deletable_ids)
+
+    if isinstance(result, str):
+        st.error(f"Erro: {result}")
+    elif result is not None:
+        # One refresh for the whole batch
+        st.rerun()
 
-        with st.container():
-            status_color = "#10b981" if row['status'] == 'active' else "#f59e0b" if row['status'] == 'pending' else "#ef4444"
-            expiry_str = f"Expira em: {row['expiry_date'].strftime('%d/%m/%Y')}" if row.get('expiry_date') and not pd.isna(row['expiry_date']) else "Acesso Vitalício"
-            
-            c_data, c_actions = st.columns([3, 2])
-            with c_data:
-                st.markdown(f"""
-                    <div style="padding: 15px; border-radius: 12px; border: 1px solid #e2e8f0; background: white; margin-bottom: 10px;">
-                        <div style="display: flex; align-items: center; gap: 10px;">
-                            <div style="width: 10px; height: 10px; border-radius: 50%; background: {status_color};"></div>
-                            <span style="font-weight: 600; color: #0f172a;">{row['email']}</span>
-                            <span style="font-size: 0.75rem; background: #f1f5f9; padding: 2px 8px; border-radius: 10px; color: #64748b;">{row['role'].upper()}</span>
-                        </div>
-                        <div style="font-size: 0.8rem; color: #64748b; margin-top: 5px; margin-left: 20px;">
-                            📅 {expiry_str} • IDs: {row['id']} • Criado em: {row['created_at']}
-                        </div>
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            with c_actions:
-                btn_cols = st.columns([1, 1, 1])
-                
-                with st.popover("📅 Prazo", use_container_width=True):
-                    dias = st.number_input("Dias de Acesso", min_value=1, max_value=365, value=30, key=f"days_{row['id']}")
-                    if st.button("Confirmar", key=f"set_exp_{row['id']}"):
-                        from datetime import datetime, timedelta
-                        new_expiry = datetime.now() + timedelta(days=dias)
-                        db.run_query("UPDATE users SET expiry_date = %s WHERE id = %s", (new_expiry, row['id']))
-                        st.rerun()
-
-                with btn_cols[0]:
-                    if row['status'] == 'pending':
-                        if st.button("✅", key=f"app_{row['id']}", help="Aprovar"):
-                            db.run_query("UPDATE users SET status = 'active' WHERE id = %s", (row['id'],))
-                            st.rerun()
-                    elif row['status'] == 'active':
-                        if st.button("🚫", key=f"blk_{row['id']}", help="Bloquear"):
-                            db.run_query("UPDATE users SET status = 'blocked' WHERE id = %s", (row['id'],))
-                            st.rerun()
-                    else:
-                        if st.button("🔓", key=f"unblk_{row['id']}", help="Ativar"):
-                            db.run_query("UPDATE users SET status = 'active' WHERE id = %s", (row['id'],))
-                            st.rerun()
-                
-                with btn_cols[1]:
-                    if row['role'] != 'admin':
-                        if st.button("⭐", key=f"promo_{row['id']}", help="Promover"):
-                            db.run_query("UPDATE users SET role = 'admin' WHERE id = %s", (row['id'],))
-                            st.rerun()
-                
-                with btn_cols[2]:
-                    if st.button("🗑️", key=f"del_{row['id']}", help="Excluir"):
-                        if row['email'] != st.session_state.user['email']:
-                            db.run_query("DELETE FROM users WHERE id = %s", (row['id'],))
-                            st.rerun()
+    nav_prev, nav_info, nav_next = st.columns([1, 2, 1])
+    if nav_prev.button("⬅️ Anterior", disabled=len(cursors) == 1, use_container_width=True):
+        cursors.pop()
+        st.rerun()
+    if nav_next.button("Próxima ➡️", disabled=not has_next, use_container_width=True):
+        cursors.append(int(page_users['id'].iloc[-1]))
+        st.rerun()
 
     # 4. Rodapé e Segurança
     st.markdown("<br><br>", unsafe_allow_html=True)
@@ -1196,10 +1251,16 @@ def admin_dashboard():
             </div>
         """, unsafe_allow_html=True)
     with footer_cols[1]:
+        last_sweep = db.get_last_sweep()
+        sweep_info = (
+            f"Varredura de expiração: {last_sweep['at'].strftime('%H:%M:%S')} ({last_sweep['blocked']} bloqueados)"
+            if last_sweep else "Varredura de expiração: pendente"
+        )
         st.markdown(f"""
             <div style="text-align: right; color: #94a3b8; font-size: 0.8rem; margin-top: 10px;">
                 🟢 Banco Neon Sincronizado<br>
-                Última atualização: {datetime.now().strftime('%H:%M:%S')}
+                Última atualização: {datetime.datetime.now().strftime('%H:%M:%S')}<br>
+                {sweep_info}
             </div>
         """, unsafe_allow_html=True)
 
@@ -0,0 +1,10 @@
+import functools
+import os
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+@functools.lru_cache(maxsize=None)
+def style_block(name):
+    """Returns the <style> block for assets/<name>, read and built once per process."""
+    with open(os.path.join(ASSETS_DIR, name), encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
@@ -0,0 +1,34 @@
+"""Shared fixtures. The database tests need a disposable Postgres in TEST_DATABASE_URL:
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/finanflow_test python -m pytest
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import auth, config, repository
+
+TEST_PASSWORD = "senha-de-teste"
+
+@pytest.fixture(scope="session")
+def database_url():
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL não definida")
+    config.configure({"DATABASE_URL": url, "SESSION_SECRET": "test-secret"})
+    repository.ensure_schema()
+    return url
+
+@pytest.fixture
+def user(database_url):
+    """A fresh active user (a new id, so no cached reads or stickiness carry over)."""
+    email = f"teste-{uuid.uuid4().hex[:12]}@finanflow.test"
+    repository.create_user(email, auth.hash_password(TEST_PASSWORD), status="active")
+    user_id = repository.find_user_by_email(email)[0][0]
+    # The signup write marks this thread's session; tests start from a session that never wrote
+    config.session_state().clear()
+    return {"id": user_id, "email": email, "password": TEST_PASSWORD}
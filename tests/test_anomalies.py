@@ -0,0 +1,62 @@
+from decimal import Decimal
+
+import pandas as pd
+
+from core import anomalies
+
+MONTH = pd.Timestamp("2026-06-01")
+
+def _monthly(user_id=1, **categories):
+    """Monthly totals ending at MONTH, one list of totals per category (oldest first)."""
+    rows = []
+    for category, totals in categories.items():
+        months = pd.date_range(end=MONTH, periods=len(totals), freq="MS")
+        rows += [{"user_id": user_id, "month": m, "category": category, "total": t} for m, t in zip(months, totals)]
+    return pd.DataFrame(rows, columns=["user_id", "month", "category", "total"])
+
+def _daily(usual, days_of_month, user_id=1):
+    """Daily totals: `usual` on every day of the baseline window, then {day of MONTH: total}."""
+    days = pd.date_range(end=MONTH - pd.Timedelta(days=1), periods=anomalies.DAY_BASELINE_DAYS, freq="D")
+    rows = [{"user_id": user_id, "date": d, "total": usual} for d in days]
+    rows += [{"user_id": user_id, "date": MONTH + pd.Timedelta(days=day - 1), "total": t} for day, t in days_of_month.items()]
+    return pd.DataFrame(rows, columns=["user_id", "date", "total"])
+
+def test_month_far_above_its_baseline_is_a_spike():
+    found = anomalies.detect(_monthly(Mercado=[100.0] * 12 + [400.0], Luz=[80.0] * 13), pd.DataFrame(), MONTH)
+    assert list(found["kind"]) == ["pico"]
+    row = found.iloc[0]
+    assert row["category"] == "Mercado" and row["amount"] == 400.0 and row["baseline"] == 100.0
+
+def test_new_repeated_charge_is_recurring_not_a_spike():
+    found = anomalies.detect(_monthly(Mercado=[300.0] * 13, Streaming=[0.0] * 11 + [40.0, 40.0]), pd.DataFrame(), MONTH)
+    assert list(found["kind"]) == ["recorrente"]
+    assert found.iloc[0]["category"] == "Streaming"
+
+def test_day_far_above_the_usual_spending_day_is_flagged():
+    found = anomalies.detect(pd.DataFrame(), _daily(20.0, {3: 25.0, 10: 300.0}), MONTH)
+    assert list(found["kind"]) == ["dia"]
+    assert found.iloc[0]["period"] == pd.Timestamp("2026-06-10")
+    assert found.iloc[0]["category"] == ""
+
+def test_decimal_totals_give_the_same_anomalies_as_floats():
+    monthly = _monthly(Mercado=[100.0] * 12 + [400.0])
+    daily = _daily(20.0, {10: 300.0})
+    as_decimal = lambda frame: frame.assign(total=[Decimal(str(t)) for t in frame["total"]])
+    expected = anomalies.detect(monthly, daily, MONTH)
+    found = anomalies.detect(as_decimal(monthly), as_decimal(daily), MONTH)
+    assert sorted(found["kind"]) == ["dia", "pico"]
+    pd.testing.assert_frame_equal(found, expected)
+
+def test_steady_spending_has_no_anomalies():
+    found = anomalies.detect(_monthly(Mercado=[100.0, 110.0, 95.0] * 4 + [105.0]), _daily(20.0, {10: 22.0}), MONTH)
+    assert found.empty and list(found.columns) == anomalies.COLUMNS
+
+def test_empty_input_has_no_anomalies():
+    # What the repository returns without a connection or any expense
+    for monthly, daily in ((pd.DataFrame(), pd.DataFrame()), (_monthly(), _daily(20.0, {})[:0])):
+        found = anomalies.detect(monthly, daily, MONTH)
+        assert found.empty and list(found.columns) == anomalies.COLUMNS
+
+def test_short_history_is_not_judged():
+    found = anomalies.detect(_monthly(Mercado=[100.0, 100.0, 900.0]), _daily(20.0, {})[:5], MONTH)
+    assert found.empty
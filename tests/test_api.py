@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("httpx")
+from starlette.testclient import TestClient
+
+import api
+
+URL = api.API_PREFIX
+
+@pytest.fixture
+def client(database_url):
+    with TestClient(api.app) as client:
+        yield client
+
+@pytest.fixture
+def headers(client, user):
+    response = client.post(f"{URL}/login", json={"email": user["email"], "password": user["password"]})
+    assert response.status_code == 200
+    return {"Authorization": f"Bearer {response.json()['token']}"}
+
+def _transaction(**fields):
+    return {"date": datetime.date.today().isoformat(), "type": "Saída", "category": "Mercado",
+            "amount": 42.5, "description": "feira", **fields}
+
+def test_login(client, user):
+    assert client.post(f"{URL}/login", json=["não", "é", "objeto"]).status_code == 400
+    assert client.post(f"{URL}/login", json={"email": user["email"], "password": "errada"}).status_code == 401
+
+    response = client.post(f"{URL}/login", json={"email": user["email"], "password": user["password"]})
+    assert response.status_code == 200
+    assert response.json()["user"]["id"] == user["id"]
+    assert client.get(f"{URL}/transactions").status_code == 401
+
+def test_add_and_list_transactions(client, headers):
+    response = client.post(f"{URL}/transactions", json=[_transaction(), _transaction(amount=10)], headers=headers)
+    assert response.status_code == 201
+    assert response.json() == {"created": 2}
+    assert client.post(f"{URL}/transactions", json=_transaction(type="Outro"), headers=headers).status_code == 400
+
+    response = client.get(f"{URL}/transactions", params={"limit": 1}, headers=headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 2
+    assert len(body["items"]) == 1
+    assert body["next_offset"] == 1
+
+    again = client.get(f"{URL}/transactions", params={"limit": 1}, headers={**headers, "If-None-Match": response.headers["etag"]})
+    assert again.status_code == 304
+
+def test_update_and_delete_transactions(client, headers):
+    client.post(f"{URL}/transactions", json=[_transaction(), _transaction(description="outra")], headers=headers)
+    ids = [item["id"] for item in client.get(f"{URL}/transactions", headers=headers).json()["items"]]
+
+    response = client.put(f"{URL}/transactions/{ids[0]}", json=_transaction(amount=99, description="editada"), headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"updated": ids[0]}
+    items = client.get(f"{URL}/transactions", headers=headers).json()["items"]
+    assert {"editada": 99.0} == {i["description"]: i["amount"] for i in items if i["id"] == ids[0]}
+    assert client.put(f"{URL}/transactions/999999999", json=_transaction(), headers=headers).status_code == 404
+
+    assert client.delete(f"{URL}/transactions/{ids[0]}", headers=headers).status_code == 204
+    assert client.delete(f"{URL}/transactions/{ids[0]}", headers=headers).status_code == 404
+
+    response = client.request("DELETE", f"{URL}/transactions", json={"ids": ids}, headers=headers)
+    assert response.json() == {"deleted": 1}
+    assert client.get(f"{URL}/transactions", headers=headers).json()["total"] == 0
+
+def test_batch_delete_rejects_invalid_ids(client, headers):
+    for ids in ([""], [None], ["x"], [0], [2 ** 31]):
+        response = client.request("DELETE", f"{URL}/transactions", json={"ids": ids}, headers=headers)
+        assert response.status_code == 400, ids
+    assert client.delete(f"{URL}/transactions/{2 ** 40}", headers=headers).status_code == 404
+
+def test_amounts_are_bounded(client, headers):
+    for amount in (1e30, "1e30", 0, 0.001, -5, "NaN", "abc", None):
+        response = client.post(f"{URL}/transactions", json=_transaction(amount=amount), headers=headers)
+        assert response.status_code == 400, amount
+    redemption = _transaction(type="Investimento", category="CDB", amount=-150)
+    assert client.post(f"{URL}/transactions", json=redemption, headers=headers).status_code == 201
+    assert client.put(f"{URL}/goals", json={"category": "CDB", "target": 1e30}, headers=headers).status_code == 400
+
+def test_delete_goal(client, headers):
+    assert client.put(f"{URL}/goals", json={"category": "CDB", "target": 5000}, headers=headers).status_code == 200
+    goal_id = client.get(f"{URL}/goals", headers=headers).json()["items"][0]["id"]
+    assert client.delete(f"{URL}/goals/{goal_id}", headers=headers).status_code == 204
+    assert client.delete(f"{URL}/goals/{goal_id}", headers=headers).status_code == 404
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+from core import auth, config
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the limiter's monotonic clock with one the test advances by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, "monotonic", lambda: now[0])
+    return now
+
+@pytest.fixture
+def proxy_hops(monkeypatch):
+    """Sets TRUSTED_PROXY_HOPS for client_address without touching the configured secrets."""
+    def set_hops(hops):
+        get_setting = config.get_setting
+        monkeypatch.setattr(config, "get_setting",
+                            lambda key, default=None: hops if key == "TRUSTED_PROXY_HOPS" else get_setting(key, default))
+    return set_hops
+
+def test_token_bucket_allows_burst_then_refills(clock):
+    limiter = auth.TokenBucketLimiter(burst=3, refill_seconds=10)
+    assert [limiter.allow("a") for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow("b")  # buckets are per key
+    clock[0] += 9
+    assert not limiter.allow("a")
+    clock[0] += 1
+    assert limiter.allow("a")
+    assert not limiter.allow("a")
+
+def test_token_bucket_refill_is_capped_at_burst(clock):
+    limiter = auth.TokenBucketLimiter(burst=2, refill_seconds=1)
+    limiter.allow("a")
+    clock[0] += 3600
+    assert [limiter.allow("a") for _ in range(3)] == [True, True, False]
+
+def test_token_bucket_forgets_least_recently_used_keys(clock):
+    limiter = auth.TokenBucketLimiter(burst=1, refill_seconds=60, max_keys=2)
+    assert limiter.allow("a") and limiter.allow("b")
+    assert not limiter.allow("a")  # "a" is now the most recently used
+    assert limiter.allow("c")      # evicts "b"
+    assert list(limiter._buckets) == ["a", "c"]
+    assert limiter.allow("b")      # a forgotten key starts with a full bucket
+
+def test_client_address_ignores_forwarded_for_without_trusted_proxies(proxy_hops):
+    proxy_hops(0)
+    assert auth.client_address("1.1.1.1", "10.0.0.5") == "10.0.0.5"
+    assert auth.client_address(None, None) is None
+
+def test_client_address_counts_trusted_hops_from_the_right(proxy_hops):
+    proxy_hops(2)
+    # Whatever the client sent comes first; each trusted proxy appended one entry
+    assert auth.client_address("6.6.6.6, 203.0.113.7, 10.0.0.2", "10.0.0.3") == "203.0.113.7"
+    assert auth.client_address("203.0.113.7 , 10.0.0.2,", "10.0.0.3") == "203.0.113.7"
+
+def test_client_address_falls_back_to_peer_on_short_forwarded_for(proxy_hops):
+    proxy_hops(2)
+    assert auth.client_address("203.0.113.7", "10.0.0.3") == "10.0.0.3"
+    assert auth.client_address(" , ", "10.0.0.3") == "10.0.0.3"
+    assert auth.client_address(None, "10.0.0.3") == "10.0.0.3"
+
+def test_verify_password_bounded_rejects_when_saturated(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    def slow_verify(password, hashed):
+        started.set()
+        release.wait(5)
+        return True
+    monkeypatch.setattr(auth, "verify_password", slow_verify)
+    monkeypatch.setattr(auth, "_bcrypt_slots", threading.BoundedSemaphore(1))
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(auth.verify_password_bounded("x", "h")))
+    first.start()
+    assert started.wait(5)
+    assert auth.verify_password_bounded("x", "h") is None  # the only slot is taken
+    release.set()
+    first.join(5)
+    assert results == [True]
+    # The slot is released by a done-callback, which may run just after the result is handed over
+    assert auth._bcrypt_slots.acquire(timeout=5)
+    auth._bcrypt_slots.release()
+    assert auth.verify_password_bounded("x", "h") is True
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("plotly")
+
+import charts
+
+def _table():
+    index = pd.date_range("2024-01-01", periods=5)
+    return pd.DataFrame({"Entrada": [1.0, 2, 3, 4, 5], "Saída": [0.5, 1, 1, 2, 2], "Saldo Acumulado": [0.5, 1.5, 3.5, 5.5, 8.5]}, index=index)
+
+def test_cached_figures_are_private_copies_of_one_spec():
+    charts.clear_figure_cache()
+    first = charts.cashflow_chart(_table())
+    second = charts.cashflow_chart(_table())
+    assert charts.figure_cache_info()[0] == 1
+    assert first is not second
+    assert first.to_plotly_json() == second.to_plotly_json()
+
+    first.update_layout(height=10)
+    assert charts.cashflow_chart(_table()).layout.height == 400
+
+def test_figure_cache_is_keyed_by_data_and_options():
+    charts.clear_figure_cache()
+    table = _table()
+    charts.cashflow_chart(table)
+    charts.cashflow_chart(table.assign(Entrada=table["Entrada"] * 2))
+    charts.sparkline(table[["Entrada"]], "#3b82f6")
+    charts.sparkline(table[["Entrada"]], "#ef4444")
+    assert charts.figure_cache_info()[0] == 4
@@ -0,0 +1,74 @@
+import datetime
+import random
+import types
+
+import pytest
+
+from core import chat
+
+START = datetime.datetime(2026, 1, 1)
+
+def _turns(contents, start_id=1):
+    return [{"id": start_id + i, "role": ("user", "assistant")[i % 2], "content": content,
+             "created_at": START + datetime.timedelta(minutes=start_id + i)} for i, content in enumerate(contents)]
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Replaces the repository calls of history_for_prompt with an in-memory conversation."""
+    data = {"turns": [], "summary": None, "covers_until": None, "matches": []}
+    def get_chat_messages(user_id, limit):
+        return data["turns"][-limit:]
+    def search_chat_messages(user_id, text, before, limit):
+        return [t for t in data["matches"] if (t["created_at"], t["id"]) < before][:limit]
+    monkeypatch.setattr(chat, "repository", types.SimpleNamespace(
+        get_chat_summary=lambda user_id: (data["summary"], data["covers_until"]),
+        get_chat_messages=get_chat_messages,
+        search_chat_messages=search_chat_messages,
+    ))
+    return data
+
+def test_new_conversation_has_no_history(stored):
+    assert chat.history_for_prompt(1, "quanto gastei?") == ""
+
+def test_recent_turns_come_in_order_after_summary_and_matches(stored):
+    stored["summary"], stored["covers_until"] = "Usuário quer juntar para uma viagem.", START
+    stored["matches"] = _turns(["Quanto rende o CDB?"], start_id=-10)
+    stored["turns"] = _turns(["Oi", "Olá! Como posso ajudar?"])
+    history = chat.history_for_prompt(1, "CDB")
+    assert history == (
+        "RESUMO DA CONVERSA ANTERIOR:\nUsuário quer juntar para uma viagem.\n\n"
+        "TRECHOS ANTERIORES RELACIONADOS:\nUsuário: Quanto rende o CDB?\n\n"
+        "CONVERSA RECENTE:\nUsuário: Oi\nFinanBot: Olá! Como posso ajudar?"
+    )
+
+def test_turns_folded_into_the_summary_are_left_out(stored):
+    stored["turns"] = _turns(["antiga", "resumida", "nova"])
+    stored["summary"], stored["covers_until"] = "resumo", stored["turns"][1]["created_at"]
+    assert chat.history_for_prompt(1, "x").endswith("CONVERSA RECENTE:\nUsuário: nova")
+
+def test_long_turns_are_clipped_and_the_newest_kept(stored):
+    stored["turns"] = _turns([f"{i} " + "x" * 5000 for i in range(chat.CHAT_WINDOW)])
+    lines = chat.history_for_prompt(1, "x").split("\n")[1:]
+    assert all(len(line) <= len("FinanBot: ") + chat.CHAT_TURN_MAX_CHARS for line in lines)
+    assert lines[-1].startswith(f"FinanBot: {chat.CHAT_WINDOW - 1} ")
+
+@pytest.mark.parametrize("seed", range(25))
+def test_history_never_exceeds_the_budget(stored, seed):
+    rng = random.Random(seed)
+    text = lambda: "y" * rng.choice([0, 1, 10, 200, 1000, 3000, 10000])
+    stored["summary"] = text() or None
+    stored["turns"] = _turns([text() for _ in range(rng.randint(0, 40))], start_id=100)
+    stored["matches"] = _turns([text() for _ in range(rng.randint(0, 5))], start_id=1)
+    assert len(chat.history_for_prompt(1, "y")) <= chat.CHAT_HISTORY_BUDGET
+
+def test_full_sections_and_their_headings_fit_the_budget(stored):
+    # Every section filled to the character, so the headings and blank lines are what would overflow
+    stored["summary"] = "s" * chat.CHAT_SUMMARY_MAX_CHARS
+    stored["turns"] = _turns(["u" * chat.CHAT_TURN_MAX_CHARS, "a" * chat.CHAT_TURN_MAX_CHARS] * 10, start_id=100)
+    stored["matches"] = _turns(["m" * chat.CHAT_TURN_MAX_CHARS] * 3, start_id=1)
+    for size in range(1, chat.CHAT_TURN_MAX_CHARS, 7):
+        stored["turns"][-1]["content"] = "a" * size
+        stored["turns"][-2]["content"] = "u" * (chat.CHAT_TURN_MAX_CHARS - size)
+        for match in stored["matches"]:
+            match["content"] = "m" * (size // 2 + 600)
+        assert len(chat.history_for_prompt(1, "m")) <= chat.CHAT_HISTORY_BUDGET
@@ -0,0 +1,58 @@
+import pytest
+
+from core import jobs
+
+class FakeConnection:
+    """Connection whose cursor answers the job lookup with `row`, or raises `error`."""
+
+    def __init__(self, row=None, error=None):
+        self.row, self.error, self.closed = row, error, False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=()):
+        if self.error:
+            raise self.error
+
+    def fetchone(self):
+        return self.row
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def failing_job(monkeypatch):
+    """A registered job kind whose handler always fails, with the outcome writes recorded."""
+    def fail(job):
+        raise RuntimeError("falhou")
+    monkeypatch.setitem(jobs._handlers, "test_failing", fail)
+    finished = []
+    monkeypatch.setattr(jobs, "_finish", lambda job_id, status, **kw: finished.append((job_id, status, kw)))
+    return (7, 1, "test_failing", {}, 1, None, {}), finished
+
+def test_failed_job_is_requeued_while_attempts_remain(monkeypatch, failing_job):
+    row, finished = failing_job
+    conn = FakeConnection(row=(3, False))
+    monkeypatch.setattr(jobs, "_connection", lambda: conn)
+    jobs.run_job(row)
+    assert conn.closed
+    assert finished[0][:2] == (7, "queued")
+    assert finished[0][2]["retry_in"] == jobs.JOB_RETRY_DELAY
+
+def test_failed_job_deleted_meanwhile_records_nothing(monkeypatch, failing_job):
+    row, finished = failing_job
+    conn = FakeConnection(row=None)
+    monkeypatch.setattr(jobs, "_connection", lambda: conn)
+    jobs.run_job(row)
+    assert conn.closed
+    assert finished == []
+
+def test_failed_lookup_closes_the_connection(monkeypatch, failing_job):
+    row, finished = failing_job
+    conn = FakeConnection(error=RuntimeError("fila fora do ar"))
+    monkeypatch.setattr(jobs, "_connection", lambda: conn)
+    with pytest.raises(RuntimeError, match="fila fora do ar"):
+        jobs.run_job(row)
+    assert conn.closed
+    assert finished == []
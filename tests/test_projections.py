@@ -0,0 +1,72 @@
+import pandas as pd
+
+from core import projections
+
+TODAY = pd.Timestamp("2026-06-15")
+
+def _goals(*rows):
+    return pd.DataFrame(rows, columns=["category", "current", "target"])
+
+def _history(**columns):
+    index = pd.period_range(end=TODAY.to_period("M"), periods=projections.CONTRIBUTION_MONTHS, freq="M")
+    return pd.DataFrame({cat: [float(v)] * len(index) for cat, v in columns.items()}, index=index)
+
+def test_monthly_contributions_sums_investments_per_month_and_category():
+    df = pd.DataFrame([
+        {"date": "2026-06-02", "type": "Investimento", "category": "CDB", "amount": 100.0},
+        {"date": "2026-06-20", "type": "Investimento", "category": "CDB", "amount": -30.0},
+        {"date": "2026-04-10", "type": "Investimento", "category": "Ações", "amount": 50.0},
+        {"date": "2026-06-05", "type": "Saída", "category": "Mercado", "amount": 80.0},
+        {"date": "2024-01-10", "type": "Investimento", "category": "CDB", "amount": 999.0},  # outside the window
+    ])
+    history = projections.monthly_contributions(df, today=TODAY)
+    assert len(history) == projections.CONTRIBUTION_MONTHS
+    assert history.index[-1] == pd.Period("2026-06", "M")
+    assert sorted(history.columns) == ["Ações", "CDB"]
+    assert history.loc[pd.Period("2026-06", "M"), "CDB"] == 70.0
+    assert history.loc[pd.Period("2026-04", "M"), "Ações"] == 50.0
+    assert history["CDB"].sum() == 70.0
+
+def test_monthly_contributions_of_no_transactions_is_an_empty_window():
+    history = projections.monthly_contributions(pd.DataFrame(), today=TODAY)
+    assert history.empty and len(history.index) == projections.CONTRIBUTION_MONTHS
+
+def test_project_goals_is_reproducible_with_a_seed():
+    goals = _goals(("CDB", 1000.0, 5000.0), ("Ações", 200.0, 3000.0))
+    history = _history(CDB=150, Ações=80)
+    assumptions = {"CDB": (10.0, 2.0), "Ações": (12.0, 25.0)}
+    first = projections.project_goals(goals, history, assumptions, today=TODAY, paths=200, seed=42)
+    second = projections.project_goals(goals, history, assumptions, today=TODAY, paths=200, seed=42)
+    pd.testing.assert_frame_equal(first[0], second[0])
+    for cat in ("CDB", "Ações"):
+        pd.testing.assert_frame_equal(first[1][cat], second[1][cat])
+
+def test_project_goals_without_risk_reaches_the_target_on_schedule():
+    # No yield and no volatility: 100 a month from 0 reaches 300 in exactly three months on every path
+    goals = _goals(("CDB", 0.0, 300.0))
+    summary, bands = projections.project_goals(goals, _history(CDB=100), {"CDB": (0.0, 0.0)},
+                                               today=TODAY, paths=50, seed=1)
+    row = summary.iloc[0]
+    assert row["probability"] == 1.0
+    assert row["eta_p10"] == row["eta_p50"] == row["eta_p90"] == pd.Timestamp("2026-09-01")
+    assert list(bands["CDB"]["p50"].iloc[:4]) == [0.0, 100.0, 200.0, 300.0]
+
+def test_project_goals_reached_and_unreachable_goals():
+    goals = _goals(("CDB", 500.0, 400.0), ("Tesouro", 0.0, 1000.0))
+    summary, _ = projections.project_goals(goals, _history(), {"CDB": (0.0, 0.0), "Tesouro": (0.0, 0.0)},
+                                           today=TODAY, paths=20, months=24, seed=1)
+    reached, unreachable = summary.iloc[0], summary.iloc[1]
+    assert reached["probability"] == 1.0 and reached["eta_p50"] == pd.Timestamp("2026-06-01")
+    assert unreachable["probability"] == 0.0 and pd.isna(unreachable["eta_p90"])
+
+def test_project_goals_bands_are_ordered():
+    goals = _goals(("Ações", 1000.0, 1e9))
+    _, bands = projections.project_goals(goals, _history(Ações=100), {"Ações": (12.0, 30.0)},
+                                         today=TODAY, paths=300, months=36, seed=7)
+    band = bands["Ações"]
+    assert len(band) == 37
+    assert (band["p10"] <= band["p50"]).all() and (band["p50"] <= band["p90"]).all()
+
+def test_project_goals_of_no_goals_is_empty():
+    summary, bands = projections.project_goals(_goals(), _history(), {}, today=TODAY)
+    assert summary.empty and bands == {}
@@ -0,0 +1,126 @@
+import datetime
+
+import psycopg2
+import pytest
+
+from core import config, repository
+
+def _fake_replica(database_url, calls):
+    """Stands in for _connect_replica: a read-only connection to the test database, counted."""
+    def connect():
+        calls.append(1)
+        conn = psycopg2.connect(database_url)
+        conn.set_session(readonly=True, autocommit=True)
+        return conn
+    return connect
+
+def _read(user_id):
+    repository.get_connection(readonly=True, user_id=user_id).close()
+
+def test_reads_stay_on_primary_after_the_sessions_write(database_url, user, monkeypatch):
+    calls = []
+    monkeypatch.setattr(repository, "_connect_replica", _fake_replica(database_url, calls))
+    uid = user["id"]
+
+    _read(uid)
+    assert len(calls) == 1
+
+    repository.add_transaction(uid, datetime.date.today(), "Entrada", "Salário", 100, "pagamento")
+    _read(uid)
+    assert len(calls) == 1
+
+    monkeypatch.setattr(repository, "REPLICA_STICKY_SECONDS", 0)
+    _read(uid)
+    assert len(calls) == 2
+
+def test_reads_stay_on_primary_after_a_users_write_elsewhere(database_url, user, monkeypatch):
+    calls = []
+    monkeypatch.setattr(repository, "_connect_replica", _fake_replica(database_url, calls))
+    uid = user["id"]
+    repository.add_transaction(uid, datetime.date.today(), "Entrada", "Salário", 100, "pagamento")
+
+    # Another session of this process reading the same user
+    config.session_state().clear()
+    _read(uid)
+    assert len(calls) == 0
+
+    # Another process: only the data version row tells about the write
+    repository._user_writes.pop(uid, None)
+    repository._user_versions.pop(uid, None)
+    assert len(repository.get_transactions_df(uid)) == 1
+    assert len(calls) == 0
+
+    monkeypatch.setattr(repository, "REPLICA_STICKY_SECONDS", 0)
+    _read(uid)
+    assert len(calls) == 1
+
+def test_cached_reads_see_writes_from_other_processes(database_url, user, monkeypatch):
+    monkeypatch.setattr(repository, "USER_CACHE_CHECK_INTERVAL", 0)
+    uid = user["id"]
+    repository.add_transaction(uid, datetime.date.today(), "Saída", "Mercado", 40, "feira")
+    assert len(repository.get_transactions_df(uid)) == 1
+
+    # Written behind this process's back, as the API or a worker would
+    conn = psycopg2.connect(database_url)
+    with conn, conn.cursor() as c:
+        c.execute(
+            "INSERT INTO transactions (user_id, date, type, category_id, amount_cents, description) "
+            "VALUES (%s, CURRENT_DATE, 'Saída', category_id_for(%s, 'Saída', 'Mercado'), 2500, 'padaria')",
+            (uid, uid)
+        )
+    conn.close()
+
+    assert len(repository.get_transactions_df(uid)) == 2
+    assert repository.get_all_categories(uid, "Saída") == ["Mercado"]
+
+def test_transaction_pages_merge_archived_years_read_only(database_url, user):
+    uid = user["id"]
+    old = datetime.date(2001, 3, 10)
+    this_year = datetime.date(datetime.date.today().year, 1, 1)
+    repository.add_transactions(uid, [
+        (old + datetime.timedelta(days=i), "Saída", "Mercado", 10 + i, f"antiga {i}") for i in range(3)
+    ])
+    repository.add_transactions(uid, [
+        (this_year + datetime.timedelta(days=i), "Entrada", "Salário", 100, f"nova {i}") for i in range(4)
+    ])
+    conn = repository.get_connection()
+    repository._ensure_transaction_partitions(conn.cursor())
+    conn.commit()
+    conn.close()
+    assert 2001 in repository.archive_closed_years()
+
+    page, total = repository.get_transactions_page(uid, limit=5, offset=0)
+    assert total == 7
+    assert list(page['description']) == ["nova 3", "nova 2", "nova 1", "nova 0", "antiga 2"]
+    assert list(page['archived']) == [False] * 4 + [True]
+
+    rest, _ = repository.get_transactions_page(uid, limit=5, offset=5)
+    assert list(rest['description']) == ["antiga 1", "antiga 0"]
+    assert rest['archived'].all()
+
+    # A range without archived years is paged in SQL
+    live, live_total = repository.get_transactions_page(uid, start=this_year, type_filter="Entrada", limit=2, offset=2)
+    assert live_total == 4
+    assert list(live['description']) == ["nova 1", "nova 0"]
+    assert not live['archived'].any()
+
+    # Archived rows are not in transactions any more: edits match nothing
+    archived_id = int(rest['id'].iloc[0])
+    assert repository.update_transaction(archived_id, old, "Saída", "Mercado", 1, "x", uid) == 0
+    assert repository.delete_transaction(archived_id, uid) == 0
+    assert repository.delete_transaction(int(live['id'].iloc[0]), uid) == 1
+
+def test_import_progress_commits_with_its_batch(database_url, user):
+    uid = user["id"]
+    job_id = uid * 1000  # no jobs row needed: progress is keyed by job id on the user's shard
+    day = datetime.date.today()
+    assert repository.get_import_progress(uid, job_id) == 0
+
+    repository.add_transactions(uid, [(day, "Saída", "Mercado", 10, "a"), (day, "Saída", "Mercado", 20, "b")], import_job=(job_id, 2))
+    assert repository.get_import_progress(uid, job_id) == 2
+
+    # A failing batch rolls its progress back with its rows
+    with pytest.raises(repository.QueryError):
+        repository.add_transactions(uid, [(day, "Saída", "Mercado", 30, "c"), (day, "Outro", "X", 1, "d")], import_job=(job_id, 4))
+    assert repository.get_import_progress(uid, job_id) == 2
+    assert len(repository.get_transactions_df(uid)) == 2